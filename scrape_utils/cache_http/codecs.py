@@ -0,0 +1,271 @@
+"""codecs.py.
+
+Compression codecs of http cache bodies
+
+zstd can use dictionaries trained per domain: pages of one site share most of
+their markup, which per-page compression cannot exploit. Dictionaries are stored in
+redis under their zstd dict id, which is written into every record, so entries
+stay decodable after a domain gets a newer dictionary
+"""
+import hashlib
+import logging
+import struct
+import threading
+from enum import IntEnum
+from typing import Dict, Final, List, Optional, Sequence
+from urllib.parse import urlsplit
+
+import lz4.block as lz4  # type: ignore[import]
+import redis
+
+from ..core.settings import (HTTP_CACHE_BODY_DIGEST_SIZE,
+                             HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY,
+                             HTTP_CACHE_ZSTD_DICT_SIZE_DEFAULT,
+                             HTTP_CACHE_ZSTD_DICTS_KEY,
+                             HTTP_CACHE_ZSTD_DOMAINS_TTL,
+                             HTTP_CACHE_ZSTD_LEVEL)
+from ..utils.lru import LRUCache
+
+try:
+    import zstandard as zstd  # type: ignore[import]
+except ModuleNotFoundError:
+    zstd = None
+
+logger = logging.getLogger(__name__)
+
+# framed bodies, for storage without a record header, e.g. the pg body column
+FRAME_MAGIC: Final[bytes] = b"SUHB"
+# magic, codec, dict_id, raw_size
+FRAME_HEADER: Final[struct.Struct] = struct.Struct("<4sBII")
+
+
+class BodyCodec(IntEnum):
+    """Compression codec of the body, stored in the record header."""
+
+    none = 0
+    lz4 = 1
+    zstd = 2
+
+
+def _check_zstd() -> None:
+    if zstd is None:
+        raise ModuleNotFoundError("install `zstandard` to use zstd compression")
+
+
+def body_digest(body: bytes) -> bytes:
+    """Content address of an uncompressed body."""
+    return hashlib.blake2b(body, digest_size=HTTP_CACHE_BODY_DIGEST_SIZE).digest()
+
+
+def url_domain(url: str) -> str:
+    return urlsplit(url).hostname or ""
+
+
+def train_dictionary(
+    samples: Sequence[bytes],
+    dict_size: int = HTTP_CACHE_ZSTD_DICT_SIZE_DEFAULT,
+    level: int = HTTP_CACHE_ZSTD_LEVEL,
+) -> "zstd.ZstdCompressionDict":
+    _check_zstd()
+    assert len(samples) > 0, "need samples to train a dictionary"
+    return zstd.train_dictionary(dict_size, list(samples), level=level)
+
+
+class ZstdDictionaries:
+    """Trained zstd dictionaries, stored in redis.
+
+    `HTTP_CACHE_ZSTD_DICTS_KEY` maps dict ids to dictionaries, and
+    `HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY` maps domains to the dict id to compress with.
+    Dictionaries never change once stored, so they are cached in-process
+
+    Usage:
+        dicts = ZstdDictionaries(client)
+        dict_id = dicts.train("example.com", bodies)
+    """
+
+    def __init__(
+        self, client: redis.StrictRedis, level: int = HTTP_CACHE_ZSTD_LEVEL
+    ) -> None:
+        _check_zstd()
+        self.client: redis.StrictRedis = client
+        self.level: int = level
+        self._dicts: Dict[int, "zstd.ZstdCompressionDict"] = {}
+        # domain -> current dict id, refreshed after the ttl to pick up new dictionaries
+        self._domains = LRUCache(10_000, ttl=HTTP_CACHE_ZSTD_DOMAINS_TTL)
+        # compressors and decompressors are not thread-safe
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def get(self, dict_id: int) -> "zstd.ZstdCompressionDict":
+        dictionary = self._dicts.get(dict_id)
+        if dictionary is not None:
+            return dictionary
+
+        data: Optional[bytes] = self.client.hget(HTTP_CACHE_ZSTD_DICTS_KEY, dict_id)
+        if data is None:
+            raise KeyError(f"zstd dictionary {dict_id} not found")
+
+        dictionary = zstd.ZstdCompressionDict(data)
+        dictionary.precompute_compress(level=self.level)
+        with self._lock:
+            self._dicts[dict_id] = dictionary
+
+        return dictionary
+
+    def dict_id_for_url(self, url: str) -> int:
+        """Get the current dict id of the domain of `url`, 0 if it has none."""
+        domain: str = url_domain(url)
+        dict_id: Optional[int] = self._domains.get(domain)
+        if dict_id is None:
+            value = self.client.hget(HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY, domain)
+            dict_id = int(value) if value is not None else 0
+            self._domains.set(domain, dict_id)
+
+        return dict_id
+
+    def put(self, domain: str, dictionary: "zstd.ZstdCompressionDict") -> int:
+        """Store `dictionary` and make it current for `domain`, returns its dict id."""
+        dict_id: int = dictionary.dict_id()
+        assert dict_id != 0, "dictionary has no id"
+        with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(HTTP_CACHE_ZSTD_DICTS_KEY, dict_id, dictionary.as_bytes())
+            pipe.hset(HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY, domain, dict_id)
+            pipe.execute()
+
+        self._domains.set(domain, dict_id)
+        logger.info(f"stored zstd dictionary {dict_id} for `{domain}`")
+        return dict_id
+
+    def train(
+        self,
+        domain: str,
+        samples: Sequence[bytes],
+        dict_size: int = HTTP_CACHE_ZSTD_DICT_SIZE_DEFAULT,
+    ) -> int:
+        """Train a dictionary on sample bodies, and store it for `domain`."""
+        dictionary = train_dictionary(samples, dict_size, self.level)
+        return self.put(domain, dictionary)
+
+    def compressor(self, dict_id: int) -> "zstd.ZstdCompressor":
+        compressors = self._local.__dict__.setdefault("compressors", {})
+        compressor = compressors.get(dict_id)
+        if compressor is None:
+            dictionary = self.get(dict_id) if dict_id else None
+            compressor = zstd.ZstdCompressor(
+                level=self.level, dict_data=dictionary, write_content_size=False
+            )
+            compressors[dict_id] = compressor
+
+        return compressor
+
+    def decompressor(self, dict_id: int) -> "zstd.ZstdDecompressor":
+        decompressors = self._local.__dict__.setdefault("decompressors", {})
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            dictionary = self.get(dict_id) if dict_id else None
+            decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+            decompressors[dict_id] = decompressor
+
+        return decompressor
+
+
+def compress_body(
+    body: bytes,
+    codec: BodyCodec,
+    dict_id: int = 0,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> bytes:
+    match codec:
+        case BodyCodec.none:
+            return bytes(body)
+        case BodyCodec.lz4:
+            # the uncompressed size is stored in the record header
+            return lz4.compress(body, store_size=False)
+        case BodyCodec.zstd:
+            if dicts is not None:
+                return dicts.compressor(dict_id).compress(body)
+            assert dict_id == 0, f"need dictionaries to compress with {dict_id=}"
+            _check_zstd()
+            return zstd.ZstdCompressor(
+                level=HTTP_CACHE_ZSTD_LEVEL, write_content_size=False
+            ).compress(body)
+        case other:
+            raise NotImplementedError(f"{other=}")
+
+
+def decompress_body(
+    data: memoryview | bytes,
+    codec: BodyCodec,
+    raw_size: int,
+    dict_id: int = 0,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> bytes:
+    if raw_size == 0:
+        return b""
+
+    match codec:
+        case BodyCodec.none:
+            return bytes(data)
+        case BodyCodec.lz4:
+            return lz4.decompress(data, uncompressed_size=raw_size)
+        case BodyCodec.zstd:
+            if dicts is not None:
+                decompressor = dicts.decompressor(dict_id)
+            elif dict_id != 0:
+                raise ValueError(f"need zstd dictionaries to decompress {dict_id=}")
+            else:
+                _check_zstd()
+                decompressor = zstd.ZstdDecompressor()
+            return decompressor.decompress(data, max_output_size=raw_size)
+        case other:
+            raise NotImplementedError(f"{other=}")
+
+
+def resolve_dict_id(
+    url: str, codec: BodyCodec, dicts: Optional[ZstdDictionaries] = None
+) -> int:
+    """Get the dict id to compress the body of `url` with, 0 for none."""
+    if codec != BodyCodec.zstd or dicts is None:
+        return 0
+
+    return dicts.dict_id_for_url(url)
+
+
+def encode_body_frame(
+    body: bytes,
+    url: str,
+    codec: BodyCodec = BodyCodec.zstd,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> bytes:
+    """Compress a body with a small header, for storage outside a `CacheRecord`."""
+    dict_id: int = resolve_dict_id(url, codec, dicts)
+    compressed: bytes = compress_body(body, codec, dict_id, dicts)
+    return FRAME_HEADER.pack(FRAME_MAGIC, codec, dict_id, len(body)) + compressed
+
+
+def decode_body_frame(data: bytes, dicts: Optional[ZstdDictionaries] = None) -> bytes:
+    """Decompress a framed body, bodies without frame are plain `lz4.block` with size."""
+    if bytes(data[: len(FRAME_MAGIC)]) != FRAME_MAGIC:
+        return lz4.decompress(data)
+
+    _, codec, dict_id, raw_size = FRAME_HEADER.unpack_from(data)
+    return decompress_body(
+        memoryview(data)[FRAME_HEADER.size :],
+        BodyCodec(codec),
+        raw_size,
+        dict_id,
+        dicts,
+    )
+
+
+def sample_bodies(bodies: Sequence[bytes], max_total_size: int) -> List[bytes]:
+    """Take bodies until `max_total_size` bytes, zstd trains on at most a few MB."""
+    samples: List[bytes] = []
+    total: int = 0
+    for body in bodies:
+        if total + len(body) > max_total_size:
+            break
+        samples.append(body)
+        total += len(body)
+
+    return samples
@@ -0,0 +1,285 @@
+"""dedup.py.
+
+Content-addressed body storage for the Redis HTTP cache
+
+Bodies are stored once in `{http_cache_key}:bodies`, keyed by the digest of the
+uncompressed body, and reference counted in `{http_cache_key}:body-refs`. Url entries
+are `CacheRecord`s with `FLAG_BODY_REF`, that hold the digest instead of the body.
+
+Lua scripts keep the url entry, date index and reference counts consistent. Every
+write of a url entry goes through them, also of inline entries, since overwriting a
+body reference with a plain HSET would leak its reference count.
+Re-storing an unchanged page only rewrites its metadata: the body is not compressed
+or sent when this process recently stored the digest
+"""
+import logging
+from typing import Final, Iterable, List, Optional, Tuple
+
+import redis
+from pydantic import BaseModel
+from scrapy.http import Response  # type: ignore[import]
+
+from ..core.settings import (HTTP_CACHE_BODIES_KEY_FORMAT,
+                             HTTP_CACHE_BODY_DIGEST_SIZE,
+                             HTTP_CACHE_BODY_REFS_KEY_FORMAT,
+                             HTTP_CACHE_KNOWN_DIGESTS_MAXSIZE,
+                             HTTP_CACHE_PUT_CHUNK_SIZE)
+from ..utils.lru import LRUCache
+from .codecs import BodyCodec, ZstdDictionaries, body_digest, encode_body_frame
+from .items import make_cache_item
+from .record import FLAG_BODY_REF, MAGIC, CacheRecord
+
+logger = logging.getLogger(__name__)
+
+# returns of the save script
+SAVE_UNCHANGED: Final[int] = 0
+SAVE_STORED: Final[int] = 1
+SAVE_NEED_BODY: Final[int] = -1
+
+# digest of the body that an existing url entry references, if any.
+# flags are the little-endian uint16 at byte 7 (1-based) of the record header
+_BODY_REF_LUA: Final[
+    str
+] = f"""
+local function body_ref(rec)
+    if rec and string.sub(rec, 1, 4) == '{MAGIC.decode()}'
+        and string.byte(rec, 5) >= 2
+        and string.byte(rec, 7) % 2 == {FLAG_BODY_REF} then
+        return string.sub(rec, -{HTTP_CACHE_BODY_DIGEST_SIZE})
+    end
+    return false
+end
+
+local function release(digest)
+    if redis.call('HINCRBY', KEYS[4], digest, -1) <= 0 then
+        redis.call('HDEL', KEYS[4], digest)
+        redis.call('HDEL', KEYS[3], digest)
+    end
+end
+"""
+
+# KEYS: cache, dates, bodies, refs. ARGV: url, record, time, digest, body frame or ''
+SAVE_SCRIPT: Final[str] = (
+    _BODY_REF_LUA
+    + f"""
+local old = body_ref(redis.call('HGET', KEYS[1], ARGV[1]))
+local digest = ARGV[4]
+local res = {SAVE_UNCHANGED}
+if old ~= digest then
+    if redis.call('HEXISTS', KEYS[3], digest) == 0 then
+        if ARGV[5] == '' then
+            return {SAVE_NEED_BODY}
+        end
+        redis.call('HSET', KEYS[3], digest, ARGV[5])
+    end
+    redis.call('HINCRBY', KEYS[4], digest, 1)
+    if old then
+        release(old)
+    end
+    res = {SAVE_STORED}
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return res
+"""
+)
+
+# KEYS: cache, dates, bodies, refs. ARGV: url, entry, time, per entry. An empty time
+# leaves the date index alone. Entries are written as they are, body references included
+PUT_SCRIPT: Final[str] = (
+    _BODY_REF_LUA
+    + """
+for i = 1, #ARGV, 3 do
+    local url = ARGV[i]
+    local old = body_ref(redis.call('HGET', KEYS[1], url))
+    local new = body_ref(ARGV[i + 1])
+    redis.call('HSET', KEYS[1], url, ARGV[i + 1])
+    if ARGV[i + 2] ~= '' then
+        redis.call('ZADD', KEYS[2], ARGV[i + 2], url)
+    end
+    if old ~= new then
+        if new then
+            redis.call('HINCRBY', KEYS[4], new, 1)
+        end
+        if old then
+            release(old)
+        end
+    end
+end
+return #ARGV / 3
+"""
+)
+
+# KEYS: cache, dates, bodies, refs. ARGV: urls
+DELETE_SCRIPT: Final[str] = (
+    _BODY_REF_LUA
+    + """
+local n = 0
+for _, url in ipairs(ARGV) do
+    local rec = redis.call('HGET', KEYS[1], url)
+    if rec then
+        local digest = body_ref(rec)
+        redis.call('HDEL', KEYS[1], url)
+        if digest then
+            release(digest)
+        end
+        n = n + 1
+    end
+    redis.call('ZREM', KEYS[2], url)
+end
+return n
+"""
+)
+
+
+def dedup_keys(http_cache_key: str, http_date_key: str) -> List[str]:
+    return [
+        http_cache_key,
+        http_date_key,
+        HTTP_CACHE_BODIES_KEY_FORMAT.format(http_cache_key=http_cache_key),
+        HTTP_CACHE_BODY_REFS_KEY_FORMAT.format(http_cache_key=http_cache_key),
+    ]
+
+
+# url, encoded entry, and its date index score or None
+CacheEntry = Tuple[str | bytes, bytes, Optional[float]]
+
+
+def queue_cache_entries_redis(
+    pipe: redis.client.Pipeline,
+    http_cache_key: str,
+    http_date_key: str,
+    entries: Iterable[CacheEntry],
+    chunk_size: int = HTTP_CACHE_PUT_CHUNK_SIZE,
+) -> int:
+    """Queue writes of encoded entries on a pipeline, with one script call per chunk.
+
+    Shared bodies that the entries replace are released, returns the number of entries
+    """
+    assert chunk_size > 0, f"{chunk_size=}"
+    put = pipe.register_script(PUT_SCRIPT)
+    keys: List[str] = dedup_keys(http_cache_key, http_date_key)
+    n: int = 0
+    args: List[str | bytes | float] = []
+    for url, data, time in entries:
+        args += [url, data, "" if time is None else time]
+        n += 1
+        if len(args) >= 3 * chunk_size:
+            put(keys=keys, args=args)
+            args = []
+
+    if args:
+        put(keys=keys, args=args)
+
+    return n
+
+
+def save_cache_records_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    records: Iterable[CacheRecord],
+) -> int:
+    """Save encoded records as they are, in one MULTI/EXEC round trip."""
+    entries: List[Tuple[str, bytes, float]] = [
+        (record.url, record.to_bytes(), record.time) for record in records
+    ]
+    if not entries:
+        return 0
+
+    with client.pipeline(transaction=True) as pipe:
+        n: int = queue_cache_entries_redis(pipe, http_cache_key, http_date_key, entries)
+        pipe.execute()
+
+    return n
+
+
+class DedupResult(BaseModel):
+    # url entries that reference a new body
+    nstored: int = 0
+    # url entries of which only the metadata changed
+    nunchanged: int = 0
+
+
+# digests this process stored recently, so their bodies are not compressed and sent again
+_known_digests = LRUCache(HTTP_CACHE_KNOWN_DIGESTS_MAXSIZE)
+
+
+def save_responses_dedup_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    responses: Iterable[Response],
+    codec: BodyCodec = BodyCodec.lz4,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> DedupResult:
+    """Save responses with deduplicated bodies, in one MULTI/EXEC round trip.
+
+    Bodies that turn out to be missing, e.g. after eviction, are sent in a second round trip
+    """
+    keys: List[str] = dedup_keys(http_cache_key, http_date_key)
+    save = client.register_script(SAVE_SCRIPT)
+    res = DedupResult()
+
+    # (record, time, digest, body, url)
+    entries: List[Tuple[bytes, float, bytes, bytes, str]] = []
+    for response in responses:
+        cache_item = make_cache_item(response)
+        digest: bytes = body_digest(cache_item.body)
+        record: bytes = CacheRecord.encode_ref(
+            cache_item.status,
+            cache_item.url,
+            cache_item.headers,
+            digest,
+            len(cache_item.body),
+            cache_item.time,
+        )
+        entries.append(
+            (record, cache_item.time, digest, cache_item.body, cache_item.url)
+        )
+
+    def _execute(batch: List[Tuple[bytes, float, bytes, bytes, str]], send_body: bool):
+        with client.pipeline(transaction=True) as pipe:
+            for record, time, digest, body, url in batch:
+                frame: bytes = b""
+                if send_body or digest not in _known_digests:
+                    frame = encode_body_frame(body, url, codec, dicts)
+                save(keys=keys, args=[url, record, time, digest, frame], client=pipe)
+
+            return pipe.execute()
+
+    if not entries:
+        return res
+
+    retry: List[Tuple[bytes, float, bytes, bytes, str]] = []
+    for entry, status in zip(entries, _execute(entries, send_body=False)):
+        if status == SAVE_NEED_BODY:
+            retry.append(entry)
+            continue
+        _known_digests.set(entry[2], True)
+        if status == SAVE_UNCHANGED:
+            res.nunchanged += 1
+        else:
+            res.nstored += 1
+
+    if retry:
+        logger.debug(f"sending {len(retry):,} evicted bodies again")
+        for entry, status in zip(retry, _execute(retry, send_body=True)):
+            _known_digests.set(entry[2], True)
+            res.nstored += 1
+
+    return res
+
+
+def delete_cache_entries_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    urls: List[str],
+) -> int:
+    """Delete url entries and their date index, and release their shared bodies."""
+    if not urls:
+        return 0
+
+    delete = client.register_script(DELETE_SCRIPT)
+    return delete(keys=dedup_keys(http_cache_key, http_date_key), args=urls)
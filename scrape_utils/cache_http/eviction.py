@@ -0,0 +1,377 @@
+"""eviction.py.
+
+Size- and age-bounded eviction of the HTTP cache
+
+Entries are evicted oldest first, by the `http_date_key` zset in redis and by `time`
+in postgres, in small batches, so neither is blocked for long. Redis entries that
+are missing from the date zset, e.g. copied by `move_cache`, are never evicted
+"""
+import logging
+import math
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import redis
+from pydantic import BaseModel
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..core.db import loop_async_session
+from ..core.settings import (HTTP_CACHE_BODIES_KEY_FORMAT,
+                             HTTP_CACHE_EVICT_BATCH_SIZE,
+                             HTTP_CACHE_EVICT_INTERVAL,
+                             HTTP_CACHE_EVICT_MEMORY_SAMPLES)
+from ..models.cache import HttpCacheBody, HttpCacheItem
+from ..models.cache.crud import CacheCRUD
+from .dedup import delete_cache_entries_redis
+from .tiered import CacheTier
+
+logger = logging.getLogger(__name__)
+
+
+class EvictionPolicy(BaseModel):
+    """Limits of the http cache, None is unbounded."""
+
+    max_entries: Optional[int] = None
+    # bytes, estimated with MEMORY USAGE in redis, and stored sizes in postgres
+    max_bytes: Optional[int] = None
+    # seconds since the entry was cached
+    max_age: Optional[float] = None
+
+
+class EvictionResult(BaseModel):
+    # evicted for `max_age`
+    nexpired: int = 0
+    # evicted for `max_entries`
+    noverflow: int = 0
+    # evicted for `max_bytes`
+    noversize: int = 0
+
+    @property
+    def nevicted(self) -> int:
+        return self.nexpired + self.noverflow + self.noversize
+
+
+def _now() -> float:
+    # same clock as the `time` of cache items
+    return datetime.utcnow().timestamp()
+
+
+def evict_oldest_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    n: int,
+    batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+) -> int:
+    """Evict the `n` oldest entries, one HDEL/ZREM round trip per batch."""
+    nevicted: int = 0
+    while nevicted < n:
+        urls: List[bytes] = client.zrange(
+            http_date_key, 0, min(batch_size, n - nevicted) - 1
+        )
+        if not urls:
+            break
+        nevicted += delete_cache_entries_redis(
+            client, http_cache_key, http_date_key, urls
+        )
+
+    return nevicted
+
+
+def expire_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    max_age: float,
+    batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+) -> int:
+    """Evict entries older than `max_age` seconds."""
+    cutoff: float = _now() - max_age
+    nevicted: int = 0
+    while urls := client.zrangebyscore(
+        http_date_key, "-inf", cutoff, start=0, num=batch_size
+    ):
+        nevicted += delete_cache_entries_redis(
+            client, http_cache_key, http_date_key, urls
+        )
+
+    return nevicted
+
+
+def redis_cache_bytes(
+    client: redis.StrictRedis, http_cache_key: str, http_date_key: str
+) -> int:
+    """Estimate the memory use of the cache hset, date zset and shared bodies."""
+    keys: List[str] = [
+        http_cache_key,
+        http_date_key,
+        HTTP_CACHE_BODIES_KEY_FORMAT.format(http_cache_key=http_cache_key),
+    ]
+    return sum(
+        client.memory_usage(key, samples=HTTP_CACHE_EVICT_MEMORY_SAMPLES) or 0
+        for key in keys
+    )
+
+
+def shrink_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    max_bytes: int,
+    batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+) -> int:
+    """Evict the oldest entries until the cache fits in `max_bytes`.
+
+    Evicts about the excess at the average entry size, measuring again after every
+    batch. Shared bodies are only freed with their last reference, so evictions can
+    free less than measured: one call evicts at most the first estimate of the excess,
+    and stops when a batch frees nothing
+    """
+    nevicted: int = 0
+    nmax: Optional[int] = None
+    last_nbytes: Optional[int] = None
+    while nmax is None or nevicted < nmax:
+        nbytes: int = redis_cache_bytes(client, http_cache_key, http_date_key)
+        nentry: int = client.zcard(http_date_key)
+        if nbytes <= max_bytes or nentry == 0:
+            break
+        if last_nbytes is not None and nbytes >= last_nbytes:
+            logger.warning(f"evictions from `{http_cache_key}` free no memory")
+            break
+        last_nbytes = nbytes
+
+        nexcess: int = math.ceil((nbytes - max_bytes) / (nbytes / nentry))
+        if nmax is None:
+            nmax = nexcess
+        nevicted += evict_oldest_redis(
+            client,
+            http_cache_key,
+            http_date_key,
+            min(nexcess, nmax - nevicted, batch_size),
+            batch_size,
+        )
+
+    return nevicted
+
+
+def evict_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    policy: EvictionPolicy,
+    batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+) -> EvictionResult:
+    """Enforce `policy` on the redis http cache, by age, count and bytes in that order."""
+    res = EvictionResult()
+    args = (client, http_cache_key, http_date_key)
+    if policy.max_age is not None:
+        res.nexpired = expire_redis(*args, policy.max_age, batch_size)
+
+    if policy.max_entries is not None:
+        nexcess: int = client.zcard(http_date_key) - policy.max_entries
+        if nexcess > 0:
+            res.noverflow = evict_oldest_redis(*args, nexcess, batch_size)
+
+    if policy.max_bytes is not None:
+        res.noversize = shrink_redis(*args, policy.max_bytes, batch_size)
+
+    if res.nevicted:
+        logger.info(f"evicted from `{http_cache_key}`: {res}")
+    return res
+
+
+def _pg_inline_size():
+    """Stored size of a cache item, without its deduplicated body."""
+    table = HttpCacheItem.__table__
+    return func.octet_length(table.c.body) + func.coalesce(
+        func.octet_length(table.c.headers), 0
+    )
+
+
+async def pg_cache_bytes(session: AsyncSession) -> int:
+    """Stored size of the pg http cache, scans the table."""
+    table = HttpCacheItem.__table__
+    bodies = HttpCacheBody.__table__
+    items_size: Optional[int] = await session.scalar(
+        select(
+            func.sum(
+                func.octet_length(table.c.body)
+                + func.coalesce(func.octet_length(table.c.headers), 0)
+            )
+        )
+    )
+    bodies_size: Optional[int] = await session.scalar(
+        select(func.sum(func.octet_length(bodies.c.body)))
+    )
+    return int(items_size or 0) + int(bodies_size or 0)
+
+
+async def evict_pg(
+    session: AsyncSession,
+    policy: EvictionPolicy,
+    batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+) -> EvictionResult:
+    """Enforce `policy` on `http_cache_items`, one DELETE and commit per batch."""
+    crud = CacheCRUD(session)
+    table = HttpCacheItem.__table__
+    id_col = crud.meta.id_col
+    res = EvictionResult()
+
+    async def _oldest(limit: int, *where) -> List:
+        result = await session.execute(
+            select(id_col).where(*where).order_by(table.c.time).limit(limit)
+        )
+        return result.scalars().all()
+
+    if policy.max_age is not None:
+        cutoff: float = _now() - policy.max_age
+        while ids := await _oldest(batch_size, table.c.time < cutoff):
+            res.nexpired += await crud.delete_many(ids)
+
+    if policy.max_entries is not None:
+        nexcess: int = (
+            await session.scalar(select(func.count()).select_from(table))
+            - policy.max_entries
+        )
+        while nexcess > 0 and (ids := await _oldest(min(batch_size, nexcess))):
+            n: int = await crud.delete_many(ids)
+            res.noverflow += n
+            nexcess -= n
+
+    if policy.max_bytes is not None:
+        bodies = HttpCacheBody.__table__
+        nexcess = await pg_cache_bytes(session) - policy.max_bytes
+        while nexcess > 0:
+            result = await session.execute(
+                select(
+                    id_col,
+                    _pg_inline_size(),
+                    bodies.c.digest,
+                    bodies.c.nref,
+                    func.octet_length(bodies.c.body),
+                )
+                .select_from(
+                    table.outerjoin(
+                        bodies,
+                        (bodies.c.digest == table.c.body_digest)
+                        & (func.octet_length(table.c.body) == 0),
+                    )
+                )
+                .order_by(table.c.time)
+                .limit(batch_size)
+            )
+            ids = []
+            # a shared body is only freed when the batch holds all of its references
+            nrefs: Dict[str, int] = Counter()
+            for model_id, size, digest, nref, body_size in result.all():
+                ids.append(model_id)
+                nexcess -= int(size)
+                if digest is not None:
+                    nrefs[digest] += 1
+                    if nrefs[digest] == nref:
+                        nexcess -= int(body_size)
+                if nexcess <= 0:
+                    break
+            if not ids:
+                break
+            res.noversize += await crud.delete_many(ids)
+
+    if res.nevicted:
+        logger.info(f"evicted from `{table.name}`: {res}")
+    return res
+
+
+class CacheEvictor:
+    """Enforce an eviction policy on the redis and postgres http cache periodically.
+
+    Runs in a background thread, with its own event loop and engine for postgres.
+    Tiers without a client are skipped
+
+    Usage:
+        policy = EvictionPolicy(max_entries=1_000_000, max_age=30 * 86400)
+        with CacheEvictor(policy, client, http_cache_key, http_date_key):
+            process.start()
+    """
+
+    def __init__(
+        self,
+        policy: EvictionPolicy,
+        client: Optional[redis.StrictRedis] = None,
+        http_cache_key: Optional[str] = None,
+        http_date_key: Optional[str] = None,
+        async_connection_str: Optional[str] = None,
+        interval: float = HTTP_CACHE_EVICT_INTERVAL,
+        batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+    ) -> None:
+        assert client is None or (
+            http_cache_key and http_date_key
+        ), "redis tier needs `http_cache_key` and `http_date_key`"
+        assert interval > 0, f"{interval=}"
+        self.policy: EvictionPolicy = policy
+        self.client: Optional[redis.StrictRedis] = client
+        self.http_cache_key: Optional[str] = http_cache_key
+        self.http_date_key: Optional[str] = http_date_key
+        self.async_connection_str: Optional[str] = async_connection_str
+        self.interval: float = interval
+        self.batch_size: int = batch_size
+
+        self.nrun: int = 0
+        self.results: Dict[CacheTier, EvictionResult] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=self.__class__.__name__, daemon=True
+        )
+
+    def __enter__(self) -> "CacheEvictor":
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run_once(self, loop, async_session: Optional[sessionmaker]) -> None:
+        if self.client is not None:
+            self.results[CacheTier.redis] = evict_redis(
+                self.client,
+                self.http_cache_key,
+                self.http_date_key,
+                self.policy,
+                self.batch_size,
+            )
+
+        if async_session is not None:
+
+            async def inner() -> EvictionResult:
+                async with async_session() as session:
+                    return await evict_pg(session, self.policy, self.batch_size)
+
+            self.results[CacheTier.pg] = loop.run_until_complete(inner())
+
+        self.nrun += 1
+
+    def _run(self) -> None:
+        try:
+            with loop_async_session(
+                self.async_connection_str, pool_size=1, max_overflow=0
+            ) as (loop, async_session):
+                while True:
+                    try:
+                        self._run_once(loop, async_session)
+                    except Exception as e:
+                        logger.exception("cannot evict http cache")
+                    if self._stop.wait(self.interval):
+                        break
+        except Exception as e:
+            logger.exception(f"{self.__class__.__name__} stopped")
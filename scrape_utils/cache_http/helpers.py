@@ -3,14 +3,13 @@
 Helper methods for Redis HTTP cache implementation
 """
 import logging
-import pickle
 from datetime import datetime
 from pathlib import Path
-from random import sample
 from time import time
-from typing import Final, List, Optional
+from typing import Dict, Final, Iterable, List, Optional, Tuple
 
 import lz4.block as lz4  # type: ignore[import]
+import numpy as np
 import redis
 from scrapy.http import Response  # type: ignore[import]
 from sqlmodel import select
@@ -18,15 +17,32 @@ from sqlmodel.ext.asyncio.session import AsyncSession
 from yapic import json  # type: ignore[import]
 
 from ..core.db import get_async_session
+from ..core.settings import (HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+                             HTTP_CACHE_EVICT_BATCH_SIZE,
+                             REDIS_PUSH_CHUNK_SIZE)
 from ..models.cache import HttpCacheItem
 from ..models.cache.crud import CacheCRUD
-from ..models.redis import SitemapRecord
+from ..models.redis import RecordFormat, SitemapBatch, SitemapRecord
 from ..utils import get_create_event_loop
+from .codecs import BodyCodec, ZstdDictionaries
+# also re-exports the record helpers that moved to `items` and `dedup`
+from .dedup import queue_cache_entries_redis, save_cache_records_redis
+from .eviction import evict_oldest_redis
+from .items import (_decompress_legacy, compress_response,
+                    load_cache_records_pg, load_cache_records_redis,
+                    load_response_body_pg, make_cache_item, read_cache_record,
+                    record_to_cache_item, resolve_body_refs_redis)
+from .migrate import migrate_cache
+from .record import CacheRecord, is_cache_record
+from .scan import iter_cache_items_redis, iter_cache_urls_redis
 
 logger = logging.getLogger(__name__)
 
 loop = get_create_event_loop()
 
+# RPUSH commands per pipeline round trip, when populating start urls
+START_URLS_PIPELINE_SIZE: Final[int] = 10
+
 
 def save_response_to_file(response: Response, data_dir: str) -> None:
     page_path = Path(data_dir) / "page.html"
@@ -35,21 +51,6 @@ def save_response_to_file(response: Response, data_dir: str) -> None:
         html_file.write(response.body)
 
 
-def make_cache_item(response: Response) -> HttpCacheItem:
-    # TODO: implement as HttpCacheItem.from_json
-    time: Final[float] = datetime.utcnow().timestamp()
-
-    data = {
-        "status": response.status,
-        "url": response.url,
-        "headers": dict(response.headers),
-        "body": response.body,
-        "time": time,
-    }
-
-    return HttpCacheItem(**data)
-
-
 def save_compressed_response_pg(response: Response, async_connection_str: str) -> None:
     """Save / upsert compressed http response to postgres."""
     # using CRUD is safest
@@ -66,25 +67,106 @@ def save_compressed_response_pg(response: Response, async_connection_str: str) -
     loop.run_until_complete(inner())
 
 
+def save_compressed_responses_pg(
+    responses: Iterable[Response],
+    async_connection_str: str,
+    codec: Optional[BodyCodec] = None,
+    dicts: Optional[ZstdDictionaries] = None,
+    dedup_bodies: bool = False,
+) -> int:
+    """Save / upsert compressed http responses to postgres, with one upsert per chunk.
+
+    With `dedup_bodies`, items are upserted one by one, see `CacheCRUD.upsert`
+    """
+    cache_items: List[HttpCacheItem] = [
+        HttpCacheItem.from_response(response, codec, dicts) for response in responses
+    ]
+    if not cache_items:
+        return 0
+
+    async def inner() -> None:
+        async_session: AsyncSession = get_async_session(async_connection_str)
+        async with async_session() as session:
+            cache_crud = CacheCRUD(session, dedup_bodies=dedup_bodies, dicts=dicts)
+            if not dedup_bodies:
+                await cache_crud.upsert_many(cache_items)
+                return
+
+            for cache_item in cache_items:
+                await cache_crud.upsert(cache_item)
+
+    loop.run_until_complete(inner())
+    return len(cache_items)
+
+
+def queue_compressed_response_redis(
+    pipe: redis.client.Pipeline,
+    http_cache_key: str,
+    http_date_key: str,
+    response: Response,
+    codec: BodyCodec = BodyCodec.lz4,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> None:
+    """Queue the cache entry and date index writes of `response` on a pipeline."""
+    cache_item: HttpCacheItem = make_cache_item(response)
+    compr_response: bytes = compress_response(cache_item, codec, dicts)
+
+    queue_cache_entries_redis(
+        pipe,
+        http_cache_key,
+        http_date_key,
+        [(cache_item.url, compr_response, cache_item.time)],
+    )
+
+
+def save_compressed_responses_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    responses: Iterable[Response],
+    codec: BodyCodec = BodyCodec.lz4,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> int:
+    """Save compressed http responses to redis hset, in one MULTI/EXEC round trip.
+
+    The cache hset and date zset are updated atomically, so they never drift apart
+    """
+    entries: List[Tuple[str, bytes, float]] = []
+    for response in responses:
+        cache_item: HttpCacheItem = make_cache_item(response)
+        entries.append(
+            (
+                cache_item.url,
+                compress_response(cache_item, codec, dicts),
+                cache_item.time,
+            )
+        )
+
+    if not entries:
+        return 0
+
+    with client.pipeline(transaction=True) as pipe:
+        n: int = queue_cache_entries_redis(pipe, http_cache_key, http_date_key, entries)
+        pipe.execute()
+
+    return n
+
+
 def save_compressed_response_redis(
     client: redis.StrictRedis,
     http_cache_key: str,
     http_date_key: str,
     response: Response,
+    codec: BodyCodec = BodyCodec.lz4,
+    dicts: Optional[ZstdDictionaries] = None,
 ) -> None:
     """Save compressed http response to redis hset."""
-    # TODO: optionally saving multiple strings as block saves more data
-    # similar to what you did with Rarc
-
     # TODO: use composite hash? url + scrape date for instance
-    url: Final[str] = response.url
-
-    cache_item: HttpCacheItem = make_cache_item(response)
-    compr_response: bytes = compress_response(cache_item)
 
     # always save cache and timestamp together
-    client.hset(http_cache_key, response.url, compr_response)
-    client.zadd(http_date_key, {url: time})
+    save_compressed_responses_redis(
+        client, http_cache_key, http_date_key, [response], codec, dicts
+    )
 
 
 def move_cache(
@@ -93,68 +175,97 @@ def move_cache(
     http_cache_key: str,
     n: int = -1,
     random: bool = True,
-) -> None:
+    http_date_key: Optional[str] = None,
+) -> int:
     """Move cache to another redis database.
 
     So the scraper can run in test move from this cache,
     and user can verify if everything works correctly,
     without affecting production database
 
+    Copies `n` random entries, or all entries with `n=-1`, in chunks.
+    See `migrate.migrate_cache` for resuming and re-encoding. Returns the number copied
+
     Example usage:
-        from scrape_utils.cache.helpers import move_cache, populate_start_urls_from_redis_cache
+        from scrape_utils.cache_http.helpers import move_cache, populate_start_urls_from_redis_cache
         import redis
         from scrape_utils import settings
         client_from = redis.from_url(settings.redis_url)
         new_url = settings.redis_url[:-1] + '5'
         client_to =redis.from_url(new_url)
-        # move_cache(client_from, client_to, n=100, random=True)
+        # move_cache(client_from, client_to, http_cache_key, n=100, random=True)
 
         # later
-        populate_start_urls_from_redis_cache(client_to)
+        populate_start_urls_from_redis_cache(client_to, http_cache_key, start_urls_key)
     """
-    all_keys: List[str] = client_from.hkeys(http_cache_key)
-
-    assert n < len(all_keys)
-    if random:
-        all_keys = sample(all_keys, n)
+    assert n == -1 or n > 0, f"{n=}"
+    res = migrate_cache(
+        client_from,
+        client_to,
+        http_cache_key,
+        http_date_key,
+        n=None if n == -1 else n,
+        random=random,
+    )
+    logger.info(f"copied {res.ncopied:,} cache_items")
 
-    cache_items = client_from.hmget(http_cache_key, all_keys)
-    logger.info(f"got {len(cache_items):,} cache_items")
-
-    client_to.hmset(http_cache_key, dict(zip(all_keys, cache_items)))
+    return res.ncopied
 
 
 def populate_start_urls_from_redis_cache(
-    client: redis.StrictRedis, http_cache_key: str, start_urls_key: str
-):
-    """Populate start_urls from cache."""
-    all_keys: List[str] = client.hkeys(http_cache_key)
-    data = client.hmget(http_cache_key, all_keys)
-
-    res: List[Optional[HttpCacheItem]] = [decompress_response(item) for item in data]
-    cache_items: List[Optional[HttpCacheItem]] = [
-        item for item in res if item is not None
-    ]
-
-    for cache_item in cache_items:
-        try:
-            item: dict = {"url": cache_item.url}
-        except Exception as e:
-            logger.info(f"{cache_item=}")
-            raise
-
-        client.rpush(start_urls_key, json.dumps(item))
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    start_urls_key: str,
+    http_date_key: Optional[str] = None,
+    min_age: Optional[float] = None,
+    max_age: Optional[float] = None,
+    chunk_size: int = REDIS_PUSH_CHUNK_SIZE,
+) -> int:
+    """Populate start_urls from cache.
+
+    Urls are the hash fields, so no cache entry is read. With `http_date_key`,
+    urls come from the date zset and can be filtered on cache age, see
+    `scan.iter_cache_urls_redis`. Urls are pushed with one multi-value RPUSH per chunk,
+    pipelined. Returns the number of urls pushed
+    """
+    n: int = 0
+    with client.pipeline(transaction=False) as pipe:
+        for urls in iter_cache_urls_redis(
+            client, http_cache_key, http_date_key, min_age, max_age, chunk_size
+        ):
+            pipe.rpush(
+                start_urls_key,
+                *[
+                    json.dumps({"url": url.decode() if isinstance(url, bytes) else url})
+                    for url in urls
+                ],
+            )
+            n += len(urls)
+            if len(pipe) >= START_URLS_PIPELINE_SIZE:
+                pipe.execute()
+
+        pipe.execute()
+
+    logger.info(f"pushed {n:,} urls to `{start_urls_key}`")
+    return n
 
 
 def get_start_urls_from_pg_cache(
-    session, limit: Optional[int] = None
-) -> List[SitemapRecord]:
+    session,
+    limit: Optional[int] = None,
+    record_format: RecordFormat = RecordFormat.pydantic,
+) -> List[SitemapRecord] | SitemapBatch:
     """Get start urls from postgres cache."""
     query = select(HttpCacheItem.url)
     if limit is not None:
         query = query.limit(limit)
 
     res = session.execute(query).scalars()
+    if record_format == RecordFormat.batch:
+        urls: List[str] = res.fetchall()
+        lastmod = np.full(len(urls), int(time()), dtype=np.int64)
+        return SitemapBatch(np.array(urls, dtype=object), lastmod)
+
     now = datetime.utcnow()
     # return list(res.fetchall())
     return [SitemapRecord(lastmod=now, url=i) for i in res.fetchall()]
@@ -164,47 +275,59 @@ def _compress(item):
     return lz4.compress(item)
 
 
-def compress_response(cache_item: HttpCacheItem) -> bytes:
-    return _compress(pickle.dumps(cache_item, protocol=4))
+def decompress_response(
+    compr_response: bytes,
+    allow_pickle: bool = HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> HttpCacheItem:
+    """Decode a cache entry, body references must be resolved, see `load_cache_records_redis`."""
+    if not is_cache_record(compr_response):
+        return _decompress_legacy(compr_response, allow_pickle)
 
-
-def decompress_response(compr_response: bytes) -> HttpCacheItem:
-    item: HttpCacheItem | dict = pickle.loads(lz4.decompress(compr_response))
-    # TODO: old api still holds plain dictionaries, support both for now
-    # remove this later
-    if isinstance(item, dict):
-        if "time" not in item:
-            item["time"] = time() - 86400
-        return HttpCacheItem(**item)
-    return item
+    return record_to_cache_item(CacheRecord(compr_response, dicts))
 
 
 # settings.redis_http_cache_key
 def load_compressed_responses_redis(
-    client: redis.StrictRedis, http_cache_key: str, url: Optional[str]
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    url: Optional[str],
+    dicts: Optional[ZstdDictionaries] = None,
 ) -> List[HttpCacheItem]:
     """Load compressed responses.
 
-    If `url` is passed, fetches for one url, if `url` is None, fetches all items
+    If `url` is passed, fetches for one url, if `url` is None, fetches all items.
+    To iterate large caches, use `scan.iter_cache_items_redis`
     """
-    keys: List[str] = []
     if url is None:
-        keys = client.hkeys(http_cache_key)
-    else:
-        keys = [url]
+        return list(
+            iter_cache_items_redis(client, http_cache_key, processes=0, dicts=dicts)
+        )
 
-    res = client.hmget(http_cache_key, keys)
+    res = client.hmget(http_cache_key, [url])
     # cache_items: List[bytes] =
 
-    cache_items: List[Optional[HttpCacheItem]] = [
-        item for item in res if item is not None
-    ]
+    cache_items: List[bytes] = [item for item in res if item is not None]
+    records: Dict[int, CacheRecord] = {
+        i: CacheRecord(item, dicts)
+        for i, item in enumerate(cache_items)
+        if is_cache_record(item)
+    }
+    resolve_body_refs_redis(client, http_cache_key, list(records.values()))
 
-    return [decompress_response(compr_response) for compr_response in cache_items]
+    return [
+        record_to_cache_item(records[i])
+        if i in records
+        else _decompress_legacy(compr_response)
+        for i, compr_response in enumerate(cache_items)
+    ]
 
 
 def load_compressed_response_redis(
-    client: redis.StrictRedis, http_cache_key: str, url: str
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    url: str,
+    dicts: Optional[ZstdDictionaries] = None,
 ) -> Optional[HttpCacheItem]:
     """Load compressed http response from redis hset by url."""
     # TODO: optionally saving multiple strings as block saves more data
@@ -215,7 +338,9 @@ def load_compressed_response_redis(
 
     # compr_response: Optional[bytes] = client.hget(key, url)
 
-    compr_responses = load_compressed_responses_redis(client, http_cache_key, url=url)
+    compr_responses = load_compressed_responses_redis(
+        client, http_cache_key, url=url, dicts=dicts
+    )
     # logger.error(f"{compr_responses=}")
 
     if len(compr_responses) != 1 or compr_responses[0] is None:
@@ -254,10 +379,17 @@ def load_compressed_response_pg(session, url: str) -> Optional[HttpCacheItem]:
     return None
 
 
-def delete_oldest_cache():
+def delete_oldest_cache(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: str,
+    n: int,
+    batch_size: int = HTTP_CACHE_EVICT_BATCH_SIZE,
+) -> int:
     """Delete oldest cache.
 
-    Delete oldest N rows from cache. First request urls, then delete
+    Delete oldest N rows from cache. First request urls, then delete, in batches.
+    See `eviction.py` for count, size and age limits
     """
-    # TODO: add test for this method
-    raise NotImplementedError
+    assert n >= 0, f"{n=}"
+    return evict_oldest_redis(client, http_cache_key, http_date_key, n, batch_size)
@@ -0,0 +1,179 @@
+"""items.py.
+
+Conversion between responses, cache items and `CacheRecord`s, and record loading
+
+The other cache modules build on these, so this module only imports codecs and records
+"""
+import logging
+import pickle
+from datetime import datetime
+from time import time
+from typing import Dict, Final, List, Optional
+
+import lz4.block as lz4  # type: ignore[import]
+import redis
+from scrapy.http import Response  # type: ignore[import]
+from sqlmodel import select
+
+from ..core.settings import (HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+                             HTTP_CACHE_BODIES_KEY_FORMAT)
+from ..models.cache import HttpCacheBody, HttpCacheItem
+from .codecs import BodyCodec, ZstdDictionaries, decode_body_frame
+from .record import CacheRecord, is_cache_record
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_item(response: Response) -> HttpCacheItem:
+    # TODO: implement as HttpCacheItem.from_json
+    time: Final[float] = datetime.utcnow().timestamp()
+
+    data = {
+        "status": response.status,
+        "url": response.url,
+        "headers": response.headers.to_string(),
+        "body": response.body,
+        "time": time,
+    }
+
+    return HttpCacheItem(**data)
+
+
+def compress_response(
+    cache_item: HttpCacheItem,
+    codec: BodyCodec = BodyCodec.lz4,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> bytes:
+    """Encode a cache item as binary `CacheRecord`, only the body is compressed."""
+    return CacheRecord.encode(
+        cache_item.status,
+        cache_item.url,
+        cache_item.headers,
+        cache_item.body,
+        cache_item.time,
+        codec=codec,
+        dicts=dicts,
+    )
+
+
+def _decompress_legacy(
+    compr_response: bytes, allow_pickle: bool = HTTP_CACHE_ALLOW_LEGACY_PICKLE
+) -> HttpCacheItem:
+    """Decode entries written before `CacheRecord`, a lz4 compressed pickle."""
+    if not allow_pickle:
+        raise ValueError("legacy pickled cache entry, and unpickling is disabled")
+
+    item: HttpCacheItem | dict = pickle.loads(lz4.decompress(compr_response))
+    # TODO: old api still holds plain dictionaries, support both for now
+    # remove this later
+    if isinstance(item, dict):
+        if "time" not in item:
+            item["time"] = time() - 86400
+        return HttpCacheItem(**item)
+    return item
+
+
+def read_cache_record(
+    compr_response: bytes,
+    allow_pickle: bool = HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> CacheRecord:
+    """Get a `CacheRecord` view of a cache entry, legacy entries are converted."""
+    if is_cache_record(compr_response):
+        return CacheRecord(compr_response, dicts)
+
+    item: HttpCacheItem = _decompress_legacy(compr_response, allow_pickle)
+    return CacheRecord(compress_response(item))
+
+
+def record_to_cache_item(record: CacheRecord) -> HttpCacheItem:
+    return HttpCacheItem(
+        status=record.status,
+        url=record.url,
+        headers=record.raw_headers,
+        body=record.body,
+        time=record.time,
+    )
+
+
+def load_cache_records_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    urls: Optional[List[str]] = None,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> List[CacheRecord]:
+    """Load cache records, bodies are only decompressed on access.
+
+    If `urls` is None, fetches all items
+    """
+    keys: List[str] = client.hkeys(http_cache_key) if urls is None else urls
+    if not keys:
+        return []
+
+    res = client.hmget(http_cache_key, keys)
+    records: List[CacheRecord] = [
+        read_cache_record(item, dicts=dicts) for item in res if item is not None
+    ]
+    return resolve_body_refs_redis(client, http_cache_key, records)
+
+
+def resolve_body_refs_redis(
+    client: redis.StrictRedis, http_cache_key: str, records: List[CacheRecord]
+) -> List[CacheRecord]:
+    """Fetch the shared bodies of body references with one HMGET."""
+    refs: Dict[bytes, List[CacheRecord]] = {}
+    for record in records:
+        if record.is_body_ref:
+            refs.setdefault(record.body_ref, []).append(record)
+
+    if not refs:
+        return records
+
+    bodies_key: str = HTTP_CACHE_BODIES_KEY_FORMAT.format(http_cache_key=http_cache_key)
+    digests: List[bytes] = list(refs)
+    for digest, frame in zip(digests, client.hmget(bodies_key, digests)):
+        if frame is None:
+            logger.warning(f"missing shared body {digest.hex()}")
+            continue
+        for record in refs[digest]:
+            record.resolve_body(frame)
+
+    return records
+
+
+def load_response_body_pg(
+    session, item: HttpCacheItem, dicts: Optional[ZstdDictionaries] = None
+) -> bytes:
+    """Get the decompressed body of a pg cache item, also when it is shared."""
+    if item.body or item.body_digest is None:
+        return item.get_body(dicts)
+
+    query = select(HttpCacheBody.body).where(HttpCacheBody.digest == item.body_digest)
+    return decode_body_frame(session.execute(query).scalar_one(), dicts)
+
+
+def load_cache_records_pg(
+    session,
+    urls: List[str],
+    codec: BodyCodec = BodyCodec.lz4,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> List[CacheRecord]:
+    """Load pg cache items by url, re-encoded as records of `codec`."""
+    if not urls:
+        return []
+
+    query = select(HttpCacheItem).where(HttpCacheItem.url.in_(urls))
+    records: List[CacheRecord] = []
+    for item in session.execute(query).scalars():
+        data: bytes = CacheRecord.encode(
+            item.status,
+            item.url,
+            item.headers,
+            load_response_body_pg(session, item, dicts),
+            item.time,
+            codec=codec,
+            dicts=dicts,
+        )
+        records.append(CacheRecord(data, dicts))
+
+    return records
@@ -0,0 +1,187 @@
+"""migrate.py.
+
+Streaming copy of the Redis HTTP cache to another redis database
+
+Random samples are drawn server-side with HRANDFIELD, full copies walk the hash with
+HSCAN. Entries are copied in chunks with their date zset scores, one pipeline per chunk.
+Full copies can be resumed: the HSCAN cursor is stored in the target database,
+with the chunk it follows. Entries can be re-encoded on the fly, e.g. to zstd
+"""
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import redis
+from pydantic import BaseModel
+
+from ..core.settings import (HTTP_CACHE_MIGRATE_RESUME_KEY_FORMAT,
+                             HTTP_CACHE_SCAN_PAGE_SIZE,
+                             HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY,
+                             HTTP_CACHE_ZSTD_DICTS_KEY)
+from .codecs import BodyCodec, ZstdDictionaries
+from .dedup import queue_cache_entries_redis
+from .items import read_cache_record, resolve_body_refs_redis
+from .record import CacheRecord, is_cache_record
+from .scan import scan_cache_pages_redis
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationResult(BaseModel):
+    ncopied: int = 0
+    # entries that were re-encoded, body references are always re-encoded inline
+    nreencoded: int = 0
+    # entries without a date zset score
+    nunscored: int = 0
+    # HSCAN cursor to resume a full copy from, 0 when it is complete
+    cursor: int = 0
+
+
+def _sample_chunks(
+    client: redis.StrictRedis, http_cache_key: str, n: int, chunk_size: int
+) -> Iterator[Dict[bytes, bytes]]:
+    """Sample `n` distinct entries with HRANDFIELD, fetched with one HMGET per chunk."""
+    fields: List[bytes] = client.hrandfield(http_cache_key, count=n) or []
+    for i in range(0, len(fields), chunk_size):
+        chunk: List[bytes] = fields[i : i + chunk_size]
+        yield {
+            field: data
+            for field, data in zip(chunk, client.hmget(http_cache_key, chunk))
+            if data is not None
+        }
+
+
+def _reencode(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    chunk: Dict[bytes, bytes],
+    codec: Optional[BodyCodec],
+    dicts_from: Optional[ZstdDictionaries],
+    dicts_to: Optional[ZstdDictionaries],
+    res: MigrationResult,
+) -> Dict[bytes, bytes]:
+    """Re-encode entries with `codec`. Without `codec`, only legacy entries and body refs."""
+    todo: Dict[bytes, CacheRecord] = {}
+    for field, data in chunk.items():
+        if codec is not None or not is_cache_record(data):
+            todo[field] = read_cache_record(data, dicts=dicts_from)
+        else:
+            record = CacheRecord(data, dicts_from)
+            if record.is_body_ref:
+                todo[field] = record
+
+    resolve_body_refs_redis(client, http_cache_key, list(todo.values()))
+    for field, record in todo.items():
+        if not record.has_body:
+            del chunk[field]
+            continue
+        chunk[field] = CacheRecord.encode(
+            record.status,
+            record.url,
+            record.raw_headers,
+            record.body,
+            record.time,
+            codec=codec if codec is not None else BodyCodec.lz4,
+            dicts=dicts_to,
+        )
+    res.nreencoded += len(todo)
+
+    return chunk
+
+
+def migrate_cache(
+    client_from: redis.StrictRedis,
+    client_to: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: Optional[str] = None,
+    n: Optional[int] = None,
+    random: bool = True,
+    chunk_size: int = HTTP_CACHE_SCAN_PAGE_SIZE,
+    resume: bool = False,
+    codec: Optional[BodyCodec] = None,
+    dicts_from: Optional[ZstdDictionaries] = None,
+    dicts_to: Optional[ZstdDictionaries] = None,
+) -> MigrationResult:
+    """Copy the http cache to another redis database, under the same keys.
+
+    `n` entries are sampled at random, or the first `n` in scan order with
+    `random=False`. `n=None` copies everything, and with `resume` continues an earlier
+    copy that was interrupted, only full copies store a resume cursor.
+    Date zset scores are copied along with `http_date_key`.
+
+    Without `codec`, entries are copied as they are, with the zstd dictionaries they
+    reference. Shared bodies are not copied, body references are re-encoded inline
+
+    Usage:
+        migrate_cache(client_from, client_to, "http_cache", "http_cache_dates", n=1_000)
+        migrate_cache(client_from, client_to, "http_cache", "http_cache_dates", resume=True)
+    """
+    assert n is None or n > 0, f"{n=}"
+    assert chunk_size > 0, f"{chunk_size=}"
+    sampled: bool = n is not None and random
+    assert not (resume and n is not None), "only full copies can be resumed"
+    resume_key: str = HTTP_CACHE_MIGRATE_RESUME_KEY_FORMAT.format(
+        http_cache_key=http_cache_key
+    )
+    res = MigrationResult()
+
+    if codec is None:
+        for key in (HTTP_CACHE_ZSTD_DICTS_KEY, HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY):
+            mapping: Dict[bytes, bytes] = client_from.hgetall(key)
+            if mapping:
+                client_to.hset(key, mapping=mapping)
+
+    # next HSCAN cursor, and the chunk it follows
+    chunks: Iterator[Tuple[int, Dict[bytes, bytes]]]
+    if sampled:
+        chunks = (
+            (0, chunk)
+            for chunk in _sample_chunks(client_from, http_cache_key, n, chunk_size)
+        )
+    else:
+        cursor: int = int(client_to.get(resume_key) or 0) if resume else 0
+        if cursor:
+            logger.info(f"resuming copy of `{http_cache_key}` at {cursor=}")
+        chunks = scan_cache_pages_redis(client_from, http_cache_key, chunk_size, cursor)
+
+    for next_cursor, chunk in chunks:
+        if n is None:
+            res.cursor = next_cursor
+        elif not sampled:
+            # a page cut short is not copied up to its cursor, so nothing is resumed
+            chunk = dict(list(chunk.items())[: n - res.ncopied])
+
+        chunk = _reencode(
+            client_from, http_cache_key, chunk, codec, dicts_from, dicts_to, res
+        )
+        if not chunk:
+            continue
+
+        fields: List[bytes] = list(chunk)
+        scores: List[Optional[float]] = [None] * len(fields)
+        if http_date_key is not None:
+            scores = client_from.zmscore(http_date_key, fields)
+            res.nunscored += scores.count(None)
+
+        # entries, scores and the resume cursor are written together. Entries replace
+        # body references of the target, so they are written by the dedup script
+        with client_to.pipeline(transaction=True) as pipe:
+            queue_cache_entries_redis(
+                pipe,
+                http_cache_key,
+                # without a date index all scores are None, and the dates key is unused
+                http_date_key or http_cache_key,
+                zip(fields, chunk.values(), scores),
+            )
+            if n is None:
+                pipe.set(resume_key, res.cursor)
+            pipe.execute()
+
+        res.ncopied += len(chunk)
+        logger.info(f"copied {res.ncopied:,} entries of `{http_cache_key}`")
+        if n is not None and res.ncopied >= n:
+            break
+
+    if n is None and res.cursor == 0:
+        client_to.delete(resume_key)
+
+    return res
@@ -0,0 +1,191 @@
+"""pg_writer.py.
+
+Background writer for the Postgres HTTP cache
+"""
+import logging
+import queue
+import threading
+import time
+from typing import List, Optional
+
+from scrapy.http import Response  # type: ignore[import]
+from sqlalchemy.orm import sessionmaker
+
+from ..core.db import loop_async_session
+from ..core.settings import (HTTP_CACHE_PG_WRITER_ATTEMPTS,
+                             HTTP_CACHE_PG_WRITER_QUEUE_SIZE,
+                             HTTP_CACHE_PG_WRITER_RETRY_DELAY,
+                             HTTP_CACHE_WRITE_BATCH_SIZE,
+                             HTTP_CACHE_WRITE_MAX_DELAY)
+from ..models.cache import HttpCacheItem
+from ..models.cache.crud import CacheCRUD
+from .codecs import BodyCodec, ZstdDictionaries
+
+logger = logging.getLogger(__name__)
+
+# tells the writer thread to stop, after the responses queued before it
+_STOP: object = object()
+
+# seconds between checks that the writer thread is still alive, while waiting on it
+_POLL_INTERVAL: float = 1.0
+
+
+class PgCacheWriter:
+    """Write responses to the postgres http cache from a background thread.
+
+    `add` only queues the response. The thread compresses responses, and upserts them
+    in batches with one INSERT .. ON CONFLICT per batch, on its own event loop and engine,
+    so callers never wait on a pg round trip. The queue is bounded: when postgres falls
+    behind, `add` blocks until there is room again. A failed batch is retried
+    `attempts` times in all, with a doubling delay, then its responses are dropped
+    and counted in `nfailed`. If the thread dies, e.g. on a bad connection string,
+    `add` and `flush` raise instead of waiting on it
+
+    Usage:
+        with PgCacheWriter(settings.async_db_url) as writer:
+            writer.add(response)
+    """
+
+    def __init__(
+        self,
+        async_connection_str: str,
+        batch_size: int = HTTP_CACHE_WRITE_BATCH_SIZE,
+        max_delay: float = HTTP_CACHE_WRITE_MAX_DELAY,
+        queue_size: int = HTTP_CACHE_PG_WRITER_QUEUE_SIZE,
+        codec: Optional[BodyCodec] = None,
+        dicts: Optional[ZstdDictionaries] = None,
+        dedup_bodies: bool = False,
+        attempts: int = HTTP_CACHE_PG_WRITER_ATTEMPTS,
+        retry_delay: float = HTTP_CACHE_PG_WRITER_RETRY_DELAY,
+    ) -> None:
+        assert batch_size > 0, f"{batch_size=}"
+        assert max_delay > 0, f"{max_delay=}"
+        assert attempts > 0, f"{attempts=}"
+        self.async_connection_str: str = async_connection_str
+        self.batch_size: int = batch_size
+        self.max_delay: float = max_delay
+        self.codec: Optional[BodyCodec] = codec
+        self.dicts: Optional[ZstdDictionaries] = dicts
+        self.dedup_bodies: bool = dedup_bodies
+        self.attempts: int = attempts
+        self.retry_delay: float = retry_delay
+
+        self.nwritten: int = 0
+        self.nfailed: int = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name=self.__class__.__name__, daemon=True
+        )
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    def __enter__(self) -> "PgCacheWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _check_alive(self) -> None:
+        if not self._thread.is_alive():
+            raise RuntimeError(
+                f"{self.__class__.__name__} is closed, {len(self):,} responses unwritten"
+            )
+
+    def _put(self, item: Response | object) -> None:
+        self._check_alive()
+        while True:
+            try:
+                self._queue.put(item, timeout=_POLL_INTERVAL)
+                return
+            except queue.Full:
+                self._check_alive()
+
+    def add(self, response: Response) -> None:
+        self._put(response)
+
+    def flush(self) -> None:
+        """Wait until all queued responses are written, or dropped after failing."""
+        # `Queue.join` without a timeout would wait forever on a dead thread
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                self._check_alive()
+                self._queue.all_tasks_done.wait(_POLL_INTERVAL)
+
+    def close(self) -> None:
+        """Write all queued responses, and stop the writer thread."""
+        if not self._thread.is_alive():
+            return
+
+        self._put(_STOP)
+        self._thread.join()
+
+    def _next_batch(self) -> List[Response | object]:
+        """Wait for a first response, then take what arrives within `max_delay`."""
+        batch: List[Response | object] = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get(timeout=self.max_delay))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        try:
+            with loop_async_session(
+                self.async_connection_str, pool_size=1, max_overflow=0
+            ) as (loop, async_session):
+                stop: bool = False
+                while not stop:
+                    batch: List[Response | object] = self._next_batch()
+                    stop = batch[-1] is _STOP
+                    responses: List[Response] = [r for r in batch if r is not _STOP]
+                    try:
+                        if responses:
+                            self._write_with_retries(loop, async_session, responses)
+                    finally:
+                        for _ in batch:
+                            self._queue.task_done()
+        except Exception as e:
+            logger.exception(f"{self.__class__.__name__} stopped")
+
+    def _write_with_retries(
+        self, loop, async_session: sessionmaker, responses: List[Response]
+    ) -> None:
+        delay: float = self.retry_delay
+        for attempt in range(1, self.attempts + 1):
+            try:
+                loop.run_until_complete(self._write(async_session, responses))
+                self.nwritten += len(responses)
+                return
+            except Exception as e:
+                if attempt == self.attempts:
+                    self.nfailed += len(responses)
+                    logger.exception(f"dropping {len(responses):,} responses")
+                    return
+                logger.warning(
+                    f"cannot write {len(responses):,} responses, {attempt=}. {e}"
+                )
+                time.sleep(delay)
+                delay *= 2
+
+    async def _write(
+        self, async_session: sessionmaker, responses: List[Response]
+    ) -> None:
+        cache_items: List[HttpCacheItem] = [
+            HttpCacheItem.from_response(response, self.codec, self.dicts)
+            for response in responses
+        ]
+        async with async_session() as session:
+            cache_crud = CacheCRUD(
+                session, dedup_bodies=self.dedup_bodies, dicts=self.dicts
+            )
+            if self.dedup_bodies:
+                for cache_item in cache_items:
+                    await cache_crud.upsert(cache_item)
+            else:
+                await cache_crud.upsert_many(cache_items)
+
+        logger.debug(f"wrote {len(responses):,} responses")
@@ -0,0 +1,305 @@
+"""record.py.
+
+Versioned binary record format of http cache entries
+
+Layout, little-endian:
+    header      magic, version, codec, flags, status, time, url / headers / body lengths,
+                the uncompressed body length, and since version 2 the zstd dict id
+    url         utf-8
+    headers     raw http headers, `Name: value\\r\\n` lines
+    body        compressed with `codec`, or with `FLAG_BODY_REF` the digest of a
+                body that is stored once, see `dedup.py`
+
+Metadata is read from the header and memoryview slices, without copying or
+decompressing the body. The body is decompressed on first access
+"""
+import logging
+import struct
+from typing import Any, Dict, Final, Iterable, List, Optional, Tuple
+
+from .codecs import (BodyCodec, ZstdDictionaries, compress_body,
+                     decode_body_frame, decompress_body, resolve_dict_id)
+
+logger = logging.getLogger(__name__)
+
+MAGIC: Final[bytes] = b"SUHC"
+RECORD_VERSION: Final[int] = 2
+
+# magic, version, codec, flags, status, time, url_len, headers_len, body_len, raw_body_len
+HEADER_V1: Final[struct.Struct] = struct.Struct("<4sBBHHdIIII")
+# version 1 + dict_id
+HEADER: Final[struct.Struct] = struct.Struct("<4sBBHHdIIIII")
+HEADERS: Final[Dict[int, struct.Struct]] = {1: HEADER_V1, 2: HEADER}
+
+# the body is the digest of a shared body frame, since version 2
+FLAG_BODY_REF: Final[int] = 1
+
+
+def encode_headers(headers: Any) -> bytes:
+    """Encode headers as raw http header lines.
+
+    Accepts raw bytes, or a mapping of names to a value or list of values,
+    like scrapy `Headers`
+    """
+    if headers is None:
+        return b""
+    if isinstance(headers, (bytes, bytearray, memoryview)):
+        return bytes(headers)
+
+    lines: List[bytes] = []
+    for name, values in headers.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        name = name.encode() if isinstance(name, str) else name
+        for value in values:
+            value = value.encode() if isinstance(value, str) else value
+            lines.append(name + b": " + value)
+
+    return b"\r\n".join(lines)
+
+
+def decode_headers(raw: bytes) -> Dict[bytes, List[bytes]]:
+    """Decode raw http header lines to a mapping of names to lists of values."""
+    headers: Dict[bytes, List[bytes]] = {}
+    for line in raw.splitlines():
+        name, sep, value = line.partition(b":")
+        if sep:
+            headers.setdefault(name.strip(), []).append(value.strip())
+
+    return headers
+
+
+def is_cache_record(data: bytes | memoryview) -> bool:
+    return bytes(data[: len(MAGIC)]) == MAGIC
+
+
+def _get_header(buf: bytes | memoryview) -> struct.Struct:
+    """Get the header struct of the record version, after checking the magic."""
+    if not is_cache_record(buf):
+        raise ValueError(f"not a cache record, magic={bytes(buf[: len(MAGIC)])!r}")
+
+    version: int = buf[len(MAGIC)] if len(buf) > len(MAGIC) else 0
+    header: Optional[struct.Struct] = HEADERS.get(version)
+    if header is None:
+        raise ValueError(f"unsupported cache record version {version}")
+
+    return header
+
+
+class CacheRecord:
+    """Read-only view of an encoded cache record.
+
+    Usage:
+        data = CacheRecord.encode(200, url, headers, body, time)
+        record = CacheRecord(data)
+        record.status, record.time   # header only
+        record.body                  # decompressed on first access
+    """
+
+    __slots__ = (
+        "_buf",
+        "_dicts",
+        "version",
+        "codec",
+        "dict_id",
+        "flags",
+        "status",
+        "time",
+        "_header_end",
+        "_url_end",
+        "_headers_end",
+        "_body_end",
+        "raw_body_size",
+        "_body",
+        "_body_frame",
+    )
+
+    def __init__(
+        self, data: bytes | memoryview, dicts: Optional[ZstdDictionaries] = None
+    ) -> None:
+        buf = memoryview(data)
+        header: struct.Struct = _get_header(buf)
+        if len(buf) < header.size:
+            raise ValueError(f"cache record too short: {len(buf)} bytes")
+
+        (
+            _,
+            self.version,
+            codec,
+            self.flags,
+            self.status,
+            self.time,
+            url_len,
+            headers_len,
+            body_len,
+            self.raw_body_size,
+            *dict_id,
+        ) = header.unpack_from(buf)
+        self.dict_id: int = dict_id[0] if dict_id else 0
+
+        self.codec: BodyCodec = BodyCodec(codec)
+        self._header_end: int = header.size
+        self._url_end: int = header.size + url_len
+        self._headers_end: int = self._url_end + headers_len
+        self._body_end: int = self._headers_end + body_len
+        if len(buf) < self._body_end:
+            raise ValueError(f"truncated cache record: {len(buf)} < {self._body_end}")
+
+        self._buf: memoryview = buf
+        self._dicts: Optional[ZstdDictionaries] = dicts
+        self._body: Optional[bytes] = None
+        self._body_frame: Optional[bytes] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}("
+            f"status={self.status}, "
+            f"url='{self.url}', "
+            f"time={self.time}, "
+            f"codec={self.codec.name}, "
+            f"body={self.compressed_size:,}/{self.raw_body_size:,} bytes"
+            f")"
+        )
+
+    @property
+    def url(self) -> str:
+        return str(self._buf[self._header_end : self._url_end], "utf-8")
+
+    @property
+    def raw_headers(self) -> bytes:
+        return bytes(self._buf[self._url_end : self._headers_end])
+
+    @property
+    def headers(self) -> Dict[bytes, List[bytes]]:
+        return decode_headers(self.raw_headers)
+
+    @property
+    def compressed_body(self) -> memoryview:
+        return self._buf[self._headers_end : self._body_end]
+
+    @property
+    def compressed_size(self) -> int:
+        return self._body_end - self._headers_end
+
+    @property
+    def is_body_ref(self) -> bool:
+        return bool(self.flags & FLAG_BODY_REF)
+
+    @property
+    def body_ref(self) -> Optional[bytes]:
+        """Digest of the shared body, None if the body is stored inline."""
+        return bytes(self.compressed_body) if self.is_body_ref else None
+
+    @property
+    def has_body(self) -> bool:
+        """False for body references of which the shared body was not found."""
+        return not self.is_body_ref or self._body_frame is not None
+
+    @property
+    def nbytes(self) -> int:
+        """Memory use, counting the decompressed body as if it was accessed."""
+        frame_size: int = len(self._body_frame) if self._body_frame is not None else 0
+        return len(self._buf) + frame_size + self.raw_body_size
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._buf)
+
+    def resolve_body(self, body_frame: bytes) -> None:
+        """Set the shared body frame of a body reference."""
+        assert self.is_body_ref, "body is stored inline"
+        self._body_frame = body_frame
+
+    @property
+    def body(self) -> bytes:
+        if self._body is not None:
+            return self._body
+
+        if self.is_body_ref:
+            if self._body_frame is None:
+                raise ValueError(f"unresolved body reference of {self.url}")
+            self._body = decode_body_frame(self._body_frame, self._dicts)
+        else:
+            self._body = decompress_body(
+                self.compressed_body,
+                self.codec,
+                self.raw_body_size,
+                self.dict_id,
+                self._dicts,
+            )
+
+        return self._body
+
+    @staticmethod
+    def encode(
+        status: int,
+        url: str,
+        headers: Any,
+        body: bytes,
+        time: float,
+        codec: BodyCodec = BodyCodec.lz4,
+        flags: int = 0,
+        dicts: Optional[ZstdDictionaries] = None,
+    ) -> bytes:
+        """Encode a record, zstd bodies use the dictionary of the url domain, if any."""
+        url_bytes: bytes = url.encode("utf-8")
+        headers_bytes: bytes = encode_headers(headers)
+        dict_id: int = resolve_dict_id(url, codec, dicts)
+        compressed: bytes = compress_body(body, codec, dict_id, dicts)
+        header: bytes = HEADER.pack(
+            MAGIC,
+            RECORD_VERSION,
+            codec,
+            flags,
+            status,
+            time,
+            len(url_bytes),
+            len(headers_bytes),
+            len(compressed),
+            len(body),
+            dict_id,
+        )
+
+        return b"".join((header, url_bytes, headers_bytes, compressed))
+
+    @staticmethod
+    def encode_ref(
+        status: int,
+        url: str,
+        headers: Any,
+        digest: bytes,
+        raw_body_size: int,
+        time: float,
+    ) -> bytes:
+        """Encode a record that references a shared body by its digest."""
+        url_bytes: bytes = url.encode("utf-8")
+        headers_bytes: bytes = encode_headers(headers)
+        header: bytes = HEADER.pack(
+            MAGIC,
+            RECORD_VERSION,
+            BodyCodec.none,
+            FLAG_BODY_REF,
+            status,
+            time,
+            len(url_bytes),
+            len(headers_bytes),
+            len(digest),
+            raw_body_size,
+            0,
+        )
+
+        return b"".join((header, url_bytes, headers_bytes, digest))
+
+
+def read_cache_headers(
+    items: Iterable[Optional[bytes]],
+) -> List[Optional[Tuple[int, float]]]:
+    """Read (status, time) of encoded records, without building records. None if not a record."""
+    res: List[Optional[Tuple[int, float]]] = []
+    for data in items:
+        if data is None or not is_cache_record(data):
+            res.append(None)
+            continue
+        _, _, _, _, status, time, *_ = _get_header(data).unpack_from(data)
+        res.append((status, time))
+
+    return res
@@ -0,0 +1,265 @@
+"""scan.py.
+
+Streaming readers of the Redis HTTP cache
+
+The cache hash is walked with HSCAN, one page at a time, so memory use is bounded by
+the page size and redis is never blocked by one huge HKEYS / HMGET. Pages can be
+decoded in a process pool, with a bounded number of pages in flight
+"""
+import logging
+import os
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                as_completed, wait)
+from datetime import datetime
+from typing import Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+import redis
+
+from ..core.settings import (HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+                             HTTP_CACHE_BODIES_KEY_FORMAT,
+                             HTTP_CACHE_SCAN_PAGE_SIZE)
+from ..models.cache import HttpCacheItem
+from .codecs import ZstdDictionaries
+from .items import _decompress_legacy, record_to_cache_item
+from .record import CacheRecord, is_cache_record
+
+logger = logging.getLogger(__name__)
+
+# encoded entry, and the shared body frame of body references
+PageEntry = Tuple[bytes, Optional[bytes]]
+
+# zstd dictionaries of pool workers, see `_init_worker`
+_worker_dicts: Optional[ZstdDictionaries] = None
+
+
+def scan_cache_pages_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    page_size: int = HTTP_CACHE_SCAN_PAGE_SIZE,
+    cursor: int = 0,
+) -> Iterator[Tuple[int, Dict[bytes, bytes]]]:
+    """Walk the cache hash with HSCAN, yields the next cursor and a page of url -> entry.
+
+    Pass a yielded cursor to resume after its page. Entries can be yielded more than
+    once when the hash is resized during the scan
+    """
+    assert page_size > 0, f"{page_size=}"
+    while True:
+        cursor, page = client.hscan(http_cache_key, cursor, count=page_size)
+        if page:
+            yield cursor, page
+        if cursor == 0:
+            return
+
+
+def _iter_hash_fields(
+    client: redis.StrictRedis, http_cache_key: str, page_size: int
+) -> Iterator[List[bytes]]:
+    """Walk the hash fields with HSCAN NOVALUES, or with values before redis 7.4.
+
+    redis-py before 5.0.8 has no `no_values`, and raises a TypeError
+    """
+    try:
+        cursor, fields = client.hscan(
+            http_cache_key, 0, count=page_size, no_values=True
+        )
+    except (redis.ResponseError, TypeError) as e:
+        logger.debug(f"HSCAN NOVALUES not supported, scanning with values. {e}")
+        for _, page in scan_cache_pages_redis(client, http_cache_key, page_size):
+            yield list(page)
+        return
+
+    while True:
+        if fields:
+            yield fields
+        if cursor == 0:
+            return
+        cursor, fields = client.hscan(
+            http_cache_key, cursor, count=page_size, no_values=True
+        )
+
+
+def iter_cache_urls_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    http_date_key: Optional[str] = None,
+    min_age: Optional[float] = None,
+    max_age: Optional[float] = None,
+    page_size: int = HTTP_CACHE_SCAN_PAGE_SIZE,
+) -> Iterator[List[bytes]]:
+    """Yield pages of cached urls, without reading any cache entry.
+
+    With `http_date_key`, urls are read from the date zset, oldest first, and can be
+    filtered on cache age in seconds: `min_age` keeps entries at least that old,
+    e.g. to refresh stale pages, `max_age` entries at most that old.
+    Without it, the hash fields are walked, and ages cannot be filtered
+    """
+    assert page_size > 0, f"{page_size=}"
+    if http_date_key is None:
+        assert (
+            min_age is None and max_age is None
+        ), "filtering on age needs the date zset"
+        yield from _iter_hash_fields(client, http_cache_key, page_size)
+        return
+
+    # same clock as the `time` of cache items
+    now: float = datetime.utcnow().timestamp()
+    min_score = "-inf" if max_age is None else now - max_age
+    max_score = "+inf" if min_age is None else now - min_age
+
+    # page by score, so entries added or evicted during the walk do not shift pages.
+    # A page starts at the last score of the previous one, skipping the urls of that
+    # score it already yielded, an exclusive bound would skip ties across pages
+    offset: int = 0
+    while True:
+        page: List[Tuple[bytes, float]] = client.zrangebyscore(
+            http_date_key,
+            min_score,
+            max_score,
+            start=offset,
+            num=page_size,
+            withscores=True,
+        )
+        if not page:
+            return
+        yield [url for url, _ in page]
+        if len(page) < page_size:
+            return
+
+        last: float = page[-1][1]
+        nlast: int = sum(1 for _, score in page if score == last)
+        offset = offset + nlast if last == min_score else nlast
+        min_score = last
+
+
+def _resolve_page(
+    client: redis.StrictRedis, http_cache_key: str, page: Dict[bytes, bytes]
+) -> List[PageEntry]:
+    """Pair entries with their shared body frames, with one HMGET per page."""
+    digests: List[Optional[bytes]] = [
+        CacheRecord(data).body_ref if is_cache_record(data) else None
+        for data in page.values()
+    ]
+    refs: List[bytes] = list({d for d in digests if d is not None})
+    if not refs:
+        return [(data, None) for data in page.values()]
+
+    bodies_key: str = HTTP_CACHE_BODIES_KEY_FORMAT.format(http_cache_key=http_cache_key)
+    frames: Dict[bytes, Optional[bytes]] = dict(
+        zip(refs, client.hmget(bodies_key, refs))
+    )
+    return [
+        (data, frames[digest] if digest is not None else None)
+        for data, digest in zip(page.values(), digests)
+    ]
+
+
+def iter_cache_records_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    page_size: int = HTTP_CACHE_SCAN_PAGE_SIZE,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> Iterator[CacheRecord]:
+    """Iterate all cache records in-process, bodies are only decompressed on access.
+
+    Legacy entries are skipped, since converting them needs unpickling
+    """
+    for _, page in scan_cache_pages_redis(client, http_cache_key, page_size):
+        for data, frame in _resolve_page(client, http_cache_key, page):
+            if not is_cache_record(data):
+                continue
+            record = CacheRecord(data, dicts)
+            if frame is not None:
+                record.resolve_body(frame)
+            yield record
+
+
+def _init_worker(connection_kwargs: Optional[dict], level: Optional[int]) -> None:
+    """Connect the zstd dictionaries of a pool worker, clients cannot be pickled."""
+    global _worker_dicts
+    if connection_kwargs is not None:
+        _worker_dicts = ZstdDictionaries(redis.StrictRedis(**connection_kwargs), level)
+
+
+def _decode_page(
+    entries: List[PageEntry],
+    allow_pickle: bool = HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+    dicts: Optional[ZstdDictionaries] = None,
+) -> List[HttpCacheItem]:
+    dicts = dicts or _worker_dicts
+    items: List[HttpCacheItem] = []
+    for data, frame in entries:
+        if not is_cache_record(data):
+            items.append(_decompress_legacy(data, allow_pickle))
+            continue
+
+        record = CacheRecord(data, dicts)
+        if frame is not None:
+            record.resolve_body(frame)
+        elif record.is_body_ref:
+            logger.warning(f"missing shared body of {record.url}")
+            continue
+        items.append(record_to_cache_item(record))
+
+    return items
+
+
+def iter_cache_items_redis(
+    client: redis.StrictRedis,
+    http_cache_key: str,
+    page_size: int = HTTP_CACHE_SCAN_PAGE_SIZE,
+    processes: Optional[int] = None,
+    ordered: bool = True,
+    dicts: Optional[ZstdDictionaries] = None,
+    allow_pickle: bool = HTTP_CACHE_ALLOW_LEGACY_PICKLE,
+) -> Iterator[HttpCacheItem]:
+    """Iterate all cache items with decompressed bodies, decoded in a process pool.
+
+    With `ordered=False`, pages are yielded as soon as they are decoded, else in
+    scan order. `processes=0` decodes in this process. At most two pages per process
+    are in flight, so memory use does not grow with the cache size
+
+    Usage:
+        for item in iter_cache_items_redis(client, http_cache_key, ordered=False):
+            ...
+    """
+    pages: Iterator[List[PageEntry]] = (
+        _resolve_page(client, http_cache_key, page)
+        for _, page in scan_cache_pages_redis(client, http_cache_key, page_size)
+    )
+    if processes == 0:
+        for entries in pages:
+            yield from _decode_page(entries, allow_pickle, dicts)
+        return
+
+    processes = processes or os.cpu_count() or 1
+    max_pending: int = 2 * processes
+    connection_kwargs: Optional[dict] = (
+        dicts.client.connection_pool.connection_kwargs if dicts is not None else None
+    )
+    level: Optional[int] = dicts.level if dicts is not None else None
+
+    with ProcessPoolExecutor(
+        processes, initializer=_init_worker, initargs=(connection_kwargs, level)
+    ) as pool:
+        # ordered: futures in scan order, unordered: futures not yet done
+        pending: Deque[Future] = deque()
+        running: Set[Future] = set()
+        for entries in pages:
+            future: Future = pool.submit(_decode_page, entries, allow_pickle)
+            if ordered:
+                pending.append(future)
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+            else:
+                running.add(future)
+                if len(running) >= max_pending:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+
+        for future in pending:
+            yield from future.result()
+        for future in as_completed(running):
+            yield from future.result()
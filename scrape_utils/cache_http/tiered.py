@@ -0,0 +1,337 @@
+"""tiered.py.
+
+Tiered HTTP cache: an in-process LRU, Redis and Postgres
+
+Lookups go through the tiers in order, and a hit is promoted to the tiers above it,
+so repeated lookups of hot urls are served from process memory. Redis is the warm tier
+shared by all workers, Postgres the cold tier. Tiers without a client are skipped
+"""
+import logging
+import threading
+from datetime import datetime
+from enum import Enum
+from itertools import islice
+from time import monotonic
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import redis
+from pydantic import BaseModel, Field
+from scrapy.http import Response  # type: ignore[import]
+from sqlmodel import Session
+
+from ..core.settings import (HTTP_CACHE_MAX_PENDING,
+                             HTTP_CACHE_MAX_RETRY_DELAY,
+                             HTTP_CACHE_MEMORY_MAX_BYTES,
+                             HTTP_CACHE_MEMORY_MAXSIZE, HTTP_CACHE_RETRY_DELAY,
+                             HTTP_CACHE_WRITE_BATCH_SIZE)
+from ..utils.lru import LRUCache
+from .codecs import BodyCodec, ZstdDictionaries
+from .dedup import save_cache_records_redis, save_responses_dedup_redis
+from .items import load_cache_records_pg, load_cache_records_redis
+from .pg_writer import PgCacheWriter
+from .record import CacheRecord
+
+logger = logging.getLogger(__name__)
+
+
+class CacheTier(str, Enum):
+    memory = "memory"
+    redis = "redis"
+    pg = "pg"
+
+
+class WritePolicy(str, Enum):
+    """When `put` writes to redis and postgres, memory is always updated right away."""
+
+    # write every response
+    through = "through"
+    # buffer responses, and write them in batches of `batch_size`, or on `flush`
+    behind = "behind"
+
+
+class TierStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        return self.hits / max(1, self.hits + self.misses)
+
+
+class TieredCacheStats(BaseModel):
+    memory: TierStats = Field(default_factory=TierStats)
+    redis: TierStats = Field(default_factory=TierStats)
+    pg: TierStats = Field(default_factory=TierStats)
+
+
+class TieredHttpCache:
+    """Read-through http cache over an in-process LRU, redis and postgres.
+
+    The memory tier holds `CacheRecord`s within `max_bytes`, decompressed bodies included.
+    With `WritePolicy.behind`, buffered responses are only visible to this process
+    until they are flushed. Postgres writes always happen in the background thread of
+    a `PgCacheWriter`, so `put` also works inside a running event loop: `pg_writer`, or
+    one started for `async_connection_str`, which is closed on exit.
+    A failed flush puts its batch back, and `put` waits `retry_delay` before flushing
+    again, doubled on every failure. At most `max_pending` responses are buffered,
+    the oldest are dropped and counted in `ndropped`
+
+    Usage:
+        cache = TieredHttpCache(
+            client, http_cache_key, http_date_key,
+            read_session=lambda: get_read_session(settings.db_url),
+            async_connection_str=settings.async_db_url,
+            write_policy=WritePolicy.behind,
+        )
+        with cache:
+            record = cache.get(url)
+            cache.put(response)
+        cache.stats.memory.hit_ratio
+    """
+
+    def __init__(
+        self,
+        client: Optional[redis.StrictRedis] = None,
+        http_cache_key: Optional[str] = None,
+        http_date_key: Optional[str] = None,
+        read_session: Optional[Callable[[], Session]] = None,
+        async_connection_str: Optional[str] = None,
+        pg_writer: Optional[PgCacheWriter] = None,
+        max_bytes: int = HTTP_CACHE_MEMORY_MAX_BYTES,
+        maxsize: int = HTTP_CACHE_MEMORY_MAXSIZE,
+        ttl: Optional[float] = None,
+        write_policy: WritePolicy = WritePolicy.through,
+        batch_size: int = HTTP_CACHE_WRITE_BATCH_SIZE,
+        max_pending: int = HTTP_CACHE_MAX_PENDING,
+        retry_delay: float = HTTP_CACHE_RETRY_DELAY,
+        max_retry_delay: float = HTTP_CACHE_MAX_RETRY_DELAY,
+        codec: BodyCodec = BodyCodec.lz4,
+        dicts: Optional[ZstdDictionaries] = None,
+        dedup: bool = False,
+    ) -> None:
+        assert client is None or (
+            http_cache_key and http_date_key
+        ), "redis tier needs `http_cache_key` and `http_date_key`"
+        assert batch_size > 0, f"{batch_size=}"
+        assert max_pending >= batch_size, f"{max_pending=} < {batch_size=}"
+        self.client: Optional[redis.StrictRedis] = client
+        self.http_cache_key: Optional[str] = http_cache_key
+        self.http_date_key: Optional[str] = http_date_key
+        self.read_session: Optional[Callable[[], Session]] = read_session
+        self.async_connection_str: Optional[str] = async_connection_str
+        # an event loop cannot be run from inside a running one, e.g. scrapy's asyncio
+        # reactor, so postgres is never written from the calling thread
+        self._owns_pg_writer: bool = (
+            pg_writer is None and async_connection_str is not None
+        )
+        if self._owns_pg_writer:
+            pg_writer = PgCacheWriter(
+                async_connection_str, codec=codec, dicts=dicts, dedup_bodies=dedup
+            )
+        self.pg_writer: Optional[PgCacheWriter] = pg_writer
+        self.write_policy: WritePolicy = write_policy
+        self.batch_size: int = batch_size
+        self.max_pending: int = max_pending
+        self.retry_delay: float = retry_delay
+        self.max_retry_delay: float = max_retry_delay
+        self.codec: BodyCodec = codec
+        self.dicts: Optional[ZstdDictionaries] = dicts
+        # store bodies once per digest, in redis and postgres
+        self.dedup: bool = dedup
+
+        self.memory = LRUCache(
+            maxsize, ttl=ttl, max_bytes=max_bytes, sizeof=lambda r: r.nbytes
+        )
+        self.stats = TieredCacheStats()
+        # url -> buffered response and its record, the last put wins
+        self._pending: Dict[str, Tuple[Response, CacheRecord]] = {}
+        # buffered responses dropped because writes kept failing
+        self.ndropped: int = 0
+        # `put` does not flush before `_retry_at`, set after a failed flush
+        self._retry_at: float = 0.0
+        self._next_retry_delay: float = retry_delay
+        # scrapy can call storage methods from its thread pool
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "TieredHttpCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Flush buffered responses, and stop the postgres writer started by the cache."""
+        try:
+            self.flush()
+        finally:
+            if self._owns_pg_writer:
+                self.pg_writer.close()
+
+    def _count(self, tier: CacheTier, hits: int, misses: int) -> None:
+        with self._lock:
+            stats: TierStats = getattr(self.stats, tier)
+            stats.hits += hits
+            stats.misses += misses
+
+    def _count_writes(self, tier: CacheTier, n: int) -> None:
+        with self._lock:
+            getattr(self.stats, tier).writes += n
+
+    def _promote(self, records: List[CacheRecord]) -> None:
+        for record in records:
+            self.memory.set(record.url, record)
+        self._count_writes(CacheTier.memory, len(records))
+
+    def get(self, url: str) -> Optional[CacheRecord]:
+        return self.get_many([url]).get(url)
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, CacheRecord]:
+        """Get records by url, looking up the urls missing in a tier in the next tier."""
+        found: Dict[str, CacheRecord] = {}
+        missing: List[str] = []
+        for url in urls:
+            record: Optional[CacheRecord] = self.memory.get(url)
+            if record is None:
+                missing.append(url)
+            else:
+                found[url] = record
+        self._count(CacheTier.memory, len(found), len(missing))
+
+        if missing and self.client is not None:
+            records: List[CacheRecord] = [
+                r
+                for r in load_cache_records_redis(
+                    self.client, self.http_cache_key, missing, self.dicts
+                )
+                if r.has_body
+            ]
+            self._count(CacheTier.redis, len(records), len(missing) - len(records))
+            self._promote(records)
+            found |= {r.url: r for r in records}
+            missing = [url for url in missing if url not in found]
+
+        if missing and self.read_session is not None:
+            with self.read_session() as session:
+                records = load_cache_records_pg(
+                    session, missing, self.codec, self.dicts
+                )
+            self._count(CacheTier.pg, len(records), len(missing) - len(records))
+            if records and self.client is not None:
+                n: int = save_cache_records_redis(
+                    self.client, self.http_cache_key, self.http_date_key, records
+                )
+                self._count_writes(CacheTier.redis, n)
+            self._promote(records)
+            found |= {r.url: r for r in records}
+
+        return found
+
+    def put(self, response: Response) -> CacheRecord:
+        """Cache a response in memory, and write it to the other tiers per `write_policy`."""
+        # same timestamp as `make_cache_item`
+        time: float = datetime.utcnow().timestamp()
+        record = CacheRecord(
+            CacheRecord.encode(
+                response.status,
+                response.url,
+                response.headers.to_string(),
+                response.body,
+                time,
+                codec=self.codec,
+                dicts=self.dicts,
+            ),
+            self.dicts,
+        )
+        self._promote([record])
+
+        if self.client is None and self.pg_writer is None:
+            return record
+
+        with self._lock:
+            # re-insert, so a url put again counts as the newest
+            self._pending.pop(record.url, None)
+            self._pending[record.url] = (response, record)
+            self._drop_oldest_pending()
+            due: bool = (
+                self.write_policy == WritePolicy.through
+                or len(self._pending) >= self.batch_size
+            ) and monotonic() >= self._retry_at
+
+        if due:
+            self.flush()
+
+        return record
+
+    def _drop_oldest_pending(self) -> None:
+        """Drop the oldest buffered responses beyond `max_pending`, call with the lock held."""
+        ndrop: int = len(self._pending) - self.max_pending
+        if ndrop <= 0:
+            return
+        for url in list(islice(self._pending, ndrop)):
+            del self._pending[url]
+        self.ndropped += ndrop
+        logger.warning(f"dropped {ndrop:,} buffered responses, {self.ndropped=:,}")
+
+    def flush(self) -> int:
+        """Write buffered responses to redis and postgres, returns the number written.
+
+        Flushes right away, also while `put` is backing off
+        """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+
+        if not batch:
+            return 0
+
+        try:
+            self._write(batch)
+        except Exception:
+            # retried by the next flush, responses put since then win
+            with self._lock:
+                self._pending = batch | self._pending
+                self._drop_oldest_pending()
+                self._retry_at = monotonic() + self._next_retry_delay
+                self._next_retry_delay = min(
+                    2 * self._next_retry_delay, self.max_retry_delay
+                )
+            raise
+
+        with self._lock:
+            self._retry_at = 0.0
+            self._next_retry_delay = self.retry_delay
+
+        logger.debug(f"flushed {len(batch):,} responses")
+        return len(batch)
+
+    def _write(self, batch: Dict[str, Tuple[Response, CacheRecord]]) -> None:
+        responses: List[Response] = [response for response, _ in batch.values()]
+        if self.client is not None:
+            if self.dedup:
+                res = save_responses_dedup_redis(
+                    self.client,
+                    self.http_cache_key,
+                    self.http_date_key,
+                    responses,
+                    self.codec,
+                    self.dicts,
+                )
+                n: int = res.nstored + res.nunchanged
+            else:
+                # the records are already encoded for the memory tier
+                n = save_cache_records_redis(
+                    self.client,
+                    self.http_cache_key,
+                    self.http_date_key,
+                    [record for _, record in batch.values()],
+                )
+            self._count_writes(CacheTier.redis, n)
+
+        if self.pg_writer is not None:
+            for response in responses:
+                self.pg_writer.add(response)
+            self._count_writes(CacheTier.pg, len(responses))
+
+    def invalidate(self, url: str) -> None:
+        """Drop `url` from the memory tier, e.g. after another process rewrote it."""
+        self.memory.delete(url)
@@ -0,0 +1,119 @@
+"""writer.py.
+
+Buffered writer for the Redis HTTP cache
+"""
+import logging
+import threading
+from time import monotonic
+from typing import List, Optional
+
+import redis
+from scrapy.http import Response  # type: ignore[import]
+
+from ..core.settings import (HTTP_CACHE_WRITE_BATCH_SIZE,
+                             HTTP_CACHE_WRITE_MAX_DELAY)
+from .codecs import BodyCodec, ZstdDictionaries
+from .dedup import save_responses_dedup_redis
+from .helpers import save_compressed_responses_redis
+
+logger = logging.getLogger(__name__)
+
+
+class RedisCacheWriter:
+    """Buffer responses, and write them to the redis cache in batches.
+
+    Each flush is one MULTI/EXEC round trip, that updates the cache hset
+    and the date zset together. A batch is flushed when it is full, or when its oldest
+    response waited longer than `max_delay` seconds, checked on `add`
+
+    Usage:
+        with RedisCacheWriter(client, http_cache_key, http_date_key) as writer:
+            writer.add(response)
+    """
+
+    def __init__(
+        self,
+        client: redis.StrictRedis,
+        http_cache_key: str,
+        http_date_key: str,
+        batch_size: int = HTTP_CACHE_WRITE_BATCH_SIZE,
+        max_delay: Optional[float] = HTTP_CACHE_WRITE_MAX_DELAY,
+        codec: BodyCodec = BodyCodec.lz4,
+        dicts: Optional[ZstdDictionaries] = None,
+        dedup: bool = False,
+    ) -> None:
+        assert batch_size > 0, f"{batch_size=}"
+        self.client: redis.StrictRedis = client
+        self.http_cache_key: str = http_cache_key
+        self.http_date_key: str = http_date_key
+        self.batch_size: int = batch_size
+        self.max_delay: Optional[float] = max_delay
+        self.codec: BodyCodec = codec
+        self.dicts: Optional[ZstdDictionaries] = dicts
+        # store bodies once per digest, see `dedup.py`
+        self.dedup: bool = dedup
+
+        self.nwritten: int = 0
+        self._buffer: List[Response] = []
+        self._first_added: float = 0.0
+        # scrapy can call storage methods from its thread pool
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def __enter__(self) -> "RedisCacheWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.flush()
+
+    def _is_due(self) -> bool:
+        if len(self._buffer) >= self.batch_size:
+            return True
+
+        return (
+            self.max_delay is not None
+            and monotonic() - self._first_added >= self.max_delay
+        )
+
+    def add(self, response: Response) -> None:
+        with self._lock:
+            if not self._buffer:
+                self._first_added = monotonic()
+            self._buffer.append(response)
+            if not self._is_due():
+                return
+
+            batch, self._buffer = self._buffer, []
+
+        self._write(batch)
+
+    def flush(self) -> int:
+        """Write all buffered responses, returns the number written."""
+        with self._lock:
+            batch, self._buffer = self._buffer, []
+
+        return self._write(batch)
+
+    def _write(self, batch: List[Response]) -> int:
+        if not batch:
+            return 0
+
+        args = (
+            self.client,
+            self.http_cache_key,
+            self.http_date_key,
+            batch,
+            self.codec,
+            self.dicts,
+        )
+        if self.dedup:
+            res = save_responses_dedup_redis(*args)
+            n: int = res.nstored + res.nunchanged
+        else:
+            n = save_compressed_responses_redis(*args)
+
+        self.nwritten += n
+        logger.debug(f"wrote {n:,} responses to `{self.http_cache_key}`")
+        return n
@@ -2,7 +2,7 @@ import logging
 import os
 from enum import Enum
 from sys import modules
-from typing import Final, List, Self
+from typing import Final, List, Optional, Self
 
 # pydantic v2
 # from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -163,6 +163,17 @@ class DBSettings(MyBaseSettings):
         vault_secret_path=DB_SETTINGS_PATH,
         vault_secret_key="async_connection_str",
     )
+    # optional read replica, read-only queries are routed here
+    db_replica_connection_str: Optional[SecretStr] = Field(
+        None,
+        vault_secret_path=DB_SETTINGS_PATH,
+        vault_secret_key="replica_connection_str",
+    )
+    db_async_replica_connection_str: Optional[SecretStr] = Field(
+        None,
+        vault_secret_path=DB_SETTINGS_PATH,
+        vault_secret_key="async_replica_connection_str",
+    )
     # db_exclude_tables: List[str]
 
     # class Config(MyBaseSettings.Config):
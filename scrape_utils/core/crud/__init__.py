@@ -1,3 +1,8 @@
+from .metadata import *
+from .counts import *
+from .keyset import *
 from .base import *
+from .key_cache import *
 from .category_item import *
 from .scrape_item import *
+from .bulk_load import *
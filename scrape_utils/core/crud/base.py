@@ -2,23 +2,52 @@
 
 Base CRUD class
 """
-import importlib
 import logging
+from datetime import datetime
 from pprint import pformat
-from typing import Generic, Optional, Type
+from typing import (Any, AsyncIterator, Dict, Generic, List, Optional, Tuple,
+                    Type)
 from uuid import UUID
 
 from fastapi import HTTPException
 from fastapi import status as http_status
-from sqlalchemy import delete, func, select
+from pydantic import BaseModel
+from sqlalchemy import literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.postgresql.dml import Insert
 from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ...types import CreateType, ModelType, PatchType
+from ..settings import (KEYSET_PAGE_SIZE_DEFAULT, PG_MAX_BIND_PARAMS,
+                        UPSERT_MANY_CHUNK_SIZE_DEFAULT)
 from .base_abc import BaseCRUDABC
+from .counts import CountMode, count_items
+from .keyset import KeysetOrder
+from .metadata import get_model_meta
 
 logger = logging.getLogger(__name__)
 
 
+class UpsertManyResult(BaseModel):
+    """Primary keys written by `upsert_many`, split by outcome."""
+
+    created: List[Any] = []
+    updated: List[Any] = []
+    # only used by CRUDs that skip writes for unchanged rows
+    unchanged: List[Any] = []
+
+    def extend(self, other: "UpsertManyResult") -> None:
+        self.created.extend(other.created)
+        self.updated.extend(other.updated)
+        self.unchanged.extend(other.unchanged)
+
+
+def model_to_row(instance: SQLModel) -> dict:
+    """Get the column values of a model instance, for use in Core statements."""
+    return {c.name: getattr(instance, c.name) for c in instance.__table__.columns}
+
+
 class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
     """BaseCRUD class that implements base functionality for CRUD operations of any SQLModel model."""
 
@@ -46,54 +75,26 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
             raise Exception("Derived class must set the 'model' attribute")
         super().__init_subclass__(**kwargs)
 
-    # TODO: make this work with class variable: `model`, set in events.crud
-    # dynamically determine the PatchType
-    @classmethod
-    def _get_patch_model(cls) -> Type:
-        model_name = cls.model.__name__
-        module_name = cls.model.__module__
-        patch_model_name = f"{model_name}Patch"
-        patch_module = importlib.import_module(module_name)
-        try:
-            PatchModel = getattr(patch_module, patch_model_name)
-        except AttributeError:
-            logger.error(f"please implement `{patch_model_name}` for {module_name}")
-            raise
-
-        return PatchModel
-
     @property
     def PatchModel(self) -> Type:
         # if not hasattr(self, "_cached_patch_type"):
         #     self._cached_patch_model = self._get_patch_model()
         return self._cached_patch_model
 
-    # TODO: try to cache the method
     @classmethod
     # def _id_attr_name(cls, model: Type[ModelType]) -> str:
     def _id_attr_name(cls, other_model: Optional[Type[ModelType]] = None) -> str:
         """Get `id` attribute name.
 
-        for UUIDModels `id` is called `uuid`, otherwise `id`
+        for UUIDModels `id` is called `uuid`, otherwise `id`. Cached per model, see `metadata.py`
         """
-        model = other_model or cls.model
-
-        assert isinstance(model, type), f"should pass a class"
-
-        assert issubclass(model, SQLModel), f"{model} should be a subclass of SQLModel"
-
-        # logger.info(f"{model=} {type(model)=}")
-
-        # return  id attribute name
-        primary_keys: list = model.__table__.primary_key.columns.items()
-        if len(primary_keys) != 1:
+        meta = get_model_meta(other_model or cls.model)
+        if meta.id_attr is None:
             raise NotImplementedError(
-                f"only single primary key is supported. {len(primary_keys)=} {primary_keys=}"
+                f"only single primary key is supported. {len(meta.primary_keys)=} {meta.primary_keys=}"
             )
 
-        attr_name: str = primary_keys[0][0]
-        assert isinstance(attr_name, str), f"{attr_name=} {type(attr_name)=}"
-        return attr_name
+        return meta.id_attr
 
     @classmethod
     def _get_id_attr(
@@ -104,6 +105,25 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
 
         return getattr(instance, id_attr)
 
+    def _read_session(self, primary: bool = False) -> AsyncSession:
+        """Get session for read-only queries.
+
+        Uses the read replica, unless `primary` is set or this CRUD already wrote
+        and `read_your_writes` is set, since the replica can lag behind
+        """
+        if (
+            primary
+            or self.read_session is None
+            or (self.read_your_writes and self._has_written)
+        ):
+            return self.session
+
+        return self.read_session
+
+    async def _commit(self) -> None:
+        self._has_written = True
+        await self.session.commit()
+
     async def create(self, data: CreateType, **kwargs) -> ModelType:
         """Create a model instance.
 
@@ -117,7 +137,7 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
         self.session.add(instance)
 
         try:
-            await self.session.commit()
+            await self._commit()
         except Exception as e:
             logger.warning(f"cannot create `{self.model.__tablename__}` item.")
             raise
@@ -125,17 +145,18 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
         await self.session.refresh(instance)
         return instance
 
-    async def get(self, model_id: str | UUID) -> ModelType:
-        """Get a model instance."""
+    async def get(self, model_id: str | UUID, primary: bool = False) -> ModelType:
+        """Get a model instance.
+
+        Pass `primary=True` to read from the primary, e.g. before modifying the instance
+        """
         assert isinstance(model_id, (str, UUID)), f"{type(model_id)=}"
         # id_attr = self._id_attr_name()
         # logger.info(f"{model_id=}")
         # statement = select(self.model).where(self.model.uuid == model_id)
-        statement = select(self.model).where(
-            self._get_id_attr(self.model) == str(model_id)
+        results = await self._read_session(primary).execute(
+            self.meta.select_by_id, {"model_id": str(model_id)}
         )
-        # statement = select(self.model).where(id_attr == model_id)
-        results = await self.session.execute(statement=statement)
         # logger.info(f"{results=}")
         # logger.info(f"{dir(results)=}")
         # logger.info(f"{len(results.fetchall())=}")
@@ -147,21 +168,29 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
             )
         return instance
 
-    async def upsert(self, data: CreateType, **kwargs) -> ModelType:
-        """Create or patch a model instance."""
-        # check if exists
+    async def _get_by_upsert_key(self, value) -> Optional[ModelType]:
+        """Get a model instance by its `upsertKey` value, or None if it does not exist."""
         result = await self.session.execute(
-            select([self.model]).where(
-                getattr(self.model, self.upsertKey) == getattr(data, self.upsertKey)
-            )
+            self.meta.select_by_upsert_key(self.upsertKey), {"key": value}
         )
         # logger.warning(f"{dir(result)=}")
         item_res = result.one_or_none()
         # assert isinstance(item, Event)
         # logger.info(f"{item_res=} \n{type(item_res)=}")
+        if item_res is None:
+            return None
+
+        return item_res[0]
+
+    async def upsert(self, data: CreateType, **kwargs) -> ModelType:
+        """Create or patch a model instance."""
+        # check if exists
+        item: Optional[ModelType] = await self._get_by_upsert_key(
+            getattr(data, self.upsertKey)
+        )
 
         # no, create it
-        if item_res is None:
+        if item is None:
             instance: ModelType = await self.create(data, **kwargs)
             # logger.info(f"{dir(instance)=}")
             logger.info(
@@ -170,7 +199,6 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
             return instance
 
         # yes, patch it
-        item: ModelType = item_res[0]
         # logger.info(f"updating {item.uuid=}")
         logger.info(f"updating {item.__tablename__} id={self._get_id_attr(item)}")
         # typecast create to patch object
@@ -182,32 +210,218 @@ class BaseCRUD(BaseCRUDABC, Generic[ModelType]):
 
         return await self.patch(self._get_id_attr(item), data=data_patch, **kwargs)
 
+    def _upsert_rows(self, data: List[CreateType], **kwargs) -> List[dict]:
+        """Build table rows for `upsert_many`.
+
+        Rows are deduplicated on `upsertKey`, the last one wins,
+        since postgres cannot update the same row twice in one statement
+        """
+        rows: Dict[Any, dict] = {}
+        for d in data:
+            row: dict = model_to_row(self.model(**d.dict(), **kwargs))
+            rows[row[self.upsertKey]] = row
+
+        return list(rows.values())
+
+    def _on_conflict_where(self, statement: Insert):
+        """Return an optional condition for updating conflicting rows in `upsert_many`."""
+        return None
+
+    def _upsert_many_statement(self, rows: List[dict]) -> Insert:
+        """Create a multi-row INSERT .. ON CONFLICT (upsertKey) DO UPDATE statement."""
+        table = self.meta.table
+        id_col = self.meta.id_col
+        statement = pg_insert(table).values(rows)
+        update_cols: dict = {
+            c.name: statement.excluded[c.name]
+            for c in table.columns
+            if c.name not in (id_col.name, self.upsertKey, "created_at")
+        }
+
+        return statement.on_conflict_do_update(
+            index_elements=[self.upsertKey],
+            set_=update_cols,
+            where=self._on_conflict_where(statement),
+        ).returning(
+            id_col,
+            table.c[self.upsertKey],
+            # xmax is only 0 for freshly inserted rows
+            literal_column("(xmax = 0)").label("inserted"),
+        )
+
+    async def _upsert_chunk(self, rows: List[dict]) -> UpsertManyResult:
+        """Upsert one chunk of rows in the current transaction."""
+        result = await self.session.execute(self._upsert_many_statement(rows))
+
+        res = UpsertManyResult()
+        for model_id, _, inserted in result.all():
+            (res.created if inserted else res.updated).append(model_id)
+
+        return res
+
+    async def upsert_many(
+        self,
+        data: List[CreateType],
+        chunk_size: int = UPSERT_MANY_CHUNK_SIZE_DEFAULT,
+        **kwargs,
+    ) -> UpsertManyResult:
+        """Create or update many model instances.
+
+        Uses one INSERT .. ON CONFLICT statement and one commit per chunk,
+        instead of several round trips per item
+        """
+        assert chunk_size > 0, f"{chunk_size=}"
+        rows: List[dict] = self._upsert_rows(data, **kwargs)
+        if not rows:
+            return UpsertManyResult()
+
+        # every column is a bind parameter
+        chunk_size = min(chunk_size, PG_MAX_BIND_PARAMS // len(rows[0]))
+
+        res = UpsertManyResult()
+        for i in range(0, len(rows), chunk_size):
+            try:
+                res.extend(await self._upsert_chunk(rows[i : i + chunk_size]))
+                await self._commit()
+            except Exception as e:
+                logger.warning(f"cannot upsert `{self.model.__tablename__}` chunk.")
+                await self.session.rollback()
+                raise
+
+        logger.info(
+            f"upserted {self.model.__tablename__}. {len(rows)=:,} {len(res.created)=:,} {len(res.updated)=:,} {len(res.unchanged)=:,}"
+        )
+        return res
+
     async def patch(self, model_id: str | UUID, data: PatchType, **kwargs) -> ModelType:
         """Patch a model instance."""
-        instance: ModelType = await self.get(model_id=model_id)
+        instance: ModelType = await self.get(model_id=model_id, primary=True)
         values = data.dict(exclude_unset=True)
 
         for k, v in values.items():
             setattr(instance, k, v)
 
         self.session.add(instance)
-        await self.session.commit()
+        await self._commit()
 
         logger.debug(f"PATCHED {model_id}")
         return instance
 
     async def delete(self, model_id: str | UUID) -> bool:
         """Delete a model instance."""
-        id_attr = self._id_attr_name()
-        statement = delete(self.model).where(id_attr == model_id)
-
-        await self.session.execute(statement=statement)
-        await self.session.commit()
+        await self.session.execute(self.meta.delete_by_id, {"model_id": model_id})
+        await self._commit()
 
         return True
 
-    async def nitem(self) -> Optional[int]:
-        """Return the number of items for the model in the database."""
-        query = select(func.count()).select_from(self.model)
-        result = await self.session.execute(query)
-        return result.scalar()
+    async def nitem(
+        self,
+        primary: bool = False,
+        mode: CountMode = CountMode.scan,
+        use_cache: bool = True,
+    ) -> Optional[int]:
+        """Return the number of items for the model in the database.
+
+        Use `CountMode.estimate` or `CountMode.exact` for frequently polled counts,
+        since a scan reads the full table
+        """
+        return await count_items(
+            self._read_session(primary),
+            self.model.__table__,
+            mode=mode,
+            use_cache=use_cache,
+        )
+
+    def _keyset_columns(self, order: KeysetOrder) -> Tuple:
+        table = self.meta.table
+        id_col = self.meta.id_col
+        if order == KeysetOrder.id:
+            return (id_col,)
+
+        assert "updated_at" in table.c, f"{self.model.__name__} has no `updated_at`"
+        return table.c.updated_at, id_col
+
+    def _keyset_value(self, instance: ModelType, order: KeysetOrder) -> Tuple:
+        return tuple(getattr(instance, c.key) for c in self._keyset_columns(order))
+
+    async def get_page(
+        self,
+        order: KeysetOrder = KeysetOrder.id,
+        after: Optional[Tuple] = None,
+        page_size: int = KEYSET_PAGE_SIZE_DEFAULT,
+        updated_after: Optional[datetime] = None,
+        updated_before: Optional[datetime] = None,
+        primary: bool = False,
+    ) -> Tuple[List[ModelType], Optional[Tuple]]:
+        """Get one page of model instances, ordered by keyset `order`.
+
+        `after` is the keyset value of the last item of the previous page.
+        Returns the items and the keyset value for the next page, None on the last page.
+        Ordering by `updated_at` needs an index on (updated_at, id) to stay fast
+        """
+        assert page_size > 0, f"{page_size=}"
+        table = self.meta.table
+        cols: Tuple = self._keyset_columns(order)
+
+        statement = select(self.model)
+        if updated_after is not None:
+            statement = statement.where(table.c.updated_at >= updated_after)
+        if updated_before is not None:
+            statement = statement.where(table.c.updated_at < updated_before)
+        if after is not None:
+            assert len(after) == len(cols), f"{after=} does not match {order=}"
+            statement = statement.where(tuple_(*cols) > tuple_(*after))
+
+        statement = statement.order_by(*cols).limit(page_size)
+        result = await self._read_session(primary).execute(statement)
+        items: List[ModelType] = list(result.scalars().all())
+
+        next_after: Optional[Tuple] = None
+        if len(items) == page_size:
+            next_after = self._keyset_value(items[-1], order)
+
+        return items, next_after
+
+    async def iter_pages(
+        self,
+        order: KeysetOrder = KeysetOrder.id,
+        after: Optional[Tuple] = None,
+        page_size: int = KEYSET_PAGE_SIZE_DEFAULT,
+        updated_after: Optional[datetime] = None,
+        updated_before: Optional[datetime] = None,
+        primary: bool = False,
+    ) -> AsyncIterator[List[ModelType]]:
+        """Iterate over the table in pages, with constant memory.
+
+        Each page is expunged from the session once the next page is requested,
+        so that the identity map does not grow
+
+        Usage:
+            async for books in crud.iter_pages(order=KeysetOrder.updated_at, updated_after=since):
+                export(books)
+        """
+        session: AsyncSession = self._read_session(primary)
+        while True:
+            items, after = await self.get_page(
+                order=order,
+                after=after,
+                page_size=page_size,
+                updated_after=updated_after,
+                updated_before=updated_before,
+                primary=primary,
+            )
+            if items:
+                yield items
+
+            for item in items:
+                if item in session:
+                    session.expunge(item)
+
+            if after is None:
+                return
+
+    async def iter_items(self, **kwargs) -> AsyncIterator[ModelType]:
+        """Iterate over all model instances, kwargs are passed to `iter_pages`."""
+        async for items in self.iter_pages(**kwargs):
+            for item in items:
+                yield item
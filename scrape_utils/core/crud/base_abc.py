@@ -2,7 +2,6 @@
 
 Base CRUD ABC class
 """
-import importlib
 import logging
 from abc import ABC, abstractmethod
 from typing import Generic, Optional, Type
@@ -11,6 +10,7 @@ from uuid import UUID
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ...types import CreateType, ModelType, PatchType
+from .metadata import ModelMeta, get_model_meta
 
 logger = logging.getLogger(__name__)
 
@@ -20,28 +20,36 @@ class BaseCRUDABC(ABC, Generic[ModelType]):
 
     model: Optional[Type[ModelType]] = None
 
-    def __init__(self, session: AsyncSession, upsertKey: str) -> None:
+    def __init__(
+        self,
+        session: AsyncSession,
+        upsertKey: str,
+        read_session: Optional[AsyncSession] = None,
+        read_your_writes: bool = True,
+    ) -> None:
         self.session: AsyncSession = session
+        # optional read replica session, for read-only queries
+        self.read_session: Optional[AsyncSession] = read_session
+        self.read_your_writes: bool = read_your_writes
+        self._has_written: bool = False
         # logger.info(f"{dir(self.model)=}")
         # assert hasattr(
         #     model, upsertKey
         # ), f"{upsertKey=} not in {model=}. Use a different upsertKey"
         self.upsertKey: str = upsertKey
+        self.meta: ModelMeta = get_model_meta(self.model)
         self._cached_patch_model = self._get_patch_model()
 
-    # TODO: make this work with class variable: `model`, set in events.crud
-    # dynamically determine the PatchType
+    # dynamically determine the PatchType, once per model
     @classmethod
     def _get_patch_model(cls) -> Type:
-        model_name = cls.model.__name__
-        module_name = cls.model.__module__
-        patch_model_name = f"{model_name}Patch"
-        patch_module = importlib.import_module(module_name)
-        try:
-            PatchModel = getattr(patch_module, patch_model_name)
-        except AttributeError:
-            logger.error(f"please implement `{patch_model_name}` for {module_name}")
-            raise
+        PatchModel: Optional[Type] = get_model_meta(cls.model).PatchModel
+        if PatchModel is None:
+            patch_model_name = f"{cls.model.__name__}Patch"
+            logger.error(
+                f"please implement `{patch_model_name}` for {cls.model.__module__}"
+            )
+            raise AttributeError(patch_model_name)
 
         return PatchModel
 
@@ -0,0 +1,215 @@
+"""bulk_load.py.
+
+COPY based bulk loader for scrape items
+"""
+import logging
+from itertools import count
+from typing import Iterable, List, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import (BigInteger, Column, MetaData, String, Table, cast,
+                        false, func, insert, literal, literal_column, select,
+                        text, union_all, update)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from ...models.scrape.scrape_update import (ScrapeUpdate,
+                                            ensure_current_partitions)
+from ...types import CreateType
+from ..settings import COPY_CHUNK_SIZE_DEFAULT
+from .base import model_to_row
+from .scrape_item import ScrapeItemCRUD, ScrapeUpdatePolicy
+
+logger = logging.getLogger(__name__)
+
+# keeps the input order in the staging table, so that the last duplicate wins
+SEQ_COLUMN: str = "_seq"
+
+
+class BulkLoadResult(BaseModel):
+    nstaged: int = 0
+    ncreated: int = 0
+    nupdated: int = 0
+    nunchanged: int = 0
+    nscrape_update: int = 0
+
+
+class ScrapeItemBulkLoader:
+    """Load scrape items at COPY speed, for backfills and replays of .jl dumps.
+
+    Rows are streamed with asyncpg `copy_records_to_table` into a temporary staging
+    table, then merged into the target table and `scrape_updates` with one statement.
+    Same semantics as `ScrapeItemCRUD.upsert_many`: unchanged `content_hash` only sets `last_seen`
+
+    Usage:
+        crud = BookCRUD(session)
+        res = await ScrapeItemBulkLoader(crud).load(books)
+    """
+
+    def __init__(
+        self, crud: ScrapeItemCRUD, chunk_size: int = COPY_CHUNK_SIZE_DEFAULT
+    ) -> None:
+        assert isinstance(crud, ScrapeItemCRUD), f"{type(crud)=}"
+        assert chunk_size > 0, f"{chunk_size=}"
+        self.crud: ScrapeItemCRUD = crud
+        self.chunk_size: int = chunk_size
+
+        self.table: Table = crud.meta.table
+        self.columns: List[str] = [c.name for c in self.table.columns]
+        self.staging: Table = self._staging_table()
+
+    def _staging_table(self) -> Table:
+        """Create staging table definition, column types come from the model metadata."""
+        return Table(
+            f"{self.table.name}_staging",
+            MetaData(),
+            *[Column(c.name, c.type) for c in self.table.columns],
+            Column(SEQ_COLUMN, BigInteger, nullable=False),
+            prefixes=["TEMPORARY"],
+            postgresql_on_commit="DROP",
+        )
+
+    def _record(self, data: CreateType | dict, seq: int) -> Tuple:
+        """Build a COPY record, applying model defaults and the content fingerprint."""
+        values: dict = data if isinstance(data, dict) else data.dict()
+        values = {**values, "content_hash": self.crud._content_hash(values)}
+        row: dict = model_to_row(self.crud.model(**values))
+
+        return tuple(row[c] for c in self.columns) + (seq,)
+
+    def _latest_statement(self):
+        """Select the last staged row per upsertKey."""
+        staging = self.staging
+        key: str = self.crud.upsertKey
+        return (
+            select(*[staging.c[c] for c in self.columns])
+            .distinct(staging.c[key])
+            .order_by(staging.c[key], staging.c[SEQ_COLUMN].desc())
+        )
+
+    def _merge_statement(self):
+        """Merge staging into target table and `scrape_updates` with one statement."""
+        table = self.table
+        key: str = self.crud.upsertKey
+        id_col = self.crud.meta.id_col
+
+        src = self._latest_statement()
+        latest = src.subquery("latest")
+
+        statement = pg_insert(table).from_select(self.columns, src)
+        upserted = (
+            statement.on_conflict_do_update(
+                index_elements=[key],
+                set_={
+                    c: statement.excluded[c]
+                    for c in self.columns
+                    if c not in (id_col.name, key, "created_at")
+                },
+                where=table.c.content_hash.is_distinct_from(
+                    statement.excluded.content_hash
+                ),
+            )
+            .returning(
+                id_col.label("id"), literal_column("(xmax = 0)").label("inserted")
+            )
+            .cte("upserted")
+        )
+
+        # rows with the same fingerprint were skipped by the upsert, so both sets are disjoint
+        touched = (
+            update(table)
+            .where(table.c[key] == latest.c[key])
+            .where(table.c.content_hash == latest.c.content_hash)
+            .values(**self.crud._seen_values())
+            .returning(id_col.label("id"))
+            .cte("touched")
+        )
+
+        updated_ids = select(upserted.c.id)
+        if self.crud.scrape_update_policy == ScrapeUpdatePolicy.always:
+            updated_ids = union_all(updated_ids, select(touched.c.id))
+        elif self.crud.scrape_update_policy == ScrapeUpdatePolicy.never:
+            updated_ids = updated_ids.where(false())
+        updated_ids = updated_ids.subquery("updated_ids")
+
+        scrape_updates = (
+            insert(ScrapeUpdate.__table__)
+            .from_select(
+                ["uuid", "scrape_base_id", "scrape_type"],
+                select(
+                    func.gen_random_uuid(),
+                    cast(updated_ids.c.id, String),
+                    literal(table.name),
+                ),
+            )
+            .returning(literal_column("1"))
+            .cte("scrape_updates_inserted")
+        )
+
+        def _count(cte, *where):
+            return select(func.count()).select_from(cte).where(*where).scalar_subquery()
+
+        return select(
+            _count(upserted, upserted.c.inserted).label("ncreated"),
+            _count(upserted, ~upserted.c.inserted).label("nupdated"),
+            _count(touched).label("nunchanged"),
+            _count(scrape_updates).label("nscrape_update"),
+        )
+
+    async def load(self, data: Iterable[CreateType | dict]) -> BulkLoadResult:
+        """Stream `data` through COPY into staging, and merge it in one transaction."""
+        session = self.crud.session
+        conn = await session.connection()
+        await conn.run_sync(lambda sync_conn: self.staging.create(sync_conn))
+
+        # asyncpg connection, inside the transaction that sqlalchemy started
+        raw_conn = await conn.get_raw_connection()
+        driver_conn = raw_conn.driver_connection
+
+        res = BulkLoadResult()
+        seq = count()
+        chunk: List[Tuple] = []
+
+        async def _copy() -> None:
+            await driver_conn.copy_records_to_table(
+                self.staging.name,
+                records=chunk,
+                columns=self.columns + [SEQ_COLUMN],
+            )
+            res.nstaged += len(chunk)
+            logger.info(f"copied {res.nstaged:,} rows to `{self.staging.name}`")
+            chunk.clear()
+
+        try:
+            for item in data:
+                chunk.append(self._record(item, next(seq)))
+                if len(chunk) >= self.chunk_size:
+                    await _copy()
+
+            if chunk:
+                await _copy()
+
+            await session.execute(text(f"ANALYZE {self.staging.name}"))
+            await ensure_current_partitions(session)
+            await self.crud._before_bulk_merge(
+                self._latest_statement().subquery("latest")
+            )
+
+            result = await session.execute(self._merge_statement())
+            (
+                res.ncreated,
+                res.nupdated,
+                res.nunchanged,
+                res.nscrape_update,
+            ) = result.one()
+
+            # drops the staging table
+            await self.crud._commit()
+
+        except Exception as e:
+            logger.warning(f"cannot bulk load `{self.table.name}` items.")
+            await session.rollback()
+            raise
+
+        logger.info(f"bulk loaded {self.table.name}. {res}")
+
+        return res
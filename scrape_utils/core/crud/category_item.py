@@ -2,17 +2,30 @@
 
 CategoryItem CRUD class
 """
-import importlib
+import asyncio
 import logging
-from typing import Generic, List, Optional, Type
+from typing import Any, Awaitable, Dict, Generic, List, Optional, Tuple, Type
 
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import make_transient_to_detached
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ...types import ModelType
+from ...utils.lru import LRUCache
+from ..settings import (CATEGORY_CACHE_MAXSIZE_DEFAULT,
+                        CATEGORY_CACHE_TTL_DEFAULT)
+from .base import model_to_row
+from .metadata import get_model_meta
 
 logger = logging.getLogger(__name__)
 
+# upsertKey -> row, per (model, upsertKey, maxsize, ttl)
+_row_caches: Dict[Tuple[type, str, int, float], LRUCache] = {}
+
+# a conflicting row can be deleted before it is selected, then it is inserted again
+CREATE_ATTEMPTS: int = 3
+
 
 class CategoryItemCRUD(Generic[ModelType]):
     """Implements functionality for working with category items.
@@ -22,27 +35,35 @@ class CategoryItemCRUD(Generic[ModelType]):
 
     model: Optional[Type[ModelType]] = None
 
-    def __init__(self, session: AsyncSession, upsertKey: str) -> None:
+    def __init__(
+        self,
+        session: AsyncSession,
+        upsertKey: str,
+        cache_maxsize: int = CATEGORY_CACHE_MAXSIZE_DEFAULT,
+        cache_ttl: float = CATEGORY_CACHE_TTL_DEFAULT,
+    ) -> None:
         self.session: AsyncSession = session
         self.upsertKey: str = upsertKey
         self._cached_create_model = self._get_create_model()
+        self._row_cache: LRUCache = self._get_row_cache(
+            upsertKey, maxsize=cache_maxsize, ttl=cache_ttl
+        )
 
     def __init_subclass__(cls, **kwargs):
         if not hasattr(cls, "model"):
             raise Exception("Derived class must set the 'model' attribute")
         super().__init_subclass__(**kwargs)
 
+    # dynamically determine the CreateType, once per model
     @classmethod
     def _get_create_model(cls) -> Type:
-        model_name = cls.model.__name__
-        module_name = cls.model.__module__
-        create_model_name = f"{model_name}Create"
-        create_module = importlib.import_module(module_name)
-        try:
-            CreateModel = getattr(create_module, create_model_name)
-        except AttributeError:
-            logger.error(f"please implement `{create_model_name}` for {module_name}")
-            raise
+        CreateModel: Optional[Type] = get_model_meta(cls.model).CreateModel
+        if CreateModel is None:
+            create_model_name = f"{cls.model.__name__}Create"
+            logger.error(
+                f"please implement `{create_model_name}` for {cls.model.__module__}"
+            )
+            raise AttributeError(create_model_name)
 
         return CreateModel
 
@@ -52,56 +73,159 @@ class CategoryItemCRUD(Generic[ModelType]):
         #     self._cached_create_model = self._get_create_model()
         return self._cached_create_model
 
+    @classmethod
+    def _get_row_cache(cls, upsertKey: str, maxsize: int, ttl: float) -> LRUCache:
+        """Get process-wide row cache, shared by CRUD instances with the same limits."""
+        key: Tuple[type, str, int, float] = (cls.model, upsertKey, maxsize, ttl)
+        if key not in _row_caches:
+            _row_caches[key] = LRUCache(maxsize=maxsize, ttl=ttl)
+
+        return _row_caches[key]
+
+    def _to_session_instance(self, row: dict) -> Awaitable[ModelType]:
+        """Attach a known row to the session, without querying the database."""
+        instance: ModelType = self.model(**row)
+        make_transient_to_detached(instance)
+        return self.session.merge(instance, load=False)
+
     async def get_create_batch(
         self,
         data: List[ModelType],
         refresh=True,
     ) -> List[ModelType]:
-        """Get or create a batch of category items."""
-        # Get all existing items that match the list of names
-        # query = select(self.model).where(self.model.name.in_([d.name for d in data]))
-        # attr_col = self.model.__table__.c.name
-        attr_col = getattr(self.model.__table__.c, self.upsertKey)
-        # query = select(self.model).where(name_col.in_([d.name for d in data]))
-        query = select(self.model).where(
-            attr_col.in_([getattr(d, self.upsertKey) for d in data])
-        )
-        existing_instances = await self.session.execute(query)
-        existing_instances = existing_instances.scalars().all()
+        """Get or create a batch of category items.
+
+        Known items are served from the in-process cache, without queries.
+        Missing items are inserted with INSERT .. ON CONFLICT DO NOTHING, so concurrent workers
+        never fail on duplicates. Items that another worker created are selected afterwards.
+        Requires a unique constraint on `upsertKey`
+        """
+        table = self.model.__table__
+        key_col = table.c[self.upsertKey]
+
+        # deduplicate on upsertKey, keeping the order
+        data_by_key: Dict[Any, ModelType] = {}
+        for d in data:
+            data_by_key.setdefault(getattr(d, self.upsertKey), d)
+
+        rows: Dict[Any, dict] = {}
+        for key in data_by_key:
+            row: Optional[dict] = self._row_cache.get(key)
+            if row is not None:
+                rows[key] = row
+
+        missing: List[Any] = [k for k in data_by_key if k not in rows]
+
+        if missing:
+            created: Dict[Any, dict] = {}
+            todo: List[Any] = missing
+            for _ in range(CREATE_ATTEMPTS):
+                result = await self.session.execute(
+                    pg_insert(table)
+                    .values(
+                        [
+                            model_to_row(self.model(**data_by_key[k].dict()))
+                            for k in todo
+                        ]
+                    )
+                    .on_conflict_do_nothing(index_elements=[self.upsertKey])
+                    .returning(*table.columns)
+                )
+                inserted: Dict[Any, dict] = {
+                    r[self.upsertKey]: dict(r) for r in result.mappings().all()
+                }
+                created |= inserted
+                rows |= inserted
+
+                # existed already, or were just created by another worker
+                conflicting: List[Any] = [k for k in todo if k not in inserted]
+                if conflicting:
+                    result = await self.session.execute(
+                        select(*table.columns).where(key_col.in_(conflicting))
+                    )
+                    rows |= {
+                        r[self.upsertKey]: dict(r) for r in result.mappings().all()
+                    }
+
+                todo = [k for k in conflicting if k not in rows]
+                if not todo:
+                    break
+
+            if todo:
+                await self.session.rollback()
+                raise LookupError(
+                    f"cannot get or create {self.model.__name__} rows for {todo}"
+                )
+
+            await self.session.commit()
+
+            for key in missing:
+                self._row_cache.set(key, rows[key])
+
+            logger.info(
+                f"creating {self.model.__table__}. {len(data)=} {len(missing)=} {len(created)=}"
+            )
 
-        # Create new instances for items that don't exist
-        existing_names = {i.name for i in existing_instances}
-        new_instances = [
-            self.model(**d.dict()) for d in data if d.name not in existing_names
-        ]
+        return [await self._to_session_instance(rows[key]) for key in data_by_key]
 
-        logger.info(
-            f"creating {self.model.__table__}. {len(data)=} {len(existing_instances)=} {len(new_instances)=}"
-        )
 
-        # Bulk save the new instances to the database
-        if new_instances:
-            self.session.add_all(new_instances)
-
-        await self.session.commit()
+async def create_category_mappings(item: dict, categories: dict) -> dict:
+    return (await create_category_mappings_batch([item], categories))[0]
 
-        # # Refresh all instances if requested
-        # if refresh:
-        #     for instance in existing_instances + new_instances:
-        #         await self.session.refresh(instance)
 
-        return existing_instances + new_instances
+async def create_category_mappings_batch(
+    items: List[dict], categories: dict
+) -> List[dict]:
+    """Create category mappings for a batch of items.
 
+    All category names across `items` are resolved with one `get_create_batch` call
+    per category type. Category types that use different sessions are resolved concurrently
+    """
 
-async def create_category_mappings(item: dict, categories: dict) -> dict:
-    to_return = {}
+    async def _resolve(cat: str) -> Dict[str, ModelType]:
+        mapping: dict = categories[cat]
+        # ordered set of names
+        names: Dict[str, None] = {}
+        for item in items:
+            names |= dict.fromkeys(item["item"].get(cat, []))
+
+        if not names:
+            return {}
+
+        logger.info(f"n{cat} in {len(items):,} items: {len(names):,}")
+
+        # create genres first in a batch
+        crud: CategoryItemCRUD = mapping["crud"]
+        data: List[ModelType] = [mapping["create_model"](name=n) for n in names]
+        instances: List[ModelType] = await crud.get_create_batch(data)
+        # rows are deduplicated on upsertKey, so map them back on it as well
+        by_key: Dict[Any, ModelType] = {
+            getattr(i, crud.upsertKey): i for i in instances
+        }
+        return {n: by_key[getattr(d, crud.upsertKey)] for n, d in zip(names, data)}
+
+    async def _resolve_sequential(cats: List[str]) -> Dict[str, Dict[str, ModelType]]:
+        return {cat: await _resolve(cat) for cat in cats}
+
+    # a session cannot run concurrent queries, so group category types by session
+    cats_by_session: Dict[int, List[str]] = {}
     for cat, mapping in categories.items():
-        if cat in item["item"]:
-            logger.info(f"n{cat} in {item['type']}: {len(item['item'][cat])}")
-
-            # create genres first in a batch
-            to_return[cat] = await mapping["crud"].get_create_batch(
-                [mapping["create_model"](name=n) for n in item["item"][cat]]
-            )
+        cats_by_session.setdefault(id(mapping["crud"].session), []).append(cat)
+
+    resolved: Dict[str, Dict[str, ModelType]] = {}
+    for res in await asyncio.gather(
+        *[_resolve_sequential(cats) for cats in cats_by_session.values()]
+    ):
+        resolved |= res
+
+    to_return: List[dict] = []
+    for item in items:
+        item_mappings: dict = {}
+        for cat in categories:
+            if cat in item["item"]:
+                item_mappings[cat] = [
+                    resolved[cat][n] for n in dict.fromkeys(item["item"][cat])
+                ]
+        to_return.append(item_mappings)
 
     return to_return
@@ -0,0 +1,200 @@
+"""counts.py.
+
+Cheap item counts for CRUD classes
+
+`CountMode.scan` runs a full `count(*)`, `CountMode.estimate` reads planner statistics,
+and `CountMode.exact` sums counters that statement-level triggers keep up to date
+"""
+import logging
+from enum import Enum
+from typing import List, Optional
+
+from sqlalchemy import BigInteger, Column, Integer, String, func, select, text
+from sqlalchemy.sql.schema import Table
+from sqlmodel import Field, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ...utils.lru import LRUCache
+from ..settings import (COUNT_CACHE_MAXSIZE, COUNT_CACHE_TTL_DEFAULT,
+                        COUNTER_NSHARD)
+
+logger = logging.getLogger(__name__)
+
+COUNT_TRIGGER_FUNCTION: str = "item_counts_update"
+
+# (table name, mode) -> estimated count, or the scan when no estimate or counter exists
+_count_cache = LRUCache(COUNT_CACHE_MAXSIZE, ttl=COUNT_CACHE_TTL_DEFAULT)
+
+
+class CountMode(str, Enum):
+    # full table scan, always exact
+    scan = "scan"
+    # planner statistics, as accurate as the last ANALYZE / autovacuum
+    estimate = "estimate"
+    # trigger maintained counters, see `install_count_triggers`
+    exact = "exact"
+
+
+class ItemCount(SQLModel, table=True):
+    """Sharded row counter per table, the count is the sum over all shards."""
+
+    __tablename__ = "item_counts"
+
+    table_name: str = Field(sa_column=Column(String(255), primary_key=True))
+    shard: int = Field(sa_column=Column(Integer, primary_key=True))
+    nitem: int = Field(sa_column=Column(BigInteger, nullable=False))
+
+
+def _count_function_ddl() -> str:
+    return f"""
+CREATE OR REPLACE FUNCTION {COUNT_TRIGGER_FUNCTION}() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    delta bigint;
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM {ItemCount.__tablename__} WHERE table_name = TG_TABLE_NAME;
+        RETURN NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+        SELECT count(*) INTO delta FROM new_rows;
+    ELSE
+        SELECT -count(*) INTO delta FROM old_rows;
+    END IF;
+
+    IF delta <> 0 THEN
+        INSERT INTO {ItemCount.__tablename__} (table_name, shard, nitem)
+        VALUES (TG_TABLE_NAME, floor(random() * {COUNTER_NSHARD})::int, delta)
+        ON CONFLICT (table_name, shard)
+        DO UPDATE SET nitem = {ItemCount.__tablename__}.nitem + excluded.nitem;
+    END IF;
+    RETURN NULL;
+END
+$$"""
+
+
+def _count_trigger_ddls(table_name: str) -> List[str]:
+    return [
+        f"DROP TRIGGER IF EXISTS {table_name}_count_insert ON {table_name}",
+        f"DROP TRIGGER IF EXISTS {table_name}_count_delete ON {table_name}",
+        f"DROP TRIGGER IF EXISTS {table_name}_count_truncate ON {table_name}",
+        # rows updated by INSERT .. ON CONFLICT DO UPDATE are not in `new_rows`
+        f"CREATE TRIGGER {table_name}_count_insert AFTER INSERT ON {table_name} "
+        f"REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION {COUNT_TRIGGER_FUNCTION}()",
+        f"CREATE TRIGGER {table_name}_count_delete AFTER DELETE ON {table_name} "
+        f"REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION {COUNT_TRIGGER_FUNCTION}()",
+        f"CREATE TRIGGER {table_name}_count_truncate AFTER TRUNCATE ON {table_name} "
+        f"FOR EACH STATEMENT EXECUTE FUNCTION {COUNT_TRIGGER_FUNCTION}()",
+    ]
+
+
+async def refresh_counter(session: AsyncSession, table: Table) -> int:
+    """Reset the counters of `table` to its exact count, in the current transaction.
+
+    Blocks writes to `table` until commit, so that no trigger update gets lost
+    """
+    await session.execute(text(f"LOCK TABLE {table.name} IN SHARE MODE"))
+    nitem: int = (
+        await session.execute(select(func.count()).select_from(table))
+    ).scalar()
+
+    counts = ItemCount.__table__
+    await session.execute(counts.delete().where(counts.c.table_name == table.name))
+    await session.execute(
+        counts.insert().values(table_name=table.name, shard=0, nitem=nitem)
+    )
+    return nitem
+
+
+async def install_count_triggers(session: AsyncSession, table: Table) -> int:
+    """Install counter triggers on `table`, and initialize its counter.
+
+    Idempotent, also use it to reconcile counters in batch. Commits the transaction
+    """
+    try:
+        await session.execute(text(_count_function_ddl()))
+        nitem: int = await refresh_counter(session, table)
+        for ddl in _count_trigger_ddls(table.name):
+            await session.execute(text(ddl))
+        await session.commit()
+    except Exception as e:
+        logger.warning(f"cannot install count triggers on `{table.name}`")
+        await session.rollback()
+        raise
+
+    logger.info(f"installed count triggers on `{table.name}`. {nitem=:,}")
+    return nitem
+
+
+async def _scan_count(session: AsyncSession, table: Table) -> Optional[int]:
+    result = await session.execute(select(func.count()).select_from(table))
+    return result.scalar()
+
+
+async def _estimate_count(session: AsyncSession, table: Table) -> Optional[int]:
+    """Estimate the row count from `pg_class.reltuples`, of the leaf partitions if any.
+
+    Partitioned parents hold no rows themselves, and unanalyzed partitions are skipped.
+    Returns None if nothing was analyzed yet
+    """
+    result = await session.execute(
+        text(
+            "WITH RECURSIVE tree(oid) AS ("
+            "SELECT CAST(CAST(:name AS regclass) AS oid) UNION ALL "
+            "SELECT i.inhrelid FROM pg_inherits i JOIN tree t ON i.inhparent = t.oid) "
+            "SELECT sum(c.reltuples)::bigint FROM tree t JOIN pg_class c ON c.oid = t.oid "
+            "WHERE c.reltuples >= 0 "
+            "AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhparent = t.oid)"
+        ),
+        {"name": table.name},
+    )
+    return result.scalar()
+
+
+async def _counter_count(session: AsyncSession, table: Table) -> Optional[int]:
+    """Sum the trigger maintained counters, returns None if they are not installed."""
+    counts = ItemCount.__table__
+    result = await session.execute(
+        select(func.sum(counts.c.nitem)).where(counts.c.table_name == table.name)
+    )
+    nitem = result.scalar()
+    return None if nitem is None else int(nitem)
+
+
+async def count_items(
+    session: AsyncSession,
+    table: Table,
+    mode: CountMode = CountMode.scan,
+    use_cache: bool = True,
+) -> Optional[int]:
+    """Count rows of `table`.
+
+    `exact` counts are cheap to sum and never cached. Both `estimate` and `exact` fall
+    back to a scan when no statistics or counters exist, estimates and fallback scans
+    are cached for `COUNT_CACHE_TTL_DEFAULT` seconds
+    """
+    if mode == CountMode.scan:
+        return await _scan_count(session, table)
+
+    nitem: Optional[int] = None
+    if mode == CountMode.exact:
+        nitem = await _counter_count(session, table)
+        if nitem is not None:
+            return nitem
+
+    key = (table.name, mode)
+    if use_cache:
+        cached: Optional[int] = _count_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if mode == CountMode.estimate:
+        nitem = await _estimate_count(session, table)
+
+    if nitem is None:
+        logger.warning(
+            f"no {mode.value} count for `{table.name}`, falling back to a full scan"
+        )
+        nitem = await _scan_count(session, table)
+
+    _count_cache.set(key, nitem)
+    return nitem
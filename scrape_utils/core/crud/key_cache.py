@@ -0,0 +1,106 @@
+"""key_cache.py.
+
+Upsert key to primary key cache for CRUD classes
+"""
+import logging
+from typing import Any, Dict, Iterable, Optional
+
+from redis import asyncio as aioredis
+from sqlalchemy.sql import Select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ...utils.lru import LRUCache
+from ..settings import (UPSERT_KEY_CACHE_KEY_FORMAT,
+                        UPSERT_KEY_CACHE_MAXSIZE_DEFAULT,
+                        UPSERT_KEY_CACHE_WARM_CHUNK_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+class UpsertKeyCache:
+    """Map upsert keys (e.g. urls) to primary keys.
+
+    Lookups go to an in-process LRU first, then to an optional Redis hash
+    that is shared by all workers. Primary keys are stored as strings
+
+    Usage:
+        key_cache = UpsertKeyCache("book", redis=redis_connection(pool))
+        crud = BookCRUD(session, key_cache=key_cache)
+        await crud.warm_key_cache()
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = UPSERT_KEY_CACHE_MAXSIZE_DEFAULT,
+        ttl: Optional[float] = None,
+        redis: Optional[aioredis.Redis] = None,
+    ) -> None:
+        self.name: str = name
+        self.lru = LRUCache(maxsize, ttl=ttl)
+        self.redis: Optional[aioredis.Redis] = redis
+        self.redis_key: str = UPSERT_KEY_CACHE_KEY_FORMAT.format(name=name)
+
+    async def get(self, key: Any) -> Optional[str]:
+        model_id: Optional[str] = self.lru.get(key)
+        if model_id is not None or self.redis is None:
+            return model_id
+
+        model_id = await self.redis.hget(self.redis_key, key)
+        if model_id is None:
+            return None
+
+        if isinstance(model_id, bytes):
+            model_id = model_id.decode()
+        self.lru.set(key, model_id)
+        return model_id
+
+    async def set(self, key: Any, model_id: Any) -> None:
+        await self.set_many({key: model_id})
+
+    async def set_many(self, mapping: Dict[Any, Any]) -> None:
+        if not mapping:
+            return
+
+        mapping = {k: str(v) for k, v in mapping.items()}
+        for k, v in mapping.items():
+            self.lru.set(k, v)
+
+        if self.redis is not None:
+            await self.redis.hset(self.redis_key, mapping=mapping)
+
+    async def delete(self, key: Any) -> None:
+        await self.delete_many([key])
+
+    async def delete_many(self, keys: Iterable[Any]) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+
+        for k in keys:
+            self.lru.delete(k)
+
+        if self.redis is not None:
+            await self.redis.hdel(self.redis_key, *keys)
+
+    async def clear(self) -> None:
+        self.lru.clear()
+        if self.redis is not None:
+            await self.redis.delete(self.redis_key)
+
+    async def warm(
+        self,
+        session: AsyncSession,
+        statement: Select,
+        chunk_size: int = UPSERT_KEY_CACHE_WARM_CHUNK_SIZE,
+    ) -> int:
+        """Fill the cache from `statement`, which selects (upsert key, primary key) rows."""
+        assert chunk_size > 0, f"{chunk_size=}"
+        n: int = 0
+        result = await session.stream(statement)
+        async for rows in result.partitions(chunk_size):
+            await self.set_many({key: model_id for key, model_id in rows})
+            n += len(rows)
+
+        logger.info(f"warmed upsert key cache `{self.name}` with {n:,} keys")
+        return n
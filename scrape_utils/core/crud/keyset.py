@@ -0,0 +1,68 @@
+"""keyset.py.
+
+Keyset pagination helpers for CRUD classes
+
+A cursor holds the sort key values of the last row of a page, encoded as urlsafe base64 json
+"""
+import base64
+import json
+import logging
+from datetime import datetime
+from enum import Enum
+from typing import Any, Generic, List, Optional, Tuple, TypeVar
+
+from pydantic.generics import GenericModel
+
+logger = logging.getLogger(__name__)
+
+ItemT = TypeVar("ItemT")
+
+
+class KeysetOrder(str, Enum):
+    # primary key
+    id = "id"
+    # (updated_at, primary key), e.g. for incremental exports
+    updated_at = "updated_at"
+
+
+class KeysetPage(GenericModel, Generic[ItemT]):
+    items: List[ItemT]
+    # None on the last page
+    next_cursor: Optional[str] = None
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    # UUID and other id types
+    return str(value)
+
+
+def encode_cursor(values: Tuple) -> str:
+    raw: bytes = json.dumps(list(values), default=_json_default).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str, order: KeysetOrder) -> Tuple:
+    """Decode a cursor for `order`, raises ValueError for malformed cursors."""
+    try:
+        values: list = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception as e:
+        raise ValueError(f"malformed cursor {cursor=}") from e
+
+    nvalue: int = 2 if order == KeysetOrder.updated_at else 1
+    if not isinstance(values, list) or len(values) != nvalue:
+        raise ValueError(f"cursor does not match {order=}")
+
+    # ids are encoded as int, or as str for UUID and other id types
+    model_id: Any = values[-1]
+    if isinstance(model_id, bool) or not isinstance(model_id, (int, str)):
+        raise ValueError(f"malformed cursor id {model_id=}")
+
+    if order == KeysetOrder.updated_at:
+        try:
+            values[0] = datetime.fromisoformat(values[0])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"malformed cursor updated_at {values[0]=}") from e
+
+    return tuple(values)
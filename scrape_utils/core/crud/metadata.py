@@ -0,0 +1,90 @@
+"""metadata.py.
+
+Per-model CRUD metadata, computed once per model class
+
+CRUD classes are instantiated per request, so everything that only depends
+on the model class is looked up here once, instead of in every constructor or call
+"""
+import importlib
+import logging
+import threading
+from typing import Dict, Optional, Type
+
+from sqlalchemy import Column, bindparam, delete, select
+from sqlalchemy.sql import Delete, Select
+from sqlmodel import SQLModel
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_registry: Dict[type, "ModelMeta"] = {}
+
+
+def _related_model(model: type, suffix: str) -> Optional[Type]:
+    """Get the `{Model}{suffix}` class from the module of `model`, e.g. `BookPatch`."""
+    module = importlib.import_module(model.__module__)
+    return getattr(module, f"{model.__name__}{suffix}", None)
+
+
+class ModelMeta:
+    """CRUD metadata of a SQLModel table model.
+
+    Statements take the `model_id` or `key` bind parameter
+    """
+
+    def __init__(self, model: Type[SQLModel]) -> None:
+        assert isinstance(model, type), f"should pass a class"
+        assert issubclass(model, SQLModel), f"{model} should be a subclass of SQLModel"
+
+        self.model: Type[SQLModel] = model
+        self.table = model.__table__
+        self.tablename: str = self.table.name
+
+        self.PatchModel: Optional[Type] = _related_model(model, "Patch")
+        self.CreateModel: Optional[Type] = _related_model(model, "Create")
+
+        # for UUIDModels `id` is called `uuid`, otherwise `id`
+        # None for composite primary keys, which are not supported by BaseCRUD
+        self.primary_keys: list = self.table.primary_key.columns.items()
+        self.id_attr: Optional[str] = None
+        self.id_col: Optional[Column] = None
+        self.select_by_id: Optional[Select] = None
+        self.delete_by_id: Optional[Delete] = None
+        if len(self.primary_keys) == 1:
+            self.id_attr = self.primary_keys[0][0]
+            self.id_col = self.table.c[self.id_attr]
+            self.select_by_id = select(model).where(
+                getattr(model, self.id_attr) == bindparam("model_id")
+            )
+            self.delete_by_id = delete(self.table).where(
+                self.id_col == bindparam("model_id")
+            )
+
+        self._select_by_key: Dict[str, Select] = {}
+
+    def upsert_col(self, upsertKey: str) -> Column:
+        return self.table.c[upsertKey]
+
+    def select_by_upsert_key(self, upsertKey: str) -> Select:
+        statement: Optional[Select] = self._select_by_key.get(upsertKey)
+        if statement is None:
+            statement = select(self.model).where(
+                getattr(self.model, upsertKey) == bindparam("key")
+            )
+            self._select_by_key[upsertKey] = statement
+
+        return statement
+
+
+def get_model_meta(model: Type[SQLModel]) -> ModelMeta:
+    """Get the metadata of `model`, built on first use."""
+    meta: Optional[ModelMeta] = _registry.get(model)
+    if meta is None:
+        with _lock:
+            meta = _registry.get(model)
+            if meta is None:
+                meta = ModelMeta(model)
+                _registry[model] = meta
+                logger.debug(f"registered crud metadata of {model.__name__}")
+
+    return meta
@@ -3,43 +3,301 @@
 ScrapeItem CRUD class
 """
 import logging
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, List, Optional
 from uuid import UUID
 
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql.dml import Insert
+from sqlalchemy.sql.selectable import Subquery
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ...models.scrape.scrape_update import ScrapeUpdate
+from ...models.scrape.scrape_update import ScrapeUpdateBuffer
 from ...types import CreateType, ModelType, PatchType
-from . import BaseCRUD
+from . import BaseCRUD, UpsertKeyCache, UpsertManyResult, model_to_row
 
 logger = logging.getLogger(__name__)
 
 
+class ScrapeUpdatePolicy(str, Enum):
+    """Decide when a `ScrapeUpdate` row is written for a scrape_item."""
+
+    # on every visit, also when the scraped content did not change
+    always = "always"
+    # only when the item is created or its content changed
+    on_change = "on_change"
+    # never, e.g. for caches that are not scrape results
+    never = "never"
+
+
 class ScrapeItemCRUD(BaseCRUD):
     """ScrapeItemCRUD class that implements base functionality for CRUD operations of scrapeItem SQLModel models.
 
     ScrapeItems have different ways of patching: `nupdate` and `updated_at` get updated
+
+    Every item stores a `content_hash`. When an upsert finds the same hash,
+    only `last_seen` gets updated, the content is not rewritten
+
+    With a `key_cache`, upserts of known items skip the lookup by `upsertKey`,
+    and update the row by primary key directly
+
+    ScrapeUpdate rows are buffered, and inserted in bulk on commit
     """
 
-    def __init__(self, session: AsyncSession, upsertKey="url") -> None:
-        super().__init__(session=session, upsertKey=upsertKey)
+    def __init__(
+        self,
+        session: AsyncSession,
+        upsertKey="url",
+        scrape_update_policy: ScrapeUpdatePolicy = ScrapeUpdatePolicy.always,
+        key_cache: Optional[UpsertKeyCache] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(session=session, upsertKey=upsertKey, **kwargs)
+        self.scrape_update_policy: ScrapeUpdatePolicy = scrape_update_policy
+        self.key_cache: Optional[UpsertKeyCache] = key_cache
+        self._scrape_updates = ScrapeUpdateBuffer()
+
+    def _content_hash(self, values: dict) -> str:
+        return self.model.content_fingerprint(values)
+
+    def _seen_values(self) -> dict:
+        """Column values of rows that were scraped again with unchanged content."""
+        return {"last_seen": datetime.utcnow()}
+
+    async def _before_bulk_merge(self, latest: Subquery) -> None:
+        """Run by `ScrapeItemBulkLoader` in its transaction, before `latest` staged rows are merged."""
+
+    def _add_scrape_update(self, instance: ModelType) -> None:
+        """Add a ScrapeUpdate item for `instance` to the current transaction."""
+        if self.scrape_update_policy == ScrapeUpdatePolicy.never:
+            return
+        self._scrape_updates.add(self.model.__tablename__, instance.uuid)
+
+    async def _commit(self) -> None:
+        """Insert buffered ScrapeUpdate rows, and commit them with the scrape_items."""
+        try:
+            await self._scrape_updates.flush(self.session)
+            await super()._commit()
+        finally:
+            self._scrape_updates.clear()
+
+    async def _cache_key(self, instance: ModelType) -> None:
+        if self.key_cache is not None:
+            await self.key_cache.set(
+                getattr(instance, self.upsertKey), self._get_id_attr(instance)
+            )
+
+    async def _upsert_by_id(
+        self, model_id: str, values: dict, content_hash: str
+    ) -> Optional[ModelType]:
+        """Update a scrape_item by primary key, without reading it first.
+
+        Returns None if no row matches `model_id` and the upsertKey, i.e. the cache entry is stale
+        """
+        table = self.meta.table
+        where = (
+            self.meta.id_col == model_id,
+            table.c[self.upsertKey] == values[self.upsertKey],
+        )
+
+        def _returning(statement):
+            # load the returned row into the identity map, replacing stale state
+            return (
+                select(self.model)
+                .from_statement(statement.returning(*table.columns))
+                .execution_options(populate_existing=True)
+            )
+
+        # unchanged content, only mark as seen
+        result = await self.session.execute(
+            _returning(
+                update(table)
+                .where(*where, table.c.content_hash == content_hash)
+                .values(**self._seen_values())
+            )
+        )
+        instance: Optional[ModelType] = result.scalars().one_or_none()
+        changed: bool = instance is None
+        if changed:
+            data_patch = self.PatchModel(**values)
+            patch_values: dict = {
+                k: v
+                for k, v in data_patch.dict(exclude_unset=True).items()
+                if k in table.c
+            }
+            result = await self.session.execute(
+                _returning(
+                    update(table)
+                    .where(*where)
+                    .values(**patch_values, content_hash=content_hash)
+                )
+            )
+            instance = result.scalars().one_or_none()
+
+        if instance is None:
+            return None
+
+        if changed or self.scrape_update_policy == ScrapeUpdatePolicy.always:
+            self._add_scrape_update(instance)
+
+        try:
+            await self._commit()
+        except Exception as e:
+            logger.warning(f"could not update {model_id=}")
+            raise
+
+        logger.debug(
+            f"{'updated' if changed else 'unchanged'} {self.model.__tablename__} id={model_id}"
+        )
+        return instance
+
+    async def upsert(self, data: CreateType, **kwargs) -> ModelType:
+        """Create or patch a scrape_item instance.
+
+        Unchanged content (same `content_hash`) only updates `last_seen`
+        """
+        key = getattr(data, self.upsertKey)
+        if self.key_cache is not None:
+            model_id: Optional[str] = await self.key_cache.get(key)
+            if model_id is not None:
+                values: dict = data.dict()
+                instance: Optional[ModelType] = await self._upsert_by_id(
+                    model_id, values, self._content_hash(values)
+                )
+                if instance is not None:
+                    return instance
+
+                logger.debug(f"stale upsert key cache entry {key=} {model_id=}")
+                await self.key_cache.delete(key)
+
+        item: Optional[ModelType] = await self._get_by_upsert_key(key)
+
+        if item is None:
+            instance: ModelType = await self.create(data, **kwargs)
+            logger.info(
+                f"created {instance.__tablename__} id={self._get_id_attr(instance)}. {self.upsertKey}={getattr(instance, self.upsertKey)}"
+            )
+            return instance
+
+        values: dict = data.dict()
+        content_hash: str = self._content_hash(values)
+        await self._cache_key(item)
+        if item.content_hash == content_hash:
+            logger.debug(f"unchanged {item.__tablename__} id={self._get_id_attr(item)}")
+            return await self.touch(item)
+
+        logger.info(f"updating {item.__tablename__} id={self._get_id_attr(item)}")
+        data_patch = self.PatchModel(**values)
+
+        return await self.patch(
+            self._get_id_attr(item), data=data_patch, content_hash=content_hash
+        )
+
+    def _upsert_rows(self, data: List[CreateType], **kwargs) -> List[dict]:
+        """Build table rows for `upsert_many`, including their `content_hash`."""
+        rows: Dict[Any, dict] = {}
+        for d in data:
+            values: dict = d.dict()
+            values["content_hash"] = self._content_hash(values)
+            row: dict = model_to_row(self.model(**values, **kwargs))
+            rows[row[self.upsertKey]] = row
+
+        return list(rows.values())
+
+    def _on_conflict_where(self, statement: Insert):
+        """Leave rows with an unchanged `content_hash` alone."""
+        return self.model.__table__.c.content_hash.is_distinct_from(
+            statement.excluded.content_hash
+        )
+
+    async def _upsert_chunk(self, rows: List[dict]) -> UpsertManyResult:
+        """Upsert one chunk of scrape_items, and add their ScrapeUpdate rows.
+
+        Rows with an unchanged `content_hash` are not rewritten, only their `last_seen` is set
+        """
+        table = self.meta.table
+        id_col = self.meta.id_col
+        key_col = table.c[self.upsertKey]
+
+        result = await self.session.execute(self._upsert_many_statement(rows))
+
+        res = UpsertManyResult()
+        key_ids: Dict[Any, Any] = {}
+        for model_id, key, inserted in result.all():
+            (res.created if inserted else res.updated).append(model_id)
+            key_ids[key] = model_id
+
+        unchanged_keys: List[Any] = [
+            row[self.upsertKey] for row in rows if row[self.upsertKey] not in key_ids
+        ]
+        if unchanged_keys:
+            result = await self.session.execute(
+                update(table)
+                .where(key_col.in_(unchanged_keys))
+                .values(**self._seen_values())
+                .returning(id_col, key_col)
+            )
+            for model_id, key in result.all():
+                res.unchanged.append(model_id)
+                key_ids[key] = model_id
 
-    async def patch(self, model_id: str | UUID, data: PatchType, **kwargs) -> ModelType:
-        """Patch a scrape_item instance."""
+        model_ids: List[Any] = res.created + res.updated
+        if self.scrape_update_policy == ScrapeUpdatePolicy.always:
+            model_ids += res.unchanged
+
+        if self.key_cache is not None:
+            await self.key_cache.set_many(key_ids)
+
+        if self.scrape_update_policy != ScrapeUpdatePolicy.never:
+            for model_id in model_ids:
+                self._scrape_updates.add(self.model.__tablename__, model_id)
+
+        return res
+
+    async def touch(self, instance: ModelType) -> ModelType:
+        """Mark a scrape_item as seen, without rewriting its content."""
+        # only the changed attributes end up in the UPDATE statement
+        for key, value in self._seen_values().items():
+            setattr(instance, key, value)
+        self.session.add(instance)
+
+        if self.scrape_update_policy == ScrapeUpdatePolicy.always:
+            self._add_scrape_update(instance)
+
+        try:
+            await self._commit()
+        except Exception as e:
+            logger.warning(f"could not touch id={self._get_id_attr(instance)}")
+            raise
+
+        return instance
+
+    async def patch(
+        self,
+        model_id: str | UUID,
+        data: PatchType,
+        content_hash: Optional[str] = None,
+        **kwargs,
+    ) -> ModelType:
+        """Patch a scrape_item instance.
+
+        `content_hash` should be the fingerprint of the full content. A partial
+        patch leaves it None, so that the next upsert rewrites the item
+        """
         # logger.info(f"{model_id=}")
-        instance: ModelType = await self.get(model_id=model_id)
+        instance: ModelType = await self.get(model_id=model_id, primary=True)
         values = data.dict(exclude_unset=True)
 
         for k, v in values.items():
             setattr(instance, k, v)
 
+        instance.content_hash = content_hash
+
         # all I do for now is create a ScrapeUpdate item, which contains a timestamp, and it is appended
         # to the self.scrape_updates list
         # as a transaction
-
-        su = ScrapeUpdate(
-            scrape_base_id=str(instance.uuid), scrape_type=self.model.__tablename__
-        )
-        self.session.add(su)
+        self._add_scrape_update(instance)
 
         # current_nupdate: int = getattr(instance, "nupdate", 0)
         # current_nupdate: int = instance.nupdate
@@ -49,13 +307,12 @@ class ScrapeItemCRUD(BaseCRUD):
 
         # instance.updated_at = datetime.utcnow()
 
-        # TODO: also implement for `create` method
         # TODO: why not use the crud?
         # TODO: turn into transaction? every time event is commited, create ScrapeUpdate record
 
         self.session.add(instance)
         try:
-            await self.session.commit()
+            await self._commit()
         except Exception as e:
             logger.warning(f"could not patch {model_id=}")
             raise
@@ -73,21 +330,56 @@ class ScrapeItemCRUD(BaseCRUD):
         # but mypy doesn't like this
         # logger.info(f"data.dict={pformat(data.dict())} \n\n{kwargs=}")
 
-        instance: ModelType = self.model(**data.dict(), **kwargs)
+        values: dict = data.dict()
+        values["content_hash"] = self._content_hash(values)
+
+        instance: ModelType = self.model(**values, **kwargs)
         self.session.add(instance)
 
         # always add a scrapeUpdate item
-        su = ScrapeUpdate(
-            scrape_base_id=str(instance.uuid), scrape_type=self.model.__tablename__
-        )
-        self.session.add(su)
+        self._add_scrape_update(instance)
 
         # causes many crashes..
         try:
-            await self.session.commit()
+            await self._commit()
         except Exception as e:
             logger.warning(f"cannot create `{self.model.__tablename__}` item.")
             raise
 
         await self.session.refresh(instance)
+        await self._cache_key(instance)
         return instance
+
+    async def delete(self, model_id: str | UUID) -> bool:
+        """Delete a scrape_item instance, and evict it from the key cache."""
+        table = self.meta.table
+        result = await self.session.execute(
+            delete(table)
+            .where(self.meta.id_col == str(model_id))
+            .returning(table.c[self.upsertKey])
+        )
+        keys: List[Any] = list(result.scalars().all())
+        await self._commit()
+
+        if self.key_cache is not None:
+            await self.key_cache.delete_many(keys)
+
+        return True
+
+    async def warm_key_cache(self, limit: Optional[int] = None) -> int:
+        """Fill the key cache from the table, the most recently seen items last.
+
+        Pass `limit` to only load the most recently seen items
+        """
+        assert self.key_cache is not None, "set `key_cache` first"
+        table = self.meta.table
+        seen_at = func.coalesce(table.c.last_seen, table.c.updated_at)
+        statement = select(table.c[self.upsertKey], self.meta.id_col)
+        if limit is not None:
+            recent = select(self.meta.id_col).order_by(seen_at.desc()).limit(limit)
+            statement = statement.where(self.meta.id_col.in_(recent))
+
+        # the LRU keeps the last inserted keys
+        statement = statement.order_by(seen_at)
+
+        return await self.key_cache.warm(self._read_session(), statement)
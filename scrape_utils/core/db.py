@@ -1,47 +1,260 @@
 """db.py.
 
 PostgreSQL connection methods
+
+Engines are shared per process: they are kept in a registry keyed by
+connection string and options, so that every call reuses the same connection pool.
+Async engines are bound to the event loop they first connect on, so they are
+registered per running loop as well. Loops are referenced weakly, and the engines
+of closed loops are dropped, so short-lived loops, e.g. of `asyncio.run`, do not leak.
 """
+import asyncio
+import atexit
 import logging
-from typing import AsyncGenerator
+import threading
+import weakref
+from contextlib import contextmanager
+from time import perf_counter
+from typing import AsyncGenerator, Dict, Iterator, List, Optional, Tuple
 
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.future.engine import Engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.schema import CreateIndex
 from sqlmodel import Session, SQLModel, create_engine
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from .settings import PG_POOL_SIZE_DEFAULT
+from .settings import (PG_MAX_OVERFLOW_DEFAULT, PG_POOL_PRE_PING_DEFAULT,
+                       PG_POOL_RECYCLE_DEFAULT, PG_POOL_SIZE_DEFAULT)
 
 logger = logging.getLogger(__name__)
 
+EngineKey = Tuple[str, Tuple]
+# async engines are registered per running loop, None outside of a loop
+AsyncEngineKey = Tuple[Optional["weakref.ref[asyncio.AbstractEventLoop]"], str, Tuple]
+
+_lock = threading.RLock()
+_async_engines: Dict[AsyncEngineKey, AsyncEngine] = {}
+_engines: Dict[EngineKey, Engine] = {}
+_async_sessions: Dict[AsyncEngineKey, sessionmaker] = {}
+
+
+class PoolStats:
+    """Checkout counters of a connection pool."""
+
+    __slots__ = ("ncheckout", "wait_total", "wait_max")
+
+    def __init__(self) -> None:
+        self.ncheckout: int = 0
+        self.wait_total: float = 0.0
+        self.wait_max: float = 0.0
+
+    def record_checkout(self, wait: float) -> None:
+        self.ncheckout += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def as_dict(self) -> dict:
+        return {
+            "ncheckout": self.ncheckout,
+            "wait_total": self.wait_total,
+            "wait_avg": self.wait_total / self.ncheckout if self.ncheckout else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+class TimedPoolMixin:
+    """Measure how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start: float = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.stats.record_checkout(perf_counter() - start)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _engine_key(connection_str: str, **kwargs) -> EngineKey:
+    return connection_str, tuple(sorted(kwargs.items()))
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
 
-def get_async_engine(async_connection_str: str, pool_size: int = PG_POOL_SIZE_DEFAULT):
-    async_engine = create_async_engine(
-        async_connection_str,
-        echo=False,
-        future=True,
+
+def _loop_ref(
+    loop: Optional[asyncio.AbstractEventLoop],
+) -> Optional["weakref.ref[asyncio.AbstractEventLoop]"]:
+    # refs of the same loop are equal, and hash like the loop
+    return weakref.ref(loop) if loop is not None else None
+
+
+def _async_engine_key(connection_str: str, **kwargs) -> AsyncEngineKey:
+    return _loop_ref(_running_loop()), *_engine_key(connection_str, **kwargs)
+
+
+def _loop_closed(key: AsyncEngineKey) -> bool:
+    loop_ref = key[0]
+    if loop_ref is None:
+        return False
+    loop: Optional[asyncio.AbstractEventLoop] = loop_ref()
+    return loop is None or loop.is_closed()
+
+
+def _drop_closed_loops() -> None:
+    """Drop the engines of closed loops, their connections cannot be closed anymore."""
+    keys: List[AsyncEngineKey] = [k for k in _async_engines if _loop_closed(k)]
+    for key in keys:
+        # forget the pooled connections without awaiting them on the closed loop
+        _async_engines.pop(key).sync_engine.dispose(close=False)
+    for key in [k for k in _async_sessions if _loop_closed(k)]:
+        del _async_sessions[key]
+
+    if keys:
+        logger.debug(f"dropped {len(keys):,} async engines of closed loops")
+
+
+def get_async_engine(
+    async_connection_str: str,
+    pool_size: int = PG_POOL_SIZE_DEFAULT,
+    max_overflow: int = PG_MAX_OVERFLOW_DEFAULT,
+    pool_pre_ping: bool = PG_POOL_PRE_PING_DEFAULT,
+    pool_recycle: int = PG_POOL_RECYCLE_DEFAULT,
+) -> AsyncEngine:
+    """Get shared async engine for connection string and pool options.
+
+    Every event loop gets its own engine, connections cannot be used across loops
+    """
+    options: dict = dict(
         pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_pre_ping=pool_pre_ping,
+        pool_recycle=pool_recycle,
     )
+    key: AsyncEngineKey = _async_engine_key(async_connection_str, **options)
+    with _lock:
+        async_engine = _async_engines.get(key)
+        if async_engine is None:
+            _drop_closed_loops()
+            async_engine = create_async_engine(
+                async_connection_str,
+                echo=False,
+                future=True,
+                poolclass=TimedAsyncAdaptedQueuePool,
+                **options,
+            )
+            _async_engines[key] = async_engine
+            logger.info(f"created async engine {async_engine.url!r} {options=}")
 
     return async_engine
 
 
+def add_missing_columns(connection: Connection) -> List[str]:
+    """Add nullable model columns that are missing from existing tables.
+
+    `create_all` skips tables that exist, so columns added to a model later,
+    e.g. `content_hash` and `last_seen` of ScrapeBase, are added here
+    """
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    added: List[str] = []
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name, schema=table.schema):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name, table.schema)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type: str = column.type.compile(dialect=connection.dialect)
+            connection.execute(
+                text(
+                    f"ALTER TABLE {quote(table.name)} ADD COLUMN IF NOT EXISTS "
+                    f"{quote(column.name)} {column_type}"
+                )
+            )
+            added.append(f"{table.name}.{column.name}")
+
+    if added:
+        logger.info(f"added missing columns: {added}")
+    return added
+
+
+def add_missing_indexes(connection: Connection) -> List[str]:
+    """Create model indexes that are missing from existing tables.
+
+    Like columns, indexes added to a model later, e.g. on `time` and `body_digest` of
+    http cache items, are skipped by `create_all`. Unique indexes are only logged,
+    since duplicate rows would fail the whole transaction. CREATE INDEX blocks writes
+    to the table while it builds
+    """
+    inspector = inspect(connection)
+    added: List[str] = []
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name, schema=table.schema):
+            continue
+        existing = {i["name"] for i in inspector.get_indexes(table.name, table.schema)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique:
+                logger.warning(
+                    f"missing unique index `{index.name}`, create it manually"
+                )
+                continue
+            connection.execute(CreateIndex(index, if_not_exists=True))
+            added.append(index.name)
+
+    if added:
+        logger.info(f"added missing indexes: {added}")
+    return added
+
+
 async def init_db(async_connection_str: str):
     async with get_async_engine(async_connection_str).begin() as conn:
         # await conn.run_sync(SQLModel.metadata.drop_all)
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+        await conn.run_sync(add_missing_indexes)
 
 
 def get_async_session(
-    async_connection_str: str, pool_size: int = PG_POOL_SIZE_DEFAULT
+    async_connection_str: str, pool_size: int = PG_POOL_SIZE_DEFAULT, **kwargs
 ) -> sessionmaker:
+    """Get shared async session factory, kwargs are passed to `get_async_engine`."""
     assert isinstance(async_connection_str, str), f"{type(async_connection_str)=}"
-    async_session = sessionmaker(
-        bind=get_async_engine(async_connection_str, pool_size=pool_size),
-        class_=AsyncSession,
-        expire_on_commit=False,
+    key: AsyncEngineKey = _async_engine_key(
+        async_connection_str, pool_size=pool_size, **kwargs
     )
+    with _lock:
+        async_session = _async_sessions.get(key)
+        if async_session is None:
+            async_session = sessionmaker(
+                bind=get_async_engine(
+                    async_connection_str, pool_size=pool_size, **kwargs
+                ),
+                class_=AsyncSession,
+                expire_on_commit=False,
+            )
+            _async_sessions[key] = async_session
+
     return async_session
     # async with async_session() as session:
     #     yield session
@@ -53,11 +266,174 @@ async def yield_async_session(async_connection_str: str) -> AsyncGenerator:
         yield session
 
 
+def get_async_read_session(
+    async_connection_str: str,
+    replica_async_connection_str: Optional[str] = None,
+    **kwargs,
+) -> sessionmaker:
+    """Get async session factory for read-only queries.
+
+    Uses the read replica if configured, else falls back to the primary
+    """
+    return get_async_session(
+        replica_async_connection_str or async_connection_str, **kwargs
+    )
+
+
+async def yield_async_read_session(
+    async_connection_str: str, replica_async_connection_str: Optional[str] = None
+) -> AsyncGenerator:
+    async_session = get_async_read_session(
+        async_connection_str, replica_async_connection_str
+    )
+    async with async_session() as session:
+        yield session
+
+
 def get_engine(connection_str: str, **kwargs) -> Engine:
-    engine: Engine = create_engine(connection_str, **kwargs)
+    """Get shared engine for connection string and engine kwargs."""
+    kwargs.setdefault("pool_pre_ping", PG_POOL_PRE_PING_DEFAULT)
+    kwargs.setdefault("pool_recycle", PG_POOL_RECYCLE_DEFAULT)
+    key: EngineKey = _engine_key(connection_str, **kwargs)
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = create_engine(connection_str, poolclass=TimedQueuePool, **kwargs)
+            _engines[key] = engine
+            logger.info(f"created engine {engine.url!r} {kwargs=}")
+
     return engine
 
 
 def get_session(connection_str: str, echo: bool = False) -> Session:
     engine: Engine = get_engine(connection_str, echo=echo)
     return Session(engine)
+
+
+def get_read_engine(
+    connection_str: str, replica_connection_str: Optional[str] = None, **kwargs
+) -> Engine:
+    """Get engine for read-only queries, the read replica if configured."""
+    return get_engine(replica_connection_str or connection_str, **kwargs)
+
+
+def get_read_session(
+    connection_str: str,
+    replica_connection_str: Optional[str] = None,
+    echo: bool = False,
+) -> Session:
+    engine: Engine = get_read_engine(connection_str, replica_connection_str, echo=echo)
+    return Session(engine)
+
+
+def pool_metrics() -> Dict[str, dict]:
+    """Return pool status and checkout wait metrics of all registered engines."""
+    metrics: Dict[str, dict] = {}
+    with _lock:
+        engines = [e.sync_engine for e in _async_engines.values()]
+        engines += list(_engines.values())
+
+    for engine in engines:
+        pool = engine.pool
+        item: dict = {
+            "size": pool.size(),
+            "checkedin": pool.checkedin(),
+            "checkedout": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+        if isinstance(pool, TimedPoolMixin):
+            item |= pool.stats.as_dict()
+        # password is masked in the url repr
+        metrics[f"{engine.url!r} #{len(metrics)}"] = item
+
+    return metrics
+
+
+def dispose_engines() -> None:
+    """Dispose all sync engines, and close their pooled connections."""
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+async def dispose_async_engines(loop_only: bool = False) -> None:
+    """Dispose the async engines of this loop and all sync engines, call this on shutdown.
+
+    Engines of other loops can only be disposed on their own loop. With `loop_only`,
+    only the engines of this loop are disposed, e.g. when a background thread stops
+    """
+    loop_refs = (
+        (_loop_ref(_running_loop()),)
+        if loop_only
+        else (_loop_ref(_running_loop()), None)
+    )
+    with _lock:
+        keys: List[AsyncEngineKey] = [k for k in _async_engines if k[0] in loop_refs]
+        async_engines = [_async_engines.pop(k) for k in keys]
+        for key in [k for k in _async_sessions if k[0] in loop_refs]:
+            del _async_sessions[key]
+
+    for async_engine in async_engines:
+        await async_engine.dispose()
+
+    if not loop_only:
+        dispose_engines()
+    logger.info(f"disposed {len(async_engines):,} async engines")
+
+
+@contextmanager
+def loop_async_session(
+    async_connection_str: Optional[str], **kwargs
+) -> Iterator[Tuple[asyncio.AbstractEventLoop, Optional[sessionmaker]]]:
+    """Run a new event loop with a shared async session factory, for a background thread.
+
+    Async engines are bound to the loop they connect on, so the thread owns both.
+    kwargs are passed to `get_async_session`. Without `async_connection_str` there is
+    no session factory. The engines of the loop are disposed, and the loop closed, on exit
+
+    Usage:
+        with loop_async_session(async_connection_str, pool_size=1) as (loop, async_session):
+            loop.run_until_complete(write(async_session))
+    """
+    loop = asyncio.new_event_loop()
+
+    async def _get_async_session() -> sessionmaker:
+        # registered under the running loop
+        return get_async_session(async_connection_str, **kwargs)
+
+    try:
+        async_session: Optional[sessionmaker] = None
+        if async_connection_str is not None:
+            async_session = loop.run_until_complete(_get_async_session())
+        yield loop, async_session
+    finally:
+        try:
+            loop.run_until_complete(dispose_async_engines(loop_only=True))
+        finally:
+            loop.close()
+
+
+def _dispose_all_engines() -> None:
+    """Dispose all engines at exit, async ones on their loop if it can still run."""
+    with _lock:
+        entries = list(_async_engines.items())
+        _async_engines.clear()
+        _async_sessions.clear()
+
+    for (loop_ref, *_), async_engine in entries:
+        loop: Optional[asyncio.AbstractEventLoop] = (
+            loop_ref() if loop_ref is not None else None
+        )
+        try:
+            if loop is not None and not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(async_engine.dispose())
+            else:
+                async_engine.sync_engine.dispose(close=False)
+        except Exception as e:
+            logger.debug(f"cannot dispose async engine {async_engine.url!r}. {e}")
+
+    dispose_engines()
+
+
+atexit.register(_dispose_all_engines)
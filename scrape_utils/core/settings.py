@@ -7,6 +7,10 @@ START_URLS_KEY: Final[str] = "rspider:start_urls"
 REDIS_SITEMAP_KEY_FORMAT: Final[str] = "sitemap-{collection}"
 
 PG_POOL_SIZE_DEFAULT: Final[int] = 10
+PG_MAX_OVERFLOW_DEFAULT: Final[int] = 10
+PG_POOL_PRE_PING_DEFAULT: Final[bool] = True
+# seconds, recycle connections before server / proxy idle timeouts kick in
+PG_POOL_RECYCLE_DEFAULT: Final[int] = 1_800
 
 ENV_FILE_PATTERN: Final[str] = ".env.{}"
 
@@ -15,3 +19,99 @@ REQUIRED_SOFT_ULIMIT: Final[int] = 10_000
 MODULE_DIR_FORMAT: Final[
     str
 ] = "/home/paul/repos/misc-scraping/misc_scraping/{module_name}/config"
+
+# blake2b digest size (bytes) of scrape item content fingerprints
+CONTENT_HASH_DIGEST_SIZE: Final[int] = 16
+
+UPSERT_MANY_CHUNK_SIZE_DEFAULT: Final[int] = 1_000
+# postgres wire protocol limit of bind parameters per statement
+PG_MAX_BIND_PARAMS: Final[int] = 32_767
+
+# records per `copy_records_to_table` call in the bulk loader
+COPY_CHUNK_SIZE_DEFAULT: Final[int] = 50_000
+
+# in-process cache of category items, keyed by upsertKey
+CATEGORY_CACHE_MAXSIZE_DEFAULT: Final[int] = 10_000
+# seconds
+CATEGORY_CACHE_TTL_DEFAULT: Final[float] = 3_600
+
+# upsert key -> primary key cache of scrape item CRUDs
+UPSERT_KEY_CACHE_MAXSIZE_DEFAULT: Final[int] = 100_000
+UPSERT_KEY_CACHE_KEY_FORMAT: Final[str] = "upsert-key-cache:{name}"
+UPSERT_KEY_CACHE_WARM_CHUNK_SIZE: Final[int] = 10_000
+
+# monthly partitions of scrape_updates created ahead of time
+SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT: Final[int] = 1
+# months of raw scrape_updates kept before they are rolled up to daily aggregates
+SCRAPE_UPDATES_RETAIN_MONTHS_DEFAULT: Final[int] = 3
+# rows per INSERT of buffered scrape_updates, 3 bind parameters each
+SCRAPE_UPDATE_INSERT_CHUNK_SIZE: Final[int] = 10_000
+
+# seconds, how long estimated and counter based item counts are cached
+COUNT_CACHE_TTL_DEFAULT: Final[float] = 10
+COUNT_CACHE_MAXSIZE: Final[int] = 1_000
+# rows per table in the counter table, spreads concurrent trigger updates over more rows
+COUNTER_NSHARD: Final[int] = 16
+
+# rows per page of keyset iteration over a table
+KEYSET_PAGE_SIZE_DEFAULT: Final[int] = 1_000
+KEYSET_PAGE_SIZE_MAX: Final[int] = 10_000
+
+# values per multi-value RPUSH / ZADD command of columnar batches
+REDIS_PUSH_CHUNK_SIZE: Final[int] = 5_000
+
+# responses per MULTI/EXEC of the buffered redis http cache writer
+HTTP_CACHE_WRITE_BATCH_SIZE: Final[int] = 100
+# seconds, flush a partial batch when its oldest response waited this long
+HTTP_CACHE_WRITE_MAX_DELAY: Final[float] = 5.0
+# responses the background postgres cache writer can queue, before `add` blocks
+HTTP_CACHE_PG_WRITER_QUEUE_SIZE: Final[int] = 10_000
+# attempts to write a batch to postgres, before its responses are dropped
+HTTP_CACHE_PG_WRITER_ATTEMPTS: Final[int] = 3
+# seconds before the first retry of a failed batch, doubled on every retry
+HTTP_CACHE_PG_WRITER_RETRY_DELAY: Final[float] = 1.0
+# read http cache entries written before the binary record format, which are pickles
+HTTP_CACHE_ALLOW_LEGACY_PICKLE: Final[bool] = True
+
+# zstd compression of http cache bodies, with dictionaries trained per domain
+HTTP_CACHE_ZSTD_LEVEL: Final[int] = 3
+HTTP_CACHE_ZSTD_DICTS_KEY: Final[str] = "http-cache:zstd-dicts"
+HTTP_CACHE_ZSTD_DICT_DOMAINS_KEY: Final[str] = "http-cache:zstd-dict-domains"
+# bytes, the zstd cli default
+HTTP_CACHE_ZSTD_DICT_SIZE_DEFAULT: Final[int] = 112_640
+HTTP_CACHE_ZSTD_TRAIN_SAMPLES_DEFAULT: Final[int] = 2_000
+HTTP_CACHE_ZSTD_TRAIN_MAX_BYTES: Final[int] = 16_000_000
+# seconds, how long workers keep using a domain dictionary before checking for a newer one
+HTTP_CACHE_ZSTD_DOMAINS_TTL: Final[float] = 300
+
+# content-addressed bodies of the redis http cache, see `cache_http/dedup.py`
+HTTP_CACHE_BODIES_KEY_FORMAT: Final[str] = "{http_cache_key}:bodies"
+HTTP_CACHE_BODY_REFS_KEY_FORMAT: Final[str] = "{http_cache_key}:body-refs"
+# blake2b digest size (bytes) of cached bodies
+HTTP_CACHE_BODY_DIGEST_SIZE: Final[int] = 16
+HTTP_CACHE_KNOWN_DIGESTS_MAXSIZE: Final[int] = 100_000
+# url entries per write script call
+HTTP_CACHE_PUT_CHUNK_SIZE: Final[int] = 500
+
+# in-process tier of the tiered http cache, see `cache_http/tiered.py`
+# bytes, counts compressed records and their decompressed bodies
+HTTP_CACHE_MEMORY_MAX_BYTES: Final[int] = 256_000_000
+HTTP_CACHE_MEMORY_MAXSIZE: Final[int] = 50_000
+# buffered responses kept while writes fail, the oldest are dropped beyond it
+HTTP_CACHE_MAX_PENDING: Final[int] = 10_000
+# seconds before `put` retries a failed flush, doubled on every failure up to the max
+HTTP_CACHE_RETRY_DELAY: Final[float] = 1.0
+HTTP_CACHE_MAX_RETRY_DELAY: Final[float] = 60.0
+
+# http cache eviction, see `cache_http/eviction.py`
+# entries per HDEL/ZREM round trip or DELETE statement
+HTTP_CACHE_EVICT_BATCH_SIZE: Final[int] = 500
+# seconds between runs of the background evictor
+HTTP_CACHE_EVICT_INTERVAL: Final[float] = 60.0
+# elements MEMORY USAGE samples to estimate the size of redis keys
+HTTP_CACHE_EVICT_MEMORY_SAMPLES: Final[int] = 64
+
+# entries per HSCAN page of the streaming http cache readers, see `cache_http/scan.py`
+HTTP_CACHE_SCAN_PAGE_SIZE: Final[int] = 500
+# HSCAN cursor of an interrupted cache copy, stored in the target database
+HTTP_CACHE_MIGRATE_RESUME_KEY_FORMAT: Final[str] = "{http_cache_key}:migrate-cursor"
@@ -4,31 +4,44 @@ Helper methods for Event objects
 """
 import logging
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Optional
 
 import pandas as pd
-from scrape_utils.core.db import get_engine
-from scrape_utils.models.redis import SitemapRecord
+from sqlalchemy import inspect
+
+from scrape_utils.core.db import get_read_engine
+from scrape_utils.models.redis import SitemapBatch, SitemapRecord
 
 logger = logging.getLogger(__name__)
 
 
 def filter_only_new_start_urls(
     db_connection_str: str,
-    start_urls: List[SitemapRecord],
+    start_urls: List[SitemapRecord] | SitemapBatch,
     table: str,
     onlyFutureRows: bool = True,
-) -> List[SitemapRecord]:
-    """Filter out start urls, that with `lastmod` later than `created_at` ScrapeUpdate in pg."""
+    replica_connection_str: Optional[str] = None,
+) -> List[SitemapRecord] | SitemapBatch:
+    """Filter out start urls, that with `lastmod` later than `created_at` ScrapeUpdate in pg.
+
+    A `SitemapBatch` is filtered with one boolean mask, and returned as a `SitemapBatch`
+    """
     # TODO: function works best if sitemaps also gets refreshed in redis! run `sitemap_to_redis`
+    is_batch: bool = isinstance(start_urls, SitemapBatch)
     logger.warning(f"{start_urls[:3]=}")
     logger.info(f"start_urls before filtering: {len(start_urls):,}")
 
     # https://docs.sqlalchemy.org/en/14/errors.html#error-3o7r
-    engine = get_engine(db_connection_str, future=False)
+    engine = get_read_engine(db_connection_str, replica_connection_str, future=False)
     # query: str = "SELECT uuid, url, updated_at, time_start FROM {table}".format(
-    query: str = "SELECT uuid, url, updated_at FROM {table}".format(
-        table=table
+    # unchanged re-scrapes only bump `last_seen`, so take the latest of both.
+    # tables created before `last_seen` existed lack it, see `add_missing_columns`
+    columns = {c["name"] for c in inspect(engine).get_columns(table)}
+    latest: str = (
+        "GREATEST(updated_at, last_seen)" if "last_seen" in columns else "updated_at"
+    )
+    query: str = "SELECT uuid, url, {latest} AS updated_at FROM {table}".format(
+        latest=latest, table=table
     )
     # if onlyFutureRows:
     #     query = "SELECT uuid, url, updated_at FROM {table} WHERE time_start > NOW()".format(table=table)
@@ -38,8 +51,10 @@ def filter_only_new_start_urls(
     items_df = pd.read_sql(query, engine)
 
     logger.info(f"got {len(items_df):,} {table} rows from postgres")
+    # a url can have several rows, compare against the latest of them
+    latest_updated_at: pd.Series = items_df.groupby("url")["updated_at"].max()
 
-    sitemap_df = pd.DataFrame(start_urls)
+    sitemap_df = start_urls.to_frame() if is_batch else pd.DataFrame(start_urls)
     # sitemap_df["lastmod"] = pd.to_datetime(sitemap_df.lastmod_ts, unit="s")
 
     last_24_hours: datetime = datetime.now() - timedelta(hours=24)
@@ -48,8 +63,18 @@ def filter_only_new_start_urls(
     # nmodified: int = len(recent_rows)
     logger.info(f"{len(recent_rows):,} {table} pages were modified in last 24 hours")
 
+    if is_batch:
+        # lookup instead of merge, keeps one row per start url, in the same order
+        updated_at = sitemap_df["url"].map(latest_updated_at)
+        mask = updated_at.isna() | (sitemap_df["lastmod"] > updated_at)
+        filtered_batch: SitemapBatch = start_urls[mask.to_numpy(dtype=bool)]
+        logger.info(f"start_urls after filtering: {len(filtered_batch):,}")
+        return filtered_batch
+
     # merge/join the datasets, and include all sitemap items that are not in table
-    merged_df = pd.merge(sitemap_df, items_df, on="url", how="left")
+    merged_df = pd.merge(
+        sitemap_df, latest_updated_at.reset_index(), on="url", how="left"
+    )
     # merged_df.sort_values('lastmod', inplace=True, ascending=False)
 
     # items_to_scrape = len(merged_df[merged_df['lastmod'] > merged_df['updated_at']])
@@ -1,7 +1,11 @@
 import logging
+import threading
 from datetime import datetime
-from typing import Final, Sequence, Set
+from typing import (Any, Dict, Final, FrozenSet, Iterable, List, Sequence, Set,
+                    Tuple, Type)
 
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.orm.base import manager_of_class
 from sqlmodel import SQLModel
 
 logger = logging.getLogger(__name__)
@@ -14,6 +18,101 @@ DATETIME_FIELDS_BASE: Final[Set[str]] = set(
     ]
 )
 
+_converters_lock = threading.Lock()
+# (model class, extra datetime fields) -> converter
+_converters: Dict[Tuple[type, Tuple[str, ...]], "FromJsonConverter"] = {}
+
+
+class FromJsonConverter:
+    """Convert json dicts to instances of one model class.
+
+    Everything that only depends on the class is computed once: the fields,
+    their defaults, and which fields hold isoformat datetimes.
+
+    `trusted=True` skips pydantic validation, only use it for items produced by
+    our own spiders. Values are set as is, and aliases are not resolved
+    """
+
+    def __init__(self, model: Type[SQLModel], dt_fields_extra: Sequence[str] = ()):
+        self.model: Type[SQLModel] = model
+        self.fields: dict = model.__fields__
+        self.field_names: FrozenSet[str] = frozenset(self.fields)
+        self.relationships: FrozenSet[str] = frozenset(
+            getattr(model, "__sqlmodel_relationships__", {})
+        )
+        self.dt_fields: Tuple[str, ...] = tuple(
+            name
+            for name, field in self.fields.items()
+            if name in DATETIME_FIELDS_BASE
+            or name in dt_fields_extra
+            or field.outer_type_ is datetime
+        )
+        self.is_table: bool = getattr(model.__config__, "table", False)
+        self._mappers_configured: bool = False
+
+    def parse(self, json_data: dict, **kwargs) -> dict:
+        """Return a new dict with isoformat datetimes parsed, `json_data` is not modified."""
+        values: dict = {**json_data, **kwargs} if kwargs else dict(json_data)
+        for key in self.dt_fields:
+            value = values.get(key)
+            if value.__class__ is str:
+                values[key] = datetime.fromisoformat(value)
+
+        return values
+
+    def _construct_table(self, values: dict) -> SQLModel:
+        """Create a table model instance without validation, like `SQLModel.__init__`."""
+        if not self._mappers_configured:
+            # normally done by the instrumented `__init__` of the first instance
+            configure_mappers()
+            self._mappers_configured = True
+
+        instance = manager_of_class(self.model).new_instance()
+        # a new transient instance has no attribute history to keep, and the
+        # INSERT reads its column values from `__dict__`, like for loaded rows
+        state_dict: dict = instance.__dict__
+        fields_set: Set[str] = set()
+        for name, field in self.fields.items():
+            if name in values:
+                state_dict[name] = values[name]
+                fields_set.add(name)
+            elif not field.required:
+                state_dict[name] = field.get_default()
+
+        object.__setattr__(instance, "__fields_set__", fields_set)
+        for name in self.relationships & values.keys():
+            setattr(instance, name, values[name])
+
+        return instance
+
+    def __call__(self, json_data: dict, trusted: bool = False, **kwargs) -> SQLModel:
+        values: dict = self.parse(json_data, **kwargs)
+        if not trusted:
+            return self.model(**values)
+
+        if self.is_table:
+            return self._construct_table(values)
+
+        return self.model.construct(
+            **{k: v for k, v in values.items() if k in self.field_names}
+        )
+
+
+def get_from_json_converter(
+    model: Type[SQLModel], dt_fields_extra: Sequence[str] = ()
+) -> FromJsonConverter:
+    """Get the cached converter of `model`."""
+    key: Tuple[type, Tuple[str, ...]] = (model, tuple(dt_fields_extra))
+    converter = _converters.get(key)
+    if converter is None:
+        with _converters_lock:
+            converter = _converters.get(key)
+            if converter is None:
+                converter = FromJsonConverter(model, dt_fields_extra)
+                _converters[key] = converter
+
+    return converter
+
 
 # class BaseScrapeUtility():
 # class Base(SQLModel):
@@ -27,21 +126,33 @@ class BaseScrapeUtility(SQLModel):
     def _date_parser(
         cls, json_data: dict, dt_fields_extra: Sequence[str] = tuple(), **kwargs
     ) -> dict:
-        """Parse dates from isoformat to datetime."""
+        """Parse dates from isoformat to datetime, returns a new dict."""
         # if present, cast isoformat dates to datetime
-        json_data |= kwargs
-
-        dt_fields: Set[str] = DATETIME_FIELDS_BASE | set(dt_fields_extra)
+        return get_from_json_converter(cls, dt_fields_extra).parse(json_data, **kwargs)
 
-        for key in dt_fields:
-            if key in json_data and isinstance(json_data[key], str):
-                json_data[key] = datetime.fromisoformat(json_data[key])
+    @classmethod
+    def from_json(
+        cls,
+        json_data: dict,
+        dt_fields_extra: Sequence[str] = tuple(),
+        trusted: bool = False,
+        **kwargs,
+    ):
+        """Create instance from json dict.
 
-        return json_data
+        Pass `trusted=True` to skip validation, for items produced by our own spiders
+        """
+        converter = get_from_json_converter(cls, dt_fields_extra)
+        return converter(json_data, trusted=trusted, **kwargs)
 
     @classmethod
-    def from_json(cls, json_data: dict, **kwargs):
-        """Create instance from json dict."""
-        json_data_new: dict = cls._date_parser(json_data, **kwargs)
-
-        return cls(**json_data_new)
+    def from_json_many(
+        cls,
+        items: Iterable[dict],
+        dt_fields_extra: Sequence[str] = tuple(),
+        trusted: bool = False,
+        **kwargs,
+    ) -> List[Any]:
+        """Create instances from json dicts."""
+        converter = get_from_json_converter(cls, dt_fields_extra)
+        return [converter(item, trusted=trusted, **kwargs) for item in items]
@@ -1,6 +1,13 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query
 from fastapi import status as http_status
 
+from ...core.crud import (CountMode, KeysetOrder, KeysetPage, decode_cursor,
+                          encode_cursor)
+from ...core.settings import KEYSET_PAGE_SIZE_DEFAULT, KEYSET_PAGE_SIZE_MAX
+from ...models.api import nitemResponse
 from ...models.main import StatusMessage
 from . import HttpCacheItem, HttpCacheItemPatch, HttpCacheItemRead
 from .crud import CacheCRUD
@@ -22,6 +29,49 @@ router = APIRouter(prefix="/cache", tags=["cache"])
 #     return event
 
 
+@router.get(
+    "",
+    response_model=KeysetPage[HttpCacheItemRead],
+    status_code=http_status.HTTP_200_OK,
+)
+async def list_caches(
+    cursor: Optional[str] = None,
+    order: KeysetOrder = KeysetOrder.id,
+    page_size: int = Query(KEYSET_PAGE_SIZE_DEFAULT, gt=0, le=KEYSET_PAGE_SIZE_MAX),
+    updated_after: Optional[datetime] = None,
+    updated_before: Optional[datetime] = None,
+    caches: CacheCRUD = Depends(get_cache_crud),
+):
+    """List caches page by page, pass `next_cursor` to get the next page."""
+    try:
+        after: Optional[Tuple] = decode_cursor(cursor, order) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=http_status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    items, next_after = await caches.get_page(
+        order=order,
+        after=after,
+        page_size=page_size,
+        updated_after=updated_after,
+        updated_before=updated_before,
+    )
+
+    return {
+        "items": items,
+        "next_cursor": encode_cursor(next_after) if next_after else None,
+    }
+
+
+# declared before `/{cache_id}`, so that `count` is not taken for an id
+@router.get("/count", response_model=nitemResponse, status_code=http_status.HTTP_200_OK)
+async def count_cache(
+    mode: CountMode = CountMode.estimate, caches: CacheCRUD = Depends(get_cache_crud)
+):
+    total = await caches.nitem(mode=mode)
+
+    return {"total": total}
+
+
 @router.get(
     "/{cache_id}", response_model=HttpCacheItemRead, status_code=http_status.HTTP_200_OK
 )
@@ -1,15 +1,230 @@
 import logging
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+from uuid import UUID
 
-from scrape_utils.core.crud import ScrapeItemCRUD
+from scrape_utils.core.crud import (ScrapeItemCRUD, ScrapeUpdatePolicy,
+                                    UpsertManyResult)
+from sqlalchemy import String, bindparam, delete, func, literal, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql.selectable import Subquery
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from . import HttpCacheItem
+from ...cache_http.codecs import (ZstdDictionaries, body_digest,
+                                  decode_body_frame)
+from ...types import CreateType
+from . import HttpCacheBody, HttpCacheItem
 
 logger = logging.getLogger(__name__)
 
 
 class CacheCRUD(ScrapeItemCRUD):
+    """CRUD of http cache items.
+
+    With `dedup_bodies=True`, `upsert` stores each distinct body once in
+    `http_cache_bodies`, and cache items only keep its `body_digest`.
+    Bodies are reference counted, and deleted with their last cache item.
+    Every write path releases the shared body of the cache item it replaces, under
+    a transaction-level advisory lock per url, so concurrent writers cannot leak a reference
+
+    Cached responses are not scrape results, so no `ScrapeUpdate` rows are written
+    """
+
     model = HttpCacheItem  # Replace `HttpCacheItem` with the actual model class
 
-    def __init__(self, session: AsyncSession):
-        super().__init__(session)
+    def __init__(
+        self,
+        session: AsyncSession,
+        dedup_bodies: bool = False,
+        dicts: Optional[ZstdDictionaries] = None,
+        **kwargs,
+    ):
+        kwargs.setdefault("scrape_update_policy", ScrapeUpdatePolicy.never)
+        super().__init__(session, **kwargs)
+        self.dedup_bodies: bool = dedup_bodies
+        self.dicts: Optional[ZstdDictionaries] = dicts
+
+    def _seen_values(self) -> dict:
+        # a refetch is as fresh as a new entry, for expiration and eviction
+        now: datetime = datetime.utcnow()
+        return {"last_seen": now, "time": now.timestamp()}
+
+    async def _lock_urls(self, hashes: Subquery) -> None:
+        """Take advisory locks on `hashes` of urls, in order, until the transaction ends.
+
+        Also serializes inserts of new urls, which SELECT .. FOR UPDATE cannot lock
+        """
+        await self.session.execute(
+            select(
+                func.pg_advisory_xact_lock(
+                    func.hashtext(literal(self.meta.table.name)), hashes.c.h
+                )
+            ).select_from(hashes)
+        )
+
+    def _url_hashes(self, urls: List[str]) -> Subquery:
+        url = func.unnest(bindparam("urls", sorted(set(urls)), type_=ARRAY(String)))
+        h = func.hashtext(url).label("h")
+        return select(h).distinct().order_by(h).subquery("hashes")
+
+    async def _release_replaced_bodies(self, rows: List[dict]) -> None:
+        """Release shared bodies of the cache items that `rows` will replace.
+
+        Items with the same `content_hash` are left alone by upserts, so they keep their body
+        """
+        content_hashes: Dict[str, Optional[str]] = {
+            row["url"]: row.get("content_hash") for row in rows
+        }
+        await self._lock_urls(self._url_hashes(list(content_hashes)))
+
+        table = self.meta.table
+        result = await self.session.execute(
+            select(table.c.url, table.c.body_digest, table.c.content_hash)
+            .where(table.c.url.in_(list(content_hashes)))
+            .where(table.c.body_digest.is_not(None))
+            .where(func.octet_length(table.c.body) == 0)
+        )
+        replaced = Counter(
+            digest
+            for url, digest, content_hash in result.all()
+            if content_hash is None or content_hash != content_hashes[url]
+        )
+        for digest, n in replaced.items():
+            await self._release_body(digest, n)
+
+    async def _shared_body_digest(self, where) -> Optional[str]:
+        """Get the digest of the shared body a cache item references, if any."""
+        table = self.meta.table
+        result = await self.session.execute(
+            select(table.c.body_digest)
+            .where(where)
+            .where(table.c.body_digest.is_not(None))
+            .where(func.octet_length(table.c.body) == 0)
+        )
+        return result.scalar_one_or_none()
+
+    async def _acquire_body(self, digest: str, body: bytes) -> None:
+        table = HttpCacheBody.__table__
+        statement = pg_insert(table).values(digest=digest, body=body, nref=1)
+        await self.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[table.c.digest], set_={"nref": table.c.nref + 1}
+            )
+        )
+
+    async def _release_body(self, digest: str, n: int = 1) -> None:
+        table = HttpCacheBody.__table__
+        await self.session.execute(
+            update(table).where(table.c.digest == digest).values(nref=table.c.nref - n)
+        )
+        await self.session.execute(
+            delete(table).where(table.c.digest == digest).where(table.c.nref <= 0)
+        )
+
+    async def _dedup_body(self, data: CreateType) -> CreateType:
+        """Move the body of `data` to `http_cache_bodies`, in the current transaction."""
+        digest: str = data.body_digest or body_digest(data.get_body(self.dicts)).hex()
+        await self._lock_urls(self._url_hashes([data.url]))
+        old: Optional[str] = await self._shared_body_digest(
+            self.meta.table.c.url == data.url
+        )
+        if old != digest:
+            await self._acquire_body(digest, data.body)
+            if old is not None:
+                await self._release_body(old)
+
+        values: dict = data.dict()
+        values |= {"body": b"", "body_digest": digest}
+        return type(data)(**values)
+
+    async def upsert(self, data: CreateType, **kwargs) -> HttpCacheItem:
+        """Create or patch a cache item, and share its body with `dedup_bodies`.
+
+        `upsert_many` and the bulk loader always store bodies inline
+        """
+        if self.dedup_bodies and data.body:
+            data = await self._dedup_body(data)
+        else:
+            content_hash: str = self._content_hash(data.dict())
+            await self._release_replaced_bodies(
+                [{"url": data.url, "content_hash": content_hash}]
+            )
+
+        return await super().upsert(data, **kwargs)
+
+    async def _upsert_chunk(self, rows: List[dict]) -> UpsertManyResult:
+        """Upsert one chunk of cache items inline, releasing the shared bodies they replace."""
+        await self._release_replaced_bodies(rows)
+        return await super()._upsert_chunk(rows)
+
+    async def _before_bulk_merge(self, latest: Subquery) -> None:
+        """Release the shared bodies of the cache items that the bulk loader will replace."""
+        table = self.meta.table
+        bodies = HttpCacheBody.__table__
+        h = func.hashtext(latest.c.url).label("h")
+        await self._lock_urls(select(h).distinct().order_by(h).subquery("hashes"))
+
+        replaced = (
+            select(table.c.body_digest, func.count().label("n"))
+            .select_from(table.join(latest, latest.c.url == table.c.url))
+            .where(table.c.body_digest.is_not(None))
+            .where(func.octet_length(table.c.body) == 0)
+            .where(table.c.content_hash.is_distinct_from(latest.c.content_hash))
+            .group_by(table.c.body_digest)
+            .subquery("replaced")
+        )
+        await self.session.execute(
+            update(bodies)
+            .where(bodies.c.digest == replaced.c.body_digest)
+            .values(nref=bodies.c.nref - replaced.c.n)
+        )
+        await self.session.execute(
+            delete(bodies)
+            .where(bodies.c.digest.in_(select(replaced.c.body_digest)))
+            .where(bodies.c.nref <= 0)
+        )
+
+    async def delete(self, model_id: str | UUID) -> bool:
+        """Delete a cache item, and release its shared body."""
+        digest: Optional[str] = await self._shared_body_digest(
+            self.meta.id_col == str(model_id)
+        )
+        if digest is not None:
+            await self._release_body(digest)
+
+        return await super().delete(model_id)
+
+    async def delete_many(self, model_ids: List[str | UUID]) -> int:
+        """Delete cache items with one statement, and release their shared bodies."""
+        if not model_ids:
+            return 0
+
+        table = self.meta.table
+        result = await self.session.execute(
+            delete(table)
+            .where(self.meta.id_col.in_([str(i) for i in model_ids]))
+            .returning(
+                table.c.body_digest,
+                (func.octet_length(table.c.body) == 0).label("shared"),
+            )
+        )
+        rows = result.all()
+        shared = Counter(digest for digest, is_shared in rows if is_shared and digest)
+        for digest, n in shared.items():
+            await self._release_body(digest, n)
+
+        await self._commit()
+        return len(rows)
+
+    async def get_body(self, item: HttpCacheItem) -> bytes:
+        """Get the decompressed body of `item`, also when it is shared."""
+        if item.body or item.body_digest is None:
+            return item.get_body(self.dicts)
+
+        table = HttpCacheBody.__table__
+        result = await self._read_session().execute(
+            select(table.c.body).where(table.c.digest == item.body_digest)
+        )
+        return decode_body_frame(result.scalar_one(), self.dicts)
@@ -1,12 +1,19 @@
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from ...core.db import get_async_session, yield_async_Session
+from ...core.db import yield_async_read_session, yield_async_session
 from .crud import CacheCRUD
 
 
 async def get_cache_crud(
     # session: AsyncSession = Depends(get_async_session)
-    session: AsyncSession = Depends(yield_async_Session),
+    session: AsyncSession = Depends(yield_async_session),
+    # the read replica if configured, see `get_async_read_session`
+    read_session: AsyncSession = Depends(yield_async_read_session),
 ) -> CacheCRUD:
-    return CacheCRUD(session=session)
+    """Cache CRUD with reads routed to the read replica.
+
+    Apps bind the connection strings by overriding `yield_async_session` and
+    `yield_async_read_session` in `app.dependency_overrides`
+    """
+    return CacheCRUD(session=session, read_session=read_session)
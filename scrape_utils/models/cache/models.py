@@ -1,15 +1,17 @@
 import sys
 from datetime import datetime
-from typing import Final, Optional, Self
+from typing import ClassVar, Final, FrozenSet, Optional, Self
 
 import lz4.block as lz4  # type: ignore[import]
 from pydantic import BaseModel
-from scrape_utils.models.main import UUIDModel
+from scrape_utils.models.main import TimestampModel, UUIDModel
 # from scrapy.http import Headers
 from sqlalchemy.orm import registry
 from sqlmodel import Field
 
 # from ..scrape import ScrapeBaseMixin
+from ...cache_http.codecs import (BodyCodec, ZstdDictionaries, body_digest,
+                                  decode_body_frame, encode_body_frame)
 from ..scrape import ScrapeBase
 
 mapper_registry = registry()
@@ -26,9 +28,19 @@ class HttpCacheItemBase(ScrapeBase):
     url: str = Field(nullable=False, unique=True, index=True)
     # headers: Headers
     headers: Optional[bytes] = Field(nullable=True)
-    # compressed bytes
+    # compressed bytes, empty when the body is stored once in `http_cache_bodies`
     body: bytes = Field(nullable=False)
-    time: float = Field(nullable=False)
+    # hex digest of the uncompressed body
+    body_digest: Optional[str] = Field(default=None, nullable=True, index=True)
+    # oldest entries are evicted first, see `cache_http/eviction.py`
+    time: float = Field(nullable=False, index=True)
+
+    # `time` and response headers (Date, ..) change on every fetch. Unchanged refetches
+    # still refresh `time`, see `CacheCRUD._seen_values`
+    fingerprint_exclude: ClassVar[FrozenSet[str]] = ScrapeBase.fingerprint_exclude | {
+        "time",
+        "headers",
+    }
 
     def __repr__(self):
         return (
@@ -50,28 +62,63 @@ class HttpCacheItem(HttpCacheItemBase, UUIDModel, table=True):
     @classmethod
     # requires py 3.11
     # def from_response(cls, response):
-    def from_response(cls, response) -> Self:
+    def from_response(
+        cls,
+        response,
+        codec: Optional[BodyCodec] = None,
+        dicts: Optional[ZstdDictionaries] = None,
+    ) -> Self:
+        """Create from a scrapy response.
+
+        Without `codec` the body is plain `lz4.block`, else a body frame of `codec`
+        """
         time: Final[float] = datetime.utcnow().timestamp()
         # time = datetime.utcnow().timestamp()
 
+        body: bytes = (
+            lz4.compress(response.body)
+            if codec is None
+            else encode_body_frame(response.body, response.url, codec, dicts)
+        )
+
         data = {
             "status": response.status,
             "url": response.url,
-            "headers": response.headers.to_string,
+            "headers": response.headers.to_string(),
             # "body": _compress(response.body),
-            "body": lz4.compress(response.body),
+            "body": body,
+            "body_digest": body_digest(response.body).hex(),
             "time": time,
             "last_scraped": datetime.utcnow(),
         }
 
         return cls(**data)
 
+    def get_body(self, dicts: Optional[ZstdDictionaries] = None) -> bytes:
+        """Decompress the body, framed or plain `lz4.block`."""
+        if not self.body and self.body_digest is not None:
+            raise ValueError(f"body of {self.url} is shared, use `CacheCRUD.get_body`")
+
+        return decode_body_frame(self.body, dicts)
+
     __mapper_args__ = {
         "polymorphic_identity": "http_cache_items",
         # "concrete": True,
     }
 
 
+class HttpCacheBody(TimestampModel, table=True):
+    """Response body stored once, for all cache items with the same `body_digest`."""
+
+    __tablename__ = "http_cache_bodies"
+
+    digest: str = Field(primary_key=True)
+    # body frame, see `cache_http.codecs.encode_body_frame`
+    body: bytes = Field(nullable=False)
+    # number of cache items that reference this body
+    nref: int = Field(default=0, nullable=False)
+
+
 class HttpCacheItemRead(HttpCacheItemBase):
     pass
 
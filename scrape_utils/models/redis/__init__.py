@@ -1,2 +1,4 @@
 from .manager import *
 from .models import *
+from .structs import *
+from .batch import *
@@ -0,0 +1,143 @@
+"""batch.py.
+
+Columnar batches of sitemap records
+
+A `SitemapBatch` holds all urls in one numpy object array, and all `lastmod`
+values in one int64 array of epoch seconds, instead of one python object per url
+"""
+import logging
+from datetime import datetime
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from dateutil import tz
+
+from .models import SitemapRecord, UrlRecord
+from .structs import SitemapStruct, UrlStruct
+
+logger = logging.getLogger(__name__)
+
+
+class SitemapBatch:
+    """Columnar batch of sitemap records.
+
+    `lastmod` is stored as epoch seconds, like the score in the sitemap zset.
+    Rows without `lastmod` get 0
+    """
+
+    __slots__ = ("urls", "lastmod")
+
+    def __init__(self, urls: np.ndarray, lastmod: Optional[np.ndarray] = None) -> None:
+        urls = np.asarray(urls, dtype=object)
+        if lastmod is None:
+            lastmod = np.zeros(len(urls), dtype=np.int64)
+        lastmod = np.asarray(lastmod, dtype=np.int64)
+        assert (
+            urls.ndim == 1 and urls.shape == lastmod.shape
+        ), f"{urls.shape=} {lastmod.shape=}"
+        self.urls: np.ndarray = urls
+        self.lastmod: np.ndarray = lastmod
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(n={len(self):,})"
+
+    def __getitem__(self, index: Any) -> "SitemapBatch | SitemapStruct":
+        """Select one row by integer, or a batch of rows by slice, index array or boolean mask."""
+        if isinstance(index, (int, np.integer)):
+            return SitemapStruct(self.urls[index], int(self.lastmod[index]))
+        return SitemapBatch(self.urls[index], self.lastmod[index])
+
+    def __iter__(self) -> Iterator[SitemapStruct]:
+        for url, lastmod in zip(self.urls, self.lastmod.tolist()):
+            yield SitemapStruct(url, lastmod)
+
+    @classmethod
+    def empty(cls) -> "SitemapBatch":
+        return cls(np.empty(0, dtype=object))
+
+    @classmethod
+    def from_pairs(cls, items: List[Tuple[str, float]]) -> "SitemapBatch":
+        """Create from (url, score) pairs, as returned by ZRANGE .. WITHSCORES."""
+        n: int = len(items)
+        urls = np.empty(n, dtype=object)
+        urls[:] = [url for url, _ in items]
+        lastmod = np.fromiter((score for _, score in items), dtype=np.float64, count=n)
+        return cls(urls, lastmod.astype(np.int64))
+
+    @classmethod
+    def from_records(
+        cls,
+        records: Iterable[SitemapRecord | SitemapStruct | UrlRecord | UrlStruct | dict],
+    ) -> "SitemapBatch":
+        urls: List[str] = []
+        lastmods: List[int] = []
+        for r in records:
+            if isinstance(r, dict):
+                url, lastmod = r["url"], r.get("lastmod")
+            else:
+                url, lastmod = r.url, getattr(r, "lastmod", None)
+
+            if isinstance(lastmod, datetime):
+                lastmod = int(lastmod.timestamp())
+            urls.append(url)
+            lastmods.append(lastmod or 0)
+
+        return cls(np.array(urls, dtype=object), np.array(lastmods, dtype=np.int64))
+
+    @classmethod
+    def from_frame(
+        cls, df: pd.DataFrame, url_col: str = "url", lastmod_col: str = "lastmod"
+    ) -> "SitemapBatch":
+        """Create from a DataFrame, naive `lastmod` datetimes are taken as local time."""
+        urls: np.ndarray = df[url_col].to_numpy(dtype=object)
+        if lastmod_col not in df:
+            return cls(urls)
+
+        lastmod = df[lastmod_col]
+        if pd.api.types.is_datetime64_any_dtype(lastmod):
+            if lastmod.dt.tz is None:
+                lastmod = lastmod.dt.tz_localize(tz.tzlocal())
+            lastmod = lastmod.dt.tz_convert("UTC").dt.tz_localize(None)
+            epoch = (lastmod - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+            return cls(urls, epoch.fillna(0).to_numpy(dtype=np.int64))
+
+        return cls(urls, lastmod.fillna(0).to_numpy(dtype=np.int64))
+
+    def lastmod_datetimes(self) -> pd.Series:
+        """Get `lastmod` as naive local datetimes, like `datetime.fromtimestamp`."""
+        return (
+            pd.Series(pd.to_datetime(self.lastmod, unit="s", utc=True))
+            .dt.tz_convert(tz.tzlocal())
+            .dt.tz_localize(None)
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({"url": self.urls, "lastmod": self.lastmod_datetimes()})
+
+    def to_records(self) -> List[SitemapRecord]:
+        """Convert to pydantic models, for API compatibility."""
+        return [struct.to_record() for struct in self]
+
+    def head(self, n: int) -> "SitemapBatch":
+        return self[:n]
+
+    def sample(self, n: int, seed: Optional[int] = None) -> "SitemapBatch":
+        """Take a random sample of `n` rows, without replacement."""
+        n = min(n, len(self))
+        index: np.ndarray = np.random.default_rng(seed).choice(
+            len(self), size=n, replace=False
+        )
+        return self[index]
+
+    def sort_by_lastmod(self, descending: bool = True) -> "SitemapBatch":
+        index: np.ndarray = np.argsort(self.lastmod, kind="stable")
+        return self[index[::-1] if descending else index]
+
+    def chunks(self, chunk_size: int) -> Iterator["SitemapBatch"]:
+        assert chunk_size > 0, f"{chunk_size=}"
+        for i in range(0, len(self), chunk_size):
+            yield self[i : i + chunk_size]
@@ -9,6 +9,7 @@ import logging
 import os
 import urllib
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Callable, Dict, Final, List, Optional, Tuple
 
@@ -17,16 +18,20 @@ import requests  # type: ignore[import]
 from fastapi import status
 from rarc_utils.misc import validate_url
 from redis import asyncio as aioredis
-from scrape_utils.core.db import get_session  # type: ignore[import]
-from scrape_utils.core.redis_connection import redis_connection
 from sqlmodel import select
 from yapic import json  # type: ignore[import]
 
+from scrape_utils.core.db import get_read_session  # type: ignore[import]
+from scrape_utils.core.redis_connection import redis_connection
+
 from ...cache_http.helpers import get_start_urls_from_pg_cache
-from ...core.settings import REDIS_SITEMAP_KEY_FORMAT, START_URLS_KEY
+from ...core.settings import (REDIS_PUSH_CHUNK_SIZE, REDIS_SITEMAP_KEY_FORMAT,
+                              START_URLS_KEY)
 from ...types import ModelType, ScrapeItemType
+from .batch import SitemapBatch
 from .models import (CollectionBase, DataSourceScrapeItems, DataSourceUrls,
-                     SitemapRecord, UrlRecord)
+                     RecordFormat, SitemapRecord, UrlRecord)
+from .structs import ScrapeItemStruct, SitemapStruct, UrlStruct
 
 logger = logging.getLogger(__name__)
 
@@ -102,17 +107,32 @@ def sitemap_record_from_row(row: pd.Series) -> SitemapRecord:
     return SitemapRecord(**str_row)
 
 
-# TODO: move out of redis/helpers.py
-def parse_dict_to_model(
-    item: dict, model_class: ModelType, from_json: str = "from_json"
-) -> Optional[ModelType]:
-    """Implement generic parse method for any model_class."""
+@lru_cache(maxsize=None)
+def _get_from_json_method(model_class: ModelType, from_json: str) -> Callable:
+    """Resolve the parse method of `model_class` once."""
     assert hasattr(model_class, from_json)
     from_json_method: Callable = getattr(model_class, from_json)
     assert callable(from_json_method)
+    return from_json_method
+
+
+# TODO: move out of redis/helpers.py
+def parse_dict_to_model(
+    item: dict,
+    model_class: ModelType,
+    from_json: str = "from_json",
+    trusted: bool = False,
+) -> Optional[ModelType]:
+    """Implement generic parse method for any model_class.
+
+    `trusted=True` skips validation, for items produced by our own spiders
+    """
+    from_json_method: Callable = _get_from_json_method(model_class, from_json)
 
     try:
         # return from_json_method(item["item"], last_scraped=item["crawled"])
+        if trusted:
+            return from_json_method(item["item"], trusted=True)
         return from_json_method(item["item"])
 
     except Exception as e:
@@ -123,13 +143,16 @@ def parse_dict_to_model(
 
 
 def filter_existing_start_urls(
-    db_connection_str: str, start_urls: List[SitemapRecord], model=None
+    db_connection_str: str,
+    start_urls: List[SitemapRecord],
+    model=None,
+    replica_connection_str: Optional[str] = None,
 ) -> List[SitemapRecord]:
     """Filter out existing start urls that exist in pg."""
     assert model is not None
     # get all urls from pg
     q = select(model.url)
-    session = get_session(db_connection_str, echo=False)
+    session = get_read_session(db_connection_str, replica_connection_str, echo=False)
     res = list(session.execute(q).scalars().fetchall())
 
     logger.info(f"{res[:5]=}")
@@ -157,11 +180,19 @@ async def get_scrape_urls_from_source(
     events_sitemap_xml_file=None,
     collection_as_singular=False,
     reverse=False,
-) -> List[SitemapRecord]:
-    """Get scrape urls from source."""
+    replica_connection_str: Optional[str] = None,
+    record_format: RecordFormat = RecordFormat.dict,
+) -> List[SitemapRecord] | SitemapBatch:
+    """Get scrape urls from source.
+
+    `RecordFormat.batch` returns one columnar `SitemapBatch`, without per-url objects
+    """
     assert scrape_urls_file is not None
     assert events_sitemap_xml_file is not None
-    scrape_urls: List[SitemapRecord] = []
+    as_batch: bool = record_format == RecordFormat.batch
+    scrape_urls: List[SitemapRecord] | SitemapBatch = (
+        SitemapBatch.empty() if as_batch else []
+    )
 
     match data_source:
         case DataSourceUrls.sitemap:
@@ -182,6 +213,10 @@ async def get_scrape_urls_from_source(
             logger.info(
                 f"read {df.shape[0]:,} {RANDOM_OR_HEAD} rows from {events_sitemap_xml_file}"
             )
+            if as_batch:
+                # keep no lastmod, like the records below
+                return SitemapBatch(df["url"].to_numpy(dtype=object))
+
             df = df.drop(columns=["lastmod"])
             scrape_urls = df.to_dict(orient="records")
 
@@ -193,17 +228,23 @@ async def get_scrape_urls_from_source(
             with open(scrape_urls_file, "r", encoding="utf-8") as f:
                 scrape_urls = [json.loads(line) for line in f]
 
+            if as_batch:
+                scrape_urls = SitemapBatch.from_records(scrape_urls)
+
         # load sitemap from redis list
         case DataSourceUrls.redis:
             async with redis_connection(redis_pool) as client:
                 # TODO: use pipeline to have real async benefits
 
-                records: List[SitemapRecord] = await get_sitemap_items(
+                records: List[SitemapRecord] | SitemapBatch = await get_sitemap_items(
                     client,
                     collection,
                     maxn,
                     reverse=reverse,
                     collection_as_singular=collection_as_singular,
+                    record_format=RecordFormat.batch
+                    if as_batch
+                    else RecordFormat.pydantic,
                 )
 
                 logger.info(f"{records[:2]=}")
@@ -218,12 +259,18 @@ async def get_scrape_urls_from_source(
                 # df = df.drop(columns=["lastmod"])
 
                 # scrape_urls = df.to_dict(orient="records")
-                scrape_urls = [r.dict() for r in records]
+                scrape_urls = records if as_batch else [r.dict() for r in records]
 
         case DataSourceUrls.pg_http_cache:
             # get url from existing http_cache
-            session = get_session(db_connection_str, echo=False)
-            scrape_urls = get_start_urls_from_pg_cache(session, limit=maxn)
+            session = get_read_session(
+                db_connection_str, replica_connection_str, echo=False
+            )
+            scrape_urls = get_start_urls_from_pg_cache(
+                session,
+                limit=maxn,
+                record_format=RecordFormat.batch if as_batch else RecordFormat.pydantic,
+            )
             # logger.info(f"{scrape_urls=}")
 
         case other:
@@ -238,8 +285,13 @@ async def get_sitemap_items(
     n: Optional[int],
     collection_as_singular: bool = False,
     reverse: bool = False,
-) -> List[SitemapRecord]:
-    """Get sitemap items from redis."""
+    record_format: RecordFormat = RecordFormat.pydantic,
+) -> List[SitemapRecord] | List[SitemapStruct] | List[dict] | SitemapBatch:
+    """Get sitemap items from redis.
+
+    Use `RecordFormat.struct` or `RecordFormat.batch` for millions of records,
+    `lastmod` stays an integer timestamp
+    """
     sitemap_redis_key: Final[str] = REDIS_SITEMAP_KEY_FORMAT.format(
         collection=collection.name
         # if not collection_as_singular
@@ -264,6 +316,19 @@ async def get_sitemap_items(
             sitemap_redis_key, 0, -1 if n is None else n, withscores=True
         )
 
+    match record_format:
+        case RecordFormat.batch:
+            return SitemapBatch.from_pairs(items)
+
+        case RecordFormat.struct:
+            return [SitemapStruct(url, int(lastmod)) for url, lastmod in items]
+
+        case RecordFormat.dict:
+            return [
+                {"url": url, "lastmod": datetime.fromtimestamp(int(lastmod))}
+                for url, lastmod in items
+            ]
+
     records: List[SitemapRecord] = [
         SitemapRecord(
             url=url,
@@ -300,12 +365,14 @@ async def push_sitemap_record_to_redis(
 
 
 async def push_redis_to_scrape(
-    client: aioredis.Redis, item: UrlRecord | dict, noPriority: bool = True
+    client: aioredis.Redis, item: UrlRecord | UrlStruct | dict, noPriority: bool = True
 ) -> None:
     """Push to_scrape items to redis list."""
-    assert isinstance(item, (UrlRecord, dict)), f"{type(item)=}"
+    assert isinstance(item, (UrlRecord, UrlStruct, dict)), f"{type(item)=}"
     if isinstance(item, UrlRecord):
         item = item.dict()
+    elif isinstance(item, UrlStruct):
+        item = item.to_dict()
 
     # TODO: check valid url format
 
@@ -316,6 +383,61 @@ async def push_redis_to_scrape(
     await client.rpush(START_URLS_KEY, json.dumps(item))
 
 
+async def push_batch_to_scrape(
+    client: aioredis.Redis,
+    batch: SitemapBatch,
+    noPriority: bool = True,
+    chunk_size: int = REDIS_PUSH_CHUNK_SIZE,
+) -> int:
+    """Push urls of a batch to the to_scrape list, with multi-value pushes in one pipeline.
+
+    Same item format and order as calling `push_redis_to_scrape` per `SitemapRecord`
+    """
+    assert isinstance(batch, SitemapBatch), f"{type(batch)=}"
+    assert chunk_size > 0, f"{chunk_size=}"
+    if len(batch) == 0:
+        return 0
+
+    async with client.pipeline(transaction=False) as pipe:
+        for chunk in batch.chunks(chunk_size):
+            values: List[str] = [
+                json.dumps({"url": url, "lastmod": datetime.fromtimestamp(lastmod)})
+                for url, lastmod in zip(chunk.urls, chunk.lastmod.tolist())
+            ]
+            if noPriority:
+                pipe.lpush(START_URLS_KEY, *values)
+            else:
+                pipe.rpush(START_URLS_KEY, *values)
+        await pipe.execute()
+
+    logger.info(f"pushed {len(batch):,} urls to `{START_URLS_KEY}`")
+    return len(batch)
+
+
+async def push_sitemap_batch_to_redis(
+    client: aioredis.Redis,
+    collection: CollectionBase,
+    batch: SitemapBatch,
+    chunk_size: int = REDIS_PUSH_CHUNK_SIZE,
+) -> int:
+    """Push a batch to the sitemap zset, with one ZADD per chunk in one pipeline."""
+    assert isinstance(batch, SitemapBatch), f"{type(batch)=}"
+    assert chunk_size > 0, f"{chunk_size=}"
+    sitemap_redis_key: Final[str] = REDIS_SITEMAP_KEY_FORMAT.format(
+        collection=collection.name
+    )
+    if len(batch) == 0:
+        return 0
+
+    async with client.pipeline(transaction=False) as pipe:
+        for chunk in batch.chunks(chunk_size):
+            pipe.zadd(sitemap_redis_key, dict(zip(chunk.urls, chunk.lastmod.tolist())))
+        await pipe.execute()
+
+    logger.info(f"pushed {len(batch):,} items to `{sitemap_redis_key}`")
+    return len(batch)
+
+
 ############################
 #### scrape_item methods
 ############################
@@ -333,12 +455,33 @@ async def rem_none_items(client: aioredis.Redis, items_key: str) -> None:
     await client.lrem(items_key, 0, "null")
 
 
+def _decode_scrape_items(
+    res: List[str], record_format: RecordFormat
+) -> List[dict] | List[ScrapeItemStruct]:
+    """Decode json scrape items, skipping `null` items."""
+    match record_format:
+        case RecordFormat.dict:
+            items: List[dict] = [json.loads(i) for i in res]
+            return [i for i in items if i is not None]
+
+        case RecordFormat.struct:
+            return [
+                ScrapeItemStruct.from_dict(d)
+                for d in map(json.loads, res)
+                if d is not None
+            ]
+
+        case other:
+            raise NotImplementedError(f"{other=}")
+
+
 async def get_redis_scrape_items(
     client: aioredis.Redis,
     items_key: str,
-    n: int
+    n: int,
+    record_format: RecordFormat = RecordFormat.dict,
     # ) -> List[ScrapeItemType]:
-) -> List[dict]:
+) -> List[dict] | List[ScrapeItemStruct]:
     """Get scrape_items from redis."""
     assert n > 0 or n == -1, f"{n=}"
     # n=1 should return one item
@@ -351,10 +494,7 @@ async def get_redis_scrape_items(
     res: List[str] = await client.lrange(items_key, 0, endRange)
 
     # items: List[ScrapeItemType] = [json.loads(i) for i in res]
-    items: List[dict] = [json.loads(i) for i in res]
-    items = [i for i in items if i is not None]
-
-    return items
+    return _decode_scrape_items(res, record_format)
 
 
 async def get_scrape_items(
@@ -388,9 +528,10 @@ async def get_scrape_items(
 async def pop_list_items(
     client: aioredis.Redis,
     items_key: str,
-    n: int
+    n: int,
+    record_format: RecordFormat = RecordFormat.dict,
     # ) -> Optional[List[ScrapeItemType]]:
-) -> Optional[List[dict]]:
+) -> Optional[List[dict] | List[ScrapeItemStruct]]:
     """Pop (scrape) items from redis list.
 
     `n` is required so that new incoming items are not deleted
@@ -407,10 +548,7 @@ async def pop_list_items(
     logger.debug(f"popped {len(res):,} {ITEMS} from `{items_key}`")
 
     # items: List[ScrapeItemType] = [json.loads(i) for i in res]
-    items: List[dict] = [json.loads(i) for i in res]
-    items = [i for i in items if i is not None]
-
-    return items
+    return _decode_scrape_items(res, record_format)
 
 
 async def push_list_item(
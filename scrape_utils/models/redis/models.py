@@ -18,6 +18,19 @@ class DataSourceScrapeItems(str, Enum):
     jl_file = "jl_file"
 
 
+class RecordFormat(str, Enum):
+    """Output format of the redis readers."""
+
+    # plain dicts, as decoded from json
+    dict = "dict"
+    # pydantic models, e.g. SitemapRecord
+    pydantic = "pydantic"
+    # compact slotted structs, e.g. SitemapStruct
+    struct = "struct"
+    # one columnar SitemapBatch, only for sitemap records
+    batch = "batch"
+
+
 class UrlRecord(BaseModel):
     url: str
 
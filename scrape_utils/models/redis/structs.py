@@ -0,0 +1,176 @@
+"""structs.py.
+
+Compact struct equivalents of the redis record models
+
+Structs use `__slots__` instead of pydantic, and skip validation, so holding millions
+of sitemap records costs a fraction of the memory and decode time.
+They encode directly to json, or to msgpack arrays if `msgpack` is installed.
+Use `to_record` / `from_record` to convert from and to the pydantic models
+"""
+import logging
+from datetime import datetime
+from typing import Any, ClassVar, Dict, Optional, Tuple, Type, TypeVar
+
+from yapic import json  # type: ignore[import]
+
+from .models import ScrapeItemBase, SitemapRecord, UrlRecord
+
+try:
+    import msgpack  # type: ignore[import]
+except ModuleNotFoundError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+StructT = TypeVar("StructT", bound="RecordStruct")
+
+
+class RecordStruct:
+    """Base struct, subclasses list their fields in `__slots__`."""
+
+    __slots__: Tuple[str, ...] = ()
+    # all fields, including those of base classes, in encoding order
+    _fields: ClassVar[Tuple[str, ...]] = ()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(
+            field
+            for klass in reversed(cls.__mro__)
+            for field in klass.__dict__.get("__slots__", ())
+        )
+
+    def __repr__(self) -> str:
+        values: str = ", ".join(f"{f}={getattr(self, f)!r}" for f in self._fields)
+        return f"{self.__class__.__name__}({values})"
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.to_tuple() == other.to_tuple()
+
+    # structs are mutable and compared by value, so unhashable like the pydantic models
+    __hash__ = None  # type: ignore[assignment]
+
+    def to_tuple(self) -> Tuple:
+        return tuple(getattr(self, f) for f in self._fields)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in self._fields}
+
+    @classmethod
+    def from_dict(cls: Type[StructT], data: dict) -> StructT:
+        return cls(**{f: data.get(f) for f in cls._fields})
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls: Type[StructT], data: str | bytes) -> StructT:
+        return cls.from_dict(json.loads(data))
+
+    def to_msgpack(self) -> bytes:
+        """Encode as msgpack array, field names are not stored.
+
+        Datetimes are encoded as iso strings, as in json
+        """
+        _check_msgpack()
+        return msgpack.packb(self.to_tuple(), default=_msgpack_default)
+
+    @classmethod
+    def from_msgpack(cls: Type[StructT], data: bytes) -> StructT:
+        _check_msgpack()
+        return cls(*msgpack.unpackb(data))
+
+
+def _msgpack_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"cannot encode {type(value)=} to msgpack")
+
+
+def _check_msgpack() -> None:
+    if msgpack is None:
+        raise ModuleNotFoundError("install `msgpack` to use msgpack encoding")
+
+
+class UrlStruct(RecordStruct):
+    __slots__ = ("url",)
+
+    def __init__(self, url: str) -> None:
+        self.url: str = url
+
+    def to_record(self) -> UrlRecord:
+        return UrlRecord.construct(url=self.url)
+
+    @classmethod
+    def from_record(cls, record: UrlRecord) -> "UrlStruct":
+        return cls(record.url)
+
+
+class SitemapStruct(UrlStruct):
+    """Sitemap record, `lastmod` is stored as integer epoch seconds, like the zset score."""
+
+    __slots__ = ("lastmod",)
+
+    def __init__(self, url: str, lastmod: int) -> None:
+        self.url: str = url
+        self.lastmod: int = lastmod
+
+    @property
+    def lastmod_datetime(self) -> datetime:
+        return datetime.fromtimestamp(self.lastmod)
+
+    def to_record(self) -> SitemapRecord:
+        return SitemapRecord.construct(url=self.url, lastmod=self.lastmod_datetime)
+
+    @classmethod
+    def from_record(cls, record: SitemapRecord) -> "SitemapStruct":
+        return cls(record.url, int(record.lastmod.timestamp()))
+
+
+class ScrapeItemStruct(RecordStruct):
+    """Scrape item as pushed by the spiders.
+
+    `crawled` is kept as decoded, yapic json already parses date strings to datetime
+    """
+
+    __slots__ = ("item", "crawled", "spider", "type", "version")
+
+    def __init__(
+        self,
+        item: dict,
+        crawled: str | datetime,
+        spider: str,
+        type: str,
+        version: Optional[str] = None,
+    ) -> None:
+        self.item: dict = item
+        self.crawled: str | datetime = crawled
+        self.spider: str = spider
+        self.type: str = type
+        self.version: Optional[str] = version
+
+    def to_record(self) -> ScrapeItemBase:
+        """Convert to ScrapeItemBase, without validating `type` against a collection."""
+        crawled = self.crawled
+        if not isinstance(crawled, datetime):
+            crawled = datetime.fromisoformat(crawled)
+
+        return ScrapeItemBase.construct(
+            item=self.item,
+            crawled=crawled,
+            spider=self.spider,
+            type=self.type,
+            version=self.version,
+        )
+
+    @classmethod
+    def from_record(cls, record: ScrapeItemBase) -> "ScrapeItemStruct":
+        return cls(
+            record.item,
+            record.crawled,
+            record.spider,
+            getattr(record.type, "value", record.type),
+            record.version,
+        )
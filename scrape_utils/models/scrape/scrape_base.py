@@ -1,14 +1,30 @@
+import hashlib
+import json
 from datetime import datetime
-from typing import List
+from typing import ClassVar, FrozenSet, List, Optional
 
 from sqlalchemy import Column, DateTime, Integer, String
 from sqlalchemy.ext.declarative import ConcreteBase
 from sqlmodel import Field, Relationship, SQLModel
 
+from ...core.settings import CONTENT_HASH_DIGEST_SIZE
 # from ...models import Base
 from ...models import BaseScrapeUtility
 from ...models.scrape.scrape_update import ScrapeUpdate
 
+# bookkeeping fields, these do not describe the scraped content
+FINGERPRINT_EXCLUDE_BASE: FrozenSet[str] = frozenset(
+    [
+        "uuid",
+        "id",
+        "created_at",
+        "updated_at",
+        "last_scraped",
+        "last_seen",
+        "content_hash",
+    ]
+)
+
 # TODO: trying to rewrite into mixin, so that table can be reused in many projects
 # without depending on same Base metadata
 # class ScrapeBaseMixin(BaseScrapeUtility):
@@ -50,8 +66,16 @@ class ScrapeBase(BaseScrapeUtility):
     created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
     updated_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
 
+    # fingerprint of the scraped content, used to skip no-op writes
+    content_hash: Optional[str] = Field(default=None, nullable=True)
+    # last time the item was scraped without changes
+    last_seen: Optional[datetime] = Field(default=None, nullable=True)
+
     updates: List[ScrapeUpdate] = Relationship(back_populates="scrape_base")
 
+    # fields that are ignored when computing `content_hash`
+    fingerprint_exclude: ClassVar[FrozenSet[str]] = FINGERPRINT_EXCLUDE_BASE
+
     __mapper_args__ = {
         "polymorphic_identity": "scrape_base",
         # "polymorphic_identity": None,
@@ -60,6 +84,31 @@ class ScrapeBase(BaseScrapeUtility):
         "concrete": True,
     }
 
+    @classmethod
+    def content_fingerprint(cls, values: dict) -> str:
+        """Compute a stable fingerprint of the scraped content.
+
+        Fields in `fingerprint_exclude` are skipped, so that re-scraping
+        an unchanged page results in the same hash
+        """
+        hasher = hashlib.blake2b(digest_size=CONTENT_HASH_DIGEST_SIZE)
+        for key in sorted(values):
+            if key in cls.fingerprint_exclude:
+                continue
+
+            value = values[key]
+            hasher.update(key.encode())
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                hasher.update(b"\x00b")
+                hasher.update(value)
+            else:
+                # stdlib json, since yapic cannot sort nested keys
+                hasher.update(b"\x00j")
+                hasher.update(json.dumps(value, sort_keys=True, default=str).encode())
+            hasher.update(b"\x01")
+
+        return hasher.hexdigest()
+
 
 # class Scrapable(ScrapeBase):
 #     __abstract__ = True
@@ -1 +1,3 @@
 from .models import *
+from .partitions import *
+from .writer import *
@@ -1,6 +1,7 @@
 import uuid as uuid_pkg
 
-from sqlalchemy import Column, DateTime, Index, String, func
+from sqlalchemy import (Column, Date, DateTime, Index, Integer, String, func,
+                        text)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_utils import generic_relationship  # type: ignore[import]
@@ -16,13 +17,21 @@ Base = declarative_base()
 
 
 class ScrapeUpdate(Base):
+    """ScrapeUpdate model.
+
+    The table is range partitioned by month on `created_at`, see `partitions.py`.
+    The partition key has to be part of the primary key
+    """
+
     __tablename__ = "scrape_updates"
 
     uuid = Column(UUID(as_uuid=True), primary_key=True, default=uuid_pkg.uuid4)
 
     scrape_type = Column(String(255), nullable=False)
 
-    created_at = Column(DateTime, server_default=func.now())  # current_timestamp()
+    created_at = Column(
+        DateTime, primary_key=True, nullable=False, server_default=func.now()
+    )  # current_timestamp()
 
     # scrape_base_id = Column(UUID(as_uuid=True), nullable=False)
     # to support both UUID and string id types
@@ -35,7 +44,23 @@ class ScrapeUpdate(Base):
         # "concrete": True,
     }
 
-    __table_args__ = (Index("ix_created_at", "created_at"),)
+    __table_args__ = (
+        Index("ix_created_at", "created_at"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+
+class ScrapeUpdateDaily(Base):
+    """Daily aggregates of scrape_updates, kept after old partitions are dropped."""
+
+    __tablename__ = "scrape_updates_daily"
+
+    day = Column(Date, primary_key=True)
+    scrape_type = Column(String(255), primary_key=True)
+
+    nupdate = Column(Integer, nullable=False, server_default=text("0"))
+    # distinct items per day
+    nitem = Column(Integer, nullable=False, server_default=text("0"))
 
 
 # class ScrapeUpdateRead(ScrapeUpdateBase, UUIDModel):
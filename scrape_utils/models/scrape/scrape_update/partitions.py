@@ -0,0 +1,330 @@
+"""partitions.py.
+
+Monthly range partitions of the scrape_updates table
+
+Partitions are named `scrape_updates_y2023m01`. Rows without a matching partition
+end up in `scrape_updates_default`, so inserts never fail.
+Old partitions are rolled up into `scrape_updates_daily` and dropped.
+A `scrape_updates` table created before partitioning is left alone, with a warning,
+until it is converted with `convert_to_partitioned`
+"""
+import logging
+import re
+from datetime import date, datetime
+from typing import List, Optional, Set, Tuple
+
+from sqlalchemy import (Date, cast, column, distinct, event, func, select,
+                        table, text)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Connection
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ....core.settings import (SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT,
+                               SCRAPE_UPDATES_RETAIN_MONTHS_DEFAULT)
+from .models import ScrapeUpdate, ScrapeUpdateDaily
+
+logger = logging.getLogger(__name__)
+
+SCRAPE_UPDATES_TABLE: str = ScrapeUpdate.__tablename__
+DEFAULT_PARTITION: str = f"{SCRAPE_UPDATES_TABLE}_default"
+PARTITION_NAME_FORMAT: str = SCRAPE_UPDATES_TABLE + "_y{year:04d}m{month:02d}"
+PARTITION_NAME_RE = re.compile(rf"^{SCRAPE_UPDATES_TABLE}_y(\d{{4}})m(\d{{2}})$")
+# the table before `convert_to_partitioned`, kept until it is dropped
+UNPARTITIONED_TABLE: str = f"{SCRAPE_UPDATES_TABLE}_unpartitioned"
+
+# months whose partitions were ensured by this process
+_ensured_months: Set[date] = set()
+
+
+def month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(d: date, n: int) -> date:
+    i: int = d.year * 12 + d.month - 1 + n
+    return date(i // 12, i % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return PARTITION_NAME_FORMAT.format(year=month.year, month=month.month)
+
+
+def _partition_ddls(
+    months_ahead: int = SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT,
+    today: Optional[date] = None,
+) -> List[Tuple[str, str]]:
+    """Get (name, ddl) of the default partition, and of the partitions from this month until `months_ahead`."""
+    assert months_ahead >= 0, f"{months_ahead=}"
+    current: date = month_start(today or datetime.utcnow().date())
+
+    ddls: List[Tuple[str, str]] = [
+        (
+            DEFAULT_PARTITION,
+            f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {SCRAPE_UPDATES_TABLE} DEFAULT",
+        )
+    ]
+    for i in range(months_ahead + 1):
+        start: date = add_months(current, i)
+        name: str = partition_name(start)
+        ddls.append(
+            (
+                name,
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {SCRAPE_UPDATES_TABLE} "
+                f"FOR VALUES FROM ('{start}') TO ('{add_months(start, 1)}')",
+            )
+        )
+
+    return ddls
+
+
+@event.listens_for(ScrapeUpdate.__table__, "after_create")
+def _create_partitions(target, connection: Connection, **kwargs) -> None:
+    """Create the first partitions together with the table, e.g. in `create_all`."""
+    for _, ddl in _partition_ddls():
+        connection.execute(text(ddl))
+
+
+async def _relkind(session: AsyncSession, name: str) -> Optional[str]:
+    """Get the pg_class relkind of a table, 'p' when partitioned, None when missing."""
+    result = await session.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+        {"name": name},
+    )
+    return result.scalar()
+
+
+async def is_partitioned(session: AsyncSession) -> bool:
+    return await _relkind(session, SCRAPE_UPDATES_TABLE) == "p"
+
+
+async def ensure_partitions(
+    session: AsyncSession,
+    months_ahead: int = SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT,
+    today: Optional[date] = None,
+) -> List[str]:
+    """Create missing partitions, from this month until `months_ahead`.
+
+    Existing partitions are skipped up front, since CREATE TABLE .. PARTITION OF
+    locks the parent table. A month cannot be created once the default partition
+    holds rows for it, so keep `months_ahead` >= 1. Commit is left to the caller.
+    Nothing is created when the table is not partitioned, see `convert_to_partitioned`
+    """
+    if not await is_partitioned(session):
+        logger.warning(
+            f"`{SCRAPE_UPDATES_TABLE}` is not partitioned, skipping partitions. "
+            "Convert it with `scrape_updates_partitions --convert`"
+        )
+        return []
+
+    created: List[str] = []
+    for name, ddl in _partition_ddls(months_ahead, today):
+        result = await session.execute(
+            text("SELECT to_regclass(:name)"), {"name": name}
+        )
+        if result.scalar() is None:
+            await session.execute(text(ddl))
+            created.append(name)
+
+    if created:
+        logger.info(f"created {SCRAPE_UPDATES_TABLE} partitions: {created}")
+
+    return created
+
+
+def _mark_ensured_on_commit(session: AsyncSession, month: date) -> None:
+    """Mark `month` as ensured once the current transaction commits, not on rollback."""
+    sync_session = session.sync_session
+    transaction = sync_session.get_transaction()
+    # listeners cannot be removed while they are dispatched, so they are disabled
+    active: bool = True
+
+    def after_commit(_session) -> None:
+        # also dispatched when a savepoint is released
+        if active and not _session.in_nested_transaction():
+            _ensured_months.add(month)
+
+    def after_transaction_end(_session, ended) -> None:
+        nonlocal active
+        if ended is transaction:
+            active = False
+
+    event.listen(sync_session, "after_commit", after_commit)
+    event.listen(sync_session, "after_transaction_end", after_transaction_end)
+
+
+async def ensure_current_partitions(session: AsyncSession) -> None:
+    """Ensure partitions once per month and process, before inserting scrape_updates.
+
+    Created partitions are part of the caller's transaction, so the month is only
+    marked as ensured when it commits
+    """
+    month: date = month_start(datetime.utcnow().date())
+    if month in _ensured_months:
+        return
+
+    if await ensure_partitions(session):
+        _mark_ensured_on_commit(session, month)
+    else:
+        _ensured_months.add(month)
+
+
+async def convert_to_partitioned(
+    session: AsyncSession,
+    months_ahead: int = SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT,
+) -> int:
+    """Convert a `scrape_updates` table created before partitioning, returns the rows copied.
+
+    The old table and its indexes are renamed to `scrape_updates_unpartitioned`, the
+    partitioned table is created with a partition for every month it holds, and its
+    rows are copied over, in one transaction that blocks writers until it commits.
+    Rows without `created_at` get the epoch, so they are rolled up first.
+    The old table is kept, drop it once the copy is checked
+    """
+    if await _relkind(session, SCRAPE_UPDATES_TABLE) != "r":
+        logger.info(f"`{SCRAPE_UPDATES_TABLE}` is partitioned or missing, skipping")
+        return 0
+
+    assert (
+        await _relkind(session, UNPARTITIONED_TABLE) is None
+    ), f"`{UNPARTITIONED_TABLE}` already exists"
+
+    # index names are unique per schema, the new table creates the same ones
+    result = await session.execute(
+        text(
+            "SELECT indexname FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename = :name"
+        ),
+        {"name": SCRAPE_UPDATES_TABLE},
+    )
+    for index in result.scalars().all():
+        await session.execute(
+            text(f"ALTER INDEX {index} RENAME TO {index}_unpartitioned")
+        )
+    await session.execute(
+        text(f"ALTER TABLE {SCRAPE_UPDATES_TABLE} RENAME TO {UNPARTITIONED_TABLE}")
+    )
+
+    # `after_create` only creates the partitions of this month and after
+    await session.run_sync(
+        lambda sync_session: ScrapeUpdate.__table__.create(sync_session.connection())
+    )
+    oldest: Optional[datetime] = await session.scalar(
+        text(f"SELECT min(created_at) FROM {UNPARTITIONED_TABLE}")
+    )
+    if oldest is not None:
+        current: date = month_start(datetime.utcnow().date())
+        nmonth: int = (current.year - oldest.year) * 12 + current.month - oldest.month
+        await ensure_partitions(
+            session, months_ahead=nmonth + months_ahead, today=oldest.date()
+        )
+
+    result = await session.execute(
+        text(
+            f"INSERT INTO {SCRAPE_UPDATES_TABLE} "
+            "(uuid, scrape_type, created_at, scrape_base_id) "
+            "SELECT uuid, scrape_type, coalesce(created_at, 'epoch'), scrape_base_id "
+            f"FROM {UNPARTITIONED_TABLE}"
+        )
+    )
+    await session.commit()
+    _ensured_months.clear()
+
+    logger.info(
+        f"converted `{SCRAPE_UPDATES_TABLE}`, copied {result.rowcount:,} rows. "
+        f"Drop `{UNPARTITIONED_TABLE}` once checked"
+    )
+    return result.rowcount
+
+
+async def list_partitions(session: AsyncSession) -> List[str]:
+    result = await session.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:parent AS regclass) ORDER BY c.relname"
+        ),
+        {"parent": SCRAPE_UPDATES_TABLE},
+    )
+    return list(result.scalars().all())
+
+
+def _rollup_statement(source, *where):
+    """Add daily aggregates of `source` rows to `scrape_updates_daily`.
+
+    `nitem` counts distinct items per source, so it is approximate when a day
+    is spread over the default partition and a monthly partition
+    """
+    day = cast(source.c.created_at, Date)
+    src = (
+        select(
+            day,
+            source.c.scrape_type,
+            func.count(),
+            func.count(distinct(source.c.scrape_base_id)),
+        )
+        .where(*where)
+        .group_by(day, source.c.scrape_type)
+    )
+
+    daily = ScrapeUpdateDaily.__table__
+    statement = pg_insert(daily).from_select(
+        ["day", "scrape_type", "nupdate", "nitem"], src
+    )
+    return statement.on_conflict_do_update(
+        index_elements=["day", "scrape_type"],
+        set_={
+            "nupdate": daily.c.nupdate + statement.excluded.nupdate,
+            "nitem": daily.c.nitem + statement.excluded.nitem,
+        },
+    )
+
+
+async def rollup_old_partitions(
+    session: AsyncSession,
+    retain_months: int = SCRAPE_UPDATES_RETAIN_MONTHS_DEFAULT,
+    today: Optional[date] = None,
+) -> List[str]:
+    """Roll up partitions older than `retain_months` into daily aggregates, and drop them.
+
+    Old rows in the default partition are rolled up and deleted as well.
+    Every partition is handled in its own transaction
+    """
+    assert retain_months >= 0, f"{retain_months=}"
+    cutoff: date = add_months(
+        month_start(today or datetime.utcnow().date()), -retain_months
+    )
+
+    dropped: List[str] = []
+    for name in await list_partitions(session):
+        source = table(
+            name,
+            column("created_at"),
+            column("scrape_type"),
+            column("scrape_base_id"),
+        )
+        try:
+            if name == DEFAULT_PARTITION:
+                old = source.c.created_at < cutoff
+                await session.execute(_rollup_statement(source, old))
+                await session.execute(source.delete().where(old))
+                await session.commit()
+                continue
+
+            match = PARTITION_NAME_RE.match(name)
+            if match is None or date(int(match[1]), int(match[2]), 1) >= cutoff:
+                continue
+
+            await session.execute(_rollup_statement(source))
+            await session.execute(
+                text(f"ALTER TABLE {SCRAPE_UPDATES_TABLE} DETACH PARTITION {name}")
+            )
+            await session.execute(text(f"DROP TABLE {name}"))
+            await session.commit()
+        except Exception as e:
+            logger.warning(f"cannot roll up partition `{name}`")
+            await session.rollback()
+            raise
+
+        dropped.append(name)
+        logger.info(f"rolled up and dropped partition `{name}`")
+
+    return dropped
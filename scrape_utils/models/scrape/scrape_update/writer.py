@@ -0,0 +1,63 @@
+"""writer.py.
+
+Buffered bulk writer of scrape_updates rows
+"""
+import logging
+from typing import Any, List
+
+from sqlalchemy import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ....core.settings import SCRAPE_UPDATE_INSERT_CHUNK_SIZE
+from .models import ScrapeUpdate
+from .partitions import ensure_current_partitions
+
+logger = logging.getLogger(__name__)
+
+
+class ScrapeUpdateBuffer:
+    """Collect scrape_updates rows, and insert them with one statement per chunk.
+
+    Flush inside the transaction of the scrape items, so that both commit together
+
+    Usage:
+        buffer = ScrapeUpdateBuffer()
+        buffer.add("book", book.uuid)
+        await buffer.flush(session)
+        await session.commit()
+    """
+
+    def __init__(self, chunk_size: int = SCRAPE_UPDATE_INSERT_CHUNK_SIZE) -> None:
+        assert chunk_size > 0, f"{chunk_size=}"
+        self.chunk_size: int = chunk_size
+        self.rows: List[dict] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, scrape_type: str, scrape_base_id: Any) -> None:
+        # to support both UUID and string id types
+        self.rows.append(
+            {"scrape_base_id": str(scrape_base_id), "scrape_type": scrape_type}
+        )
+
+    def clear(self) -> None:
+        self.rows.clear()
+
+    async def flush(self, session: AsyncSession) -> int:
+        """Insert buffered rows in the current transaction, return the number of rows."""
+        n: int = len(self.rows)
+        if n == 0:
+            return 0
+
+        await ensure_current_partitions(session)
+
+        table = ScrapeUpdate.__table__
+        for i in range(0, n, self.chunk_size):
+            await session.execute(
+                insert(table).values(self.rows[i : i + self.chunk_size])
+            )
+
+        self.rows.clear()
+        logger.debug(f"inserted {n:,} scrape_updates")
+        return n
@@ -0,0 +1,77 @@
+"""benchmark_from_json.py.
+
+Benchmark `from_json` parsing of scrape items, validated versus trusted mode
+
+Usage:
+    python -m scrape_utils.scripts.benchmark_from_json
+    python -m scrape_utils.scripts.benchmark_from_json -n 100000 --repeat 5
+"""
+
+import logging
+import timeit
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import typer
+from rarc_utils.log import get_create_logger
+
+from scrape_utils.models.cache import HttpCacheItem, HttpCacheItemRead
+from scrape_utils.models.redis.helpers import parse_dict_to_model
+
+app = typer.Typer(pretty_exceptions_short=False)
+
+logger = get_create_logger(cmdLevel=logging.INFO, color=1)
+
+
+def make_items(n: int) -> List[dict]:
+    """Create json items, as produced by the spiders."""
+    now: str = datetime.utcnow().isoformat()
+    return [
+        {
+            "url": f"https://example.com/items/{i}",
+            "status": 200,
+            "headers": b"Content-Type: text/html",
+            "body": b"<html></html>",
+            "time": 1_700_000_000.0 + i,
+            "last_scraped": now,
+            "created_at": now,
+        }
+        for i in range(n)
+    ]
+
+
+@app.command()
+def main(
+    n: int = typer.Option(10_000, "-n", help="number of items"),
+    repeat: int = typer.Option(3, "--repeat", help="best of `repeat` runs"),
+):
+    """Implement main app."""
+    items: List[dict] = make_items(n)
+    wrapped: List[dict] = [{"item": item} for item in items]
+
+    cases: Dict[str, Callable] = {}
+    for model in (HttpCacheItem, HttpCacheItemRead):
+        name: str = model.__name__
+        cases |= {
+            f"{name}.from_json": lambda m=model: [m.from_json(i) for i in items],
+            f"{name}.from_json trusted": lambda m=model: [
+                m.from_json(i, trusted=True) for i in items
+            ],
+            f"{name}.from_json_many trusted": lambda m=model: m.from_json_many(
+                items, trusted=True
+            ),
+            f"parse_dict_to_model {name}": lambda m=model: [
+                parse_dict_to_model(i, m) for i in wrapped
+            ],
+            f"parse_dict_to_model {name} trusted": lambda m=model: [
+                parse_dict_to_model(i, m, trusted=True) for i in wrapped
+            ],
+        }
+
+    for case, func in cases.items():
+        best: float = min(timeit.repeat(func, number=1, repeat=repeat))
+        logger.info(f"{case:<50} {best / n * 1e6:8.2f} us/item")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,105 @@
+"""migrate_cache.py.
+
+Copy the redis http cache to another redis database
+
+Full copies walk the cache in chunks and can be resumed after an interruption,
+samples are drawn server-side. Entries keep their date index, and can be
+re-encoded on the fly
+
+Usage:
+    python -m scrape_utils.scripts.migrate_cache --library_name scrape_meetup --http_cache_key http_cache --to_redis_url redis://localhost:6379/5 -n 1000
+    python -m scrape_utils.scripts.migrate_cache --library_name scrape_meetup --http_cache_key http_cache --http_date_key http_cache_dates --to_redis_url redis://localhost:6379/5 --resume
+    python -m scrape_utils.scripts.migrate_cache --library_name scrape_meetup --http_cache_key http_cache --to_redis_url redis://localhost:6379/5 --codec zstd
+"""
+
+import importlib
+import logging
+from typing import Optional
+
+import redis
+import typer
+from rarc_utils.log import get_create_logger
+
+from scrape_utils.cache_http.codecs import BodyCodec, ZstdDictionaries
+from scrape_utils.cache_http.migrate import migrate_cache
+from scrape_utils.core.settings import (HTTP_CACHE_SCAN_PAGE_SIZE,
+                                        HTTP_CACHE_ZSTD_DICTS_KEY)
+
+app = typer.Typer(pretty_exceptions_short=False)
+
+logger = get_create_logger(cmdLevel=logging.INFO, color=1)
+
+
+@app.command()
+def main(
+    library_name: str = typer.Option(...),
+    http_cache_key: str = typer.Option(
+        ..., "--http_cache_key", help="redis hash of the http cache"
+    ),
+    to_redis_url: str = typer.Option(
+        ..., "--to_redis_url", help="redis database to copy to"
+    ),
+    http_date_key: Optional[str] = typer.Option(
+        None, "--http_date_key", help="date zset of the http cache, copied along"
+    ),
+    nsample: Optional[int] = typer.Option(
+        None,
+        "--nsample",
+        "-n",
+        help="number of entries to copy, default is all",
+    ),
+    random: bool = typer.Option(
+        True, "--random/--no-random", help="sample entries, or take the first `n`"
+    ),
+    chunk_size: int = typer.Option(
+        HTTP_CACHE_SCAN_PAGE_SIZE, "--chunk_size", help="entries per round trip"
+    ),
+    resume: bool = typer.Option(
+        False, "--resume", help="continue an interrupted full copy"
+    ),
+    codec: Optional[str] = typer.Option(
+        None,
+        "--codec",
+        help=f"re-encode bodies, one of {[c.name for c in BodyCodec]}",
+    ),
+):
+    """Implement main app."""
+    try:
+        setup_library = importlib.import_module(f"{library_name}.core.setup")
+    except ModuleNotFoundError:
+        logger.error("please pass valid base library to import")
+        return
+
+    settings = setup_library.settings
+    # entries are binary
+    client_from = redis.from_url(settings.redis_url, decode_responses=False)
+    client_to = redis.from_url(to_redis_url, decode_responses=False)
+
+    body_codec: Optional[BodyCodec] = BodyCodec[codec] if codec is not None else None
+    dicts_from: Optional[ZstdDictionaries] = None
+    dicts_to: Optional[ZstdDictionaries] = None
+    # entries compressed with dictionaries need them to be re-encoded, also without
+    # `--codec`: body references and legacy entries are always re-encoded
+    if client_from.exists(HTTP_CACHE_ZSTD_DICTS_KEY):
+        dicts_from = ZstdDictionaries(client_from)
+    if body_codec == BodyCodec.zstd:
+        dicts_to = ZstdDictionaries(client_to)
+
+    res = migrate_cache(
+        client_from,
+        client_to,
+        http_cache_key,
+        http_date_key,
+        n=nsample,
+        random=random,
+        chunk_size=chunk_size,
+        resume=resume,
+        codec=body_codec,
+        dicts_from=dicts_from,
+        dicts_to=dicts_to,
+    )
+    logger.info(f"done. {res}")
+
+
+if __name__ == "__main__":
+    app()
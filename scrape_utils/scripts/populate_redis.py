@@ -17,6 +17,9 @@ Usage:
     ipy ./scrape_meetup/scripts/populate_redis.py -i -- --data_source sitemap
     ipy ./scrape_meetup/scripts/populate_redis.py -i -- --data_source redis -n1000 --dryrun
 
+    # columnar: no per-url objects, pipelined multi-value pushes
+    ipy ./scrape_meetup/scripts/populate_redis.py -i -- --data_source redis --filter_only_new --columnar
+
     # fetches custom urls from data/scrape_urls.jl
     ipy ./scrape_meetup/scripts/populate_redis.py -i --
 
@@ -46,13 +49,16 @@ import typer
 # from dotenv import load_dotenv
 from rarc_utils.log import get_create_logger
 from redis import asyncio as aioredis
+
 # from scrape_utils.core.config_env_file import config_env
 from scrape_utils.core.redis_connection import get_redis_pool, redis_connection
 from scrape_utils.db.helpers import filter_only_new_start_urls
 from scrape_utils.models.redis import (CollectionBase, DataSourceUrls,
+                                       RecordFormat, SitemapBatch,
                                        SitemapRecord)
 from scrape_utils.models.redis.helpers import (delete_redis_keys,
                                                get_scrape_urls_from_source,
+                                               push_batch_to_scrape,
                                                push_redis_to_scrape)
 from scrape_utils.utils import chunked_list, get_create_event_loop, set_ulimit
 from scrape_utils.utils.typer import collection_validator
@@ -130,6 +136,11 @@ def main(
         "--dryrun",
         help="only get data, do not push to redis",
     ),
+    columnar: bool = typer.Option(
+        False,
+        "--columnar",
+        help="read, filter and push urls as one columnar batch",
+    ),
 ):
     """Implement main app."""
     set_ulimit()
@@ -154,12 +165,18 @@ def main(
     MAKE_SINGULAR: Final[bool] = getattr(
         settings_module, "SITEMAP_KEY_MAKE_SINGULAR", False
     )
+    # read-only queries go to the replica, so populating does not load the primary
+    REPLICA_CONNECTION_STR: Final[Optional[str]] = getattr(
+        settings, "db_replica_connection_str", None
+    )
 
     collection: CollectionBase = collection_validator(library_name, collection_member)
 
-    async def _main() -> Optional[List[SitemapRecord]]:
+    async def _main() -> Optional[List[SitemapRecord] | SitemapBatch]:
         """Implement async main loop."""
-        scrape_urls: List[SitemapRecord] = await get_scrape_urls_from_source(
+        scrape_urls: List[
+            SitemapRecord
+        ] | SitemapBatch = await get_scrape_urls_from_source(
             redis_pool,
             data_source=data_source,
             db_connection_str=settings.db_connection_str,
@@ -170,13 +187,18 @@ def main(
             collection=collection,
             collection_as_singular=MAKE_SINGULAR,
             reverse=False,
+            replica_connection_str=REPLICA_CONNECTION_STR,
+            record_format=RecordFormat.batch if columnar else RecordFormat.dict,
         )
 
         logger.warning(f"{scrape_urls[:5]=}")
 
         if filter_only_new:
             scrape_urls = filter_only_new_start_urls(
-                settings.db_connection_str, scrape_urls, table=collection_member
+                settings.db_connection_str,
+                scrape_urls,
+                table=collection_member,
+                replica_connection_str=REPLICA_CONNECTION_STR,
             )
 
         if filter_missing and not filter_only_new:
@@ -193,6 +215,15 @@ def main(
 
         # 'else': push all sitemap events to redis
 
+        if isinstance(scrape_urls, SitemapBatch):
+            async with redis_connection(redis_pool) as client:
+                if not no_delete:
+                    await delete_redis_keys(client, KEYS_TO_DELETE)
+
+                await push_batch_to_scrape(client, scrape_urls)
+
+            return scrape_urls
+
         batches = chunked_list(scrape_urls, MAX_BATCH_SIZE)
 
         async with redis_connection(redis_pool) as client:
@@ -0,0 +1,97 @@
+"""scrape_updates_partitions.py.
+
+Maintain the monthly partitions of the scrape_updates table
+
+Creates partitions ahead of time, and rolls up partitions older than the
+retention period into `scrape_updates_daily`, before dropping them.
+Run it daily, e.g. from cron. A table created before partitioning is converted once
+with `--convert`
+
+Usage:
+    python -m scrape_utils.scripts.scrape_updates_partitions --library_name scrape_meetup
+    python -m scrape_utils.scripts.scrape_updates_partitions --library_name scrape_meetup --retain_months 6
+    python -m scrape_utils.scripts.scrape_updates_partitions --library_name scrape_meetup --no_rollup
+    python -m scrape_utils.scripts.scrape_updates_partitions --library_name scrape_meetup --convert
+"""
+
+import importlib
+import logging
+
+import typer
+from rarc_utils.log import get_create_logger
+
+from scrape_utils.core.db import dispose_async_engines, get_async_session
+from scrape_utils.core.settings import (
+    SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT,
+    SCRAPE_UPDATES_RETAIN_MONTHS_DEFAULT)
+from scrape_utils.models.scrape.scrape_update import (convert_to_partitioned,
+                                                      ensure_partitions,
+                                                      rollup_old_partitions)
+from scrape_utils.utils import get_create_event_loop
+
+app = typer.Typer(pretty_exceptions_short=False)
+loop = get_create_event_loop()
+
+logger = get_create_logger(cmdLevel=logging.INFO, color=1)
+
+
+@app.command()
+def main(
+    library_name: str = typer.Option(...),
+    months_ahead: int = typer.Option(
+        SCRAPE_UPDATES_PARTITIONS_AHEAD_DEFAULT,
+        "--months_ahead",
+        help="create partitions for this many months ahead",
+    ),
+    retain_months: int = typer.Option(
+        SCRAPE_UPDATES_RETAIN_MONTHS_DEFAULT,
+        "--retain_months",
+        help="keep raw scrape_updates for this many months",
+    ),
+    no_rollup: bool = typer.Option(
+        False,
+        "--no_rollup",
+        help="only create partitions, do not roll up and drop old ones",
+    ),
+    convert: bool = typer.Option(
+        False,
+        "--convert",
+        help="first convert a scrape_updates table created before partitioning",
+    ),
+):
+    """Implement main app."""
+    try:
+        setup_library = importlib.import_module(f"{library_name}.core.setup")
+    except ModuleNotFoundError:
+        logger.error("please pass valid base library to import")
+        return
+
+    settings = setup_library.settings
+
+    async def _main() -> None:
+        """Implement async main loop."""
+        async_session = get_async_session(settings.db_async_connection_str)
+        async with async_session() as session:
+            if convert:
+                ncopied = await convert_to_partitioned(
+                    session, months_ahead=months_ahead
+                )
+                logger.info(f"copied {ncopied:,} rows")
+
+            created = await ensure_partitions(session, months_ahead=months_ahead)
+            await session.commit()
+            logger.info(f"created {len(created):,} partitions")
+
+            if not no_rollup:
+                dropped = await rollup_old_partitions(
+                    session, retain_months=retain_months
+                )
+                logger.info(f"rolled up {len(dropped):,} partitions")
+
+        await dispose_async_engines()
+
+    loop.run_until_complete(_main())
+
+
+if __name__ == "__main__":
+    app()
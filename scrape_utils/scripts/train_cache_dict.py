@@ -0,0 +1,129 @@
+"""train_cache_dict.py.
+
+Train zstd dictionaries for http cache bodies, per domain
+
+Samples random entries from the redis http cache, trains one dictionary per domain
+and stores it with its dict id. New entries of the domain are compressed with it,
+older entries keep referencing the dictionary they were written with
+
+Usage:
+    python -m scrape_utils.scripts.train_cache_dict --library_name scrape_meetup --http_cache_key http_cache
+    python -m scrape_utils.scripts.train_cache_dict --library_name scrape_meetup --http_cache_key http_cache --domain www.meetup.com -n 5000
+    python -m scrape_utils.scripts.train_cache_dict --library_name scrape_meetup --http_cache_key http_cache --dryrun
+"""
+
+import importlib
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import lz4.block as lz4  # type: ignore[import]
+import redis
+import typer
+from rarc_utils.log import get_create_logger
+
+from scrape_utils.cache_http.codecs import (BodyCodec, ZstdDictionaries,
+                                            _check_zstd, compress_body,
+                                            sample_bodies, train_dictionary,
+                                            url_domain, zstd)
+from scrape_utils.cache_http.items import read_cache_record
+from scrape_utils.core.settings import (HTTP_CACHE_ZSTD_DICT_SIZE_DEFAULT,
+                                        HTTP_CACHE_ZSTD_TRAIN_MAX_BYTES,
+                                        HTTP_CACHE_ZSTD_TRAIN_SAMPLES_DEFAULT)
+
+app = typer.Typer(pretty_exceptions_short=False)
+
+logger = get_create_logger(cmdLevel=logging.INFO, color=1)
+
+# fewer samples give dictionaries that do not generalize
+MIN_SAMPLES: int = 20
+HMGET_CHUNK_SIZE: int = 500
+
+
+def _ratio(bodies: List[bytes], compress) -> float:
+    raw: int = sum(len(b) for b in bodies)
+    return raw / max(1, sum(len(compress(b)) for b in bodies))
+
+
+@app.command()
+def main(
+    library_name: str = typer.Option(...),
+    http_cache_key: str = typer.Option(
+        ..., "--http_cache_key", help="redis hash of the http cache"
+    ),
+    domain: Optional[str] = typer.Option(
+        None,
+        "--domain",
+        help="only train for this domain, default is every sampled domain",
+    ),
+    nsample: int = typer.Option(
+        HTTP_CACHE_ZSTD_TRAIN_SAMPLES_DEFAULT,
+        "--nsample",
+        "-n",
+        help="number of random cache entries to sample",
+    ),
+    dict_size: int = typer.Option(
+        HTTP_CACHE_ZSTD_DICT_SIZE_DEFAULT,
+        "--dict_size",
+        help="dictionary size in bytes",
+    ),
+    dryrun: bool = typer.Option(
+        False,
+        "--dryrun",
+        help="only train and report compression ratios, do not store dictionaries",
+    ),
+):
+    """Implement main app."""
+    _check_zstd()
+    try:
+        setup_library = importlib.import_module(f"{library_name}.core.setup")
+    except ModuleNotFoundError:
+        logger.error("please pass valid base library to import")
+        return
+
+    settings = setup_library.settings
+    # bodies are binary
+    client = redis.from_url(settings.redis_url, decode_responses=False)
+    dicts = ZstdDictionaries(client)
+
+    keys: List[bytes] = client.hrandfield(http_cache_key, count=nsample) or []
+    logger.info(f"sampled {len(keys):,} keys from `{http_cache_key}`")
+
+    bodies_by_domain: Dict[str, List[bytes]] = defaultdict(list)
+    for i in range(0, len(keys), HMGET_CHUNK_SIZE):
+        for data in client.hmget(http_cache_key, keys[i : i + HMGET_CHUNK_SIZE]):
+            if data is None:
+                continue
+            record = read_cache_record(data, dicts=dicts)
+            record_domain: str = url_domain(record.url)
+            if domain is None or record_domain == domain:
+                bodies_by_domain[record_domain].append(record.body)
+
+    for record_domain, bodies in bodies_by_domain.items():
+        if len(bodies) < MIN_SAMPLES:
+            logger.warning(f"skipping `{record_domain}`, only {len(bodies):,} samples")
+            continue
+
+        # train on one half, report ratios on the other half
+        train, test = bodies[::2], bodies[1::2]
+        samples: List[bytes] = sample_bodies(train, HTTP_CACHE_ZSTD_TRAIN_MAX_BYTES)
+        if dryrun:
+            dictionary = train_dictionary(samples, dict_size, dicts.level)
+            dict_compress = zstd.ZstdCompressor(
+                level=dicts.level, dict_data=dictionary
+            ).compress
+            dict_id = dictionary.dict_id()
+        else:
+            dict_id = dicts.train(record_domain, samples, dict_size=dict_size)
+            dict_compress = dicts.compressor(dict_id).compress
+
+        logger.info(
+            f"`{record_domain}` {dict_id=} {len(samples):,} samples. compression ratio: "
+            f"lz4={_ratio(test, lz4.compress):.1f} "
+            f"zstd={_ratio(test, lambda b: compress_body(b, BodyCodec.zstd)):.1f} "
+            f"zstd+dict={_ratio(test, dict_compress):.1f}"
+        )
+
+
+if __name__ == "__main__":
+    app()
@@ -1 +1,2 @@
 from .main import *
+from .lru import *
@@ -0,0 +1,97 @@
+"""lru.py.
+
+Bounded in-process LRU cache with optional time-to-live and byte budget
+"""
+import logging
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Bounded LRU cache, entries optionally expire after `ttl` seconds.
+
+    With `max_bytes`, the total `sizeof` of all values is bounded too,
+    values larger than `max_bytes` are not cached.
+    Thread-safe, so it can be shared by all workers of a process
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = len,
+    ) -> None:
+        assert maxsize > 0, f"{maxsize=}"
+        assert ttl is None or ttl > 0, f"{ttl=}"
+        assert max_bytes is None or max_bytes > 0, f"{max_bytes=}"
+        self.maxsize: int = maxsize
+        self.ttl: Optional[float] = ttl
+        self.max_bytes: Optional[int] = max_bytes
+        self.sizeof: Callable[[Any], int] = sizeof
+        self.nbytes: int = 0
+        # key -> (expires_at, value, size)
+        self._data: OrderedDict[Hashable, Tuple[float, Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires_at, value, size = entry
+            if expires_at < monotonic():
+                del self._data[key]
+                self.nbytes -= size
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at: float = (
+            monotonic() + self.ttl if self.ttl is not None else float("inf")
+        )
+        size: int = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._data[key] = (expires_at, value, size)
+            self.nbytes += size
+            while len(self._data) > self.maxsize or (
+                self.max_bytes is not None and self.nbytes > self.max_bytes
+            ):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def _pop(self, key: Hashable) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
@@ -1,5 +1,5 @@
 # import versioneer # https://github.com/python-versioneer/python-versioneer/blob/master/INSTALL.md
-from typing import Final, List
+from typing import Dict, Final, List
 
 from setuptools import find_packages, setup
 
@@ -19,10 +19,23 @@ requires: Final[List[str]] = [
     "aio-pika",
     "pika",
     "lz4",
+    # `SitemapBatch`, start url filters and the http cache helpers import these
+    "numpy",
+    "pandas",
+    "python-dateutil",
 ]
 
 # requires: Final[List[str]] = []
 
+# optional requirements, e.g. `pip install scrape_utils[zstd,msgpack]`
+extras: Final[Dict[str, List[str]]] = {
+    # zstd http cache codec, dictionaries and `train_cache_dict`
+    "zstd": ["zstandard"],
+    # msgpack encoding of redis record structs
+    "msgpack": ["msgpack"],
+}
+extras["all"] = sorted({req for reqs in extras.values() for req in reqs})
+
 setup(
     name="scrape_utils",
     version="0.1.3",
@@ -32,6 +45,7 @@ setup(
     author_email="pcbroek@paulbroek.nl",
     license="unlicense",
     install_requires=requires,
+    extras_require=extras,
     include_package_data=True,
     packages=find_packages(),
     python_requires=">=3.9",